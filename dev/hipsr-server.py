@@ -17,7 +17,7 @@ is constantly checked by yet another thread.
 Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
 """
 
-import time, sys, os, signal, random
+import time, sys, os, signal, random, socket
 from datetime import datetime
 from optparse import OptionParser
 import multiprocessing
@@ -37,6 +37,11 @@ from lib.plotter_server import PlotterServer
 from lib.hdf_server import HdfServer
 from lib.katcp_server import KatcpServer, KatcpThread
 from lib.checkpids import checkpids
+from lib.spectrum_ring import SpectrumRing
+from lib.flavor_switch import FlavorSwitcher
+from lib.acc_trace import TraceBuffer
+from lib.metrics import Metrics, MetricsServer
+from lib.queues import PolicyQueue, hdfPolicy, plotterPolicy, printPolicy, mainPolicy, queueReport
 
 try:
     import ujson as json
@@ -52,22 +57,29 @@ __email__    = config.__email__
 __license__  = config.__license__
 __modified__ = datetime.fromtimestamp(os.path.getmtime(os.path.abspath( __file__ )))
 
-def nbprint():
-     """ Non-blocking print from queue"""
-     try:
-         if not printQueue.empty():
-             print printQueue.get(block=False)
-             return False # i.e. is_empty = False
-         else:
-             return True
-     except:
-         time.sleep(1e-6)
+def printServer():
+    """ Print messages from the print queue until the shutdown sentinel arrives """
+    while True:
+        msg = printQueue.get()
+        if msg is None:
+            break
+        print msg
+
+def flushPrints():
+    """ Stop the print server once everything queued so far has been printed """
+    printQueue.put(None)
+    printThread.join(1)
 
 
 def mprint(msg):
     """ Send a message to the multiprocessing print queue """
     printQueue.put(msg)
 
+def releaseDropped(item):
+    """ Return the ring slot of a raw data message dropped from hdfQueue """
+    if isinstance(item, dict) and 'raw_data_slot' in item and spectrumRing is not None:
+        spectrumRing.release(item['raw_data_slot'])
+
 def changeFlavor(current_flavor, new_flavor):
     """ Change flavor of firmware """
 
@@ -97,6 +109,40 @@ if __name__ == '__main__':
                  help="Run in test mode, will write to ./test, and expects messages from the python dummy_TCS script.")
     p.add_option("-d", "--dummy", dest="dummy", action="store_true",
                  help="Run in dummy mode -- uses fake roach boards. For debugging only.")
+    p.add_option("-r", "--ring-slots", dest="ring_slots", type="int", default=4,
+                 help="Shared-memory spectrum slots per ROACH board. Set to 0 to pickle spectra instead. Defaults to 4.")
+    p.add_option("-p", "--plot-rate", dest="plot_rate", type="float", default=10,
+                 help="Maximum plotter update rate (Hz). Only the newest frame per beam is sent. Set to 0 to send every frame. Defaults to 10.")
+    p.add_option("-b", "--plot-format", dest="plot_format", type="choice", choices=['json', 'binary'], default='json',
+                 help="Spectrum frame format for the plotter: json or binary. Defaults to json.")
+    p.add_option("-c", "--concurrent-reads", dest="max_reads", type="int", default=4,
+                 help="Maximum number of ROACH boards read at the same time. Defaults to 4.")
+    p.add_option("-w", "--wait-capture", dest="wait_capture", action="store_true",
+                 help="Wait until every board has been read before passing any data on (disables pipelined capture).")
+    p.add_option("-D", "--deadline", dest="deadline_frac", type="float", default=0.8,
+                 help="Capture deadline as a fraction of the dump period. Boards not read in time are marked as missing. Set to 0 to disable. Defaults to 0.8.")
+    p.add_option("-m", "--max-program", dest="max_program", type="int", default=4,
+                 help="Maximum number of ROACH boards programmed at the same time. Defaults to 4.")
+    p.add_option("-T", "--trace-hdf", dest="trace_hdf", action="store_true",
+                 help="Write pipeline stage timestamps of every beam's data to a /trace table in the HDF file.")
+    p.add_option("-M", "--metrics-port", dest="metrics_port", type="int", default=9180,
+                 help="Port of the local HTTP metrics endpoint (queue depths, rates, process health). Set to 0 to disable. Defaults to 9180.")
+    p.add_option("-n", "--dummy-boards", dest="dummy_boards", type="int", default=0,
+                 help="Dummy mode only: number of fake ROACH boards, taken from the start of the roach list. Defaults to all.")
+    p.add_option("-a", "--dummy-period", dest="dummy_period", type="float", default=0.5,
+                 help="Dummy mode only: accumulation period (s) of the fake ROACH boards. Defaults to 0.5.")
+    p.add_option("-S", "--dummy-sim", dest="dummy_sim", type="string", default="",
+                 help="Dummy mode only: simulator settings, e.g. \"latency=0.01,jitter=0.005,fail_rate=0.001,roach03:hang_rate=0.1\".")
+    p.add_option("-R", "--record-tcs", dest="record_tcs", type="string", default=None,
+                 help="Record every TCS command with a monotonic timestamp to this file, for test/hipsr-tcs-replay.py.")
+    p.add_option("-Q", "--queue-size", dest="queue_size", type="int", default=256,
+                 help="Maximum data messages on the HDF and plotter queues. Raw data then waits, and spills to disk; plotter frames drop the oldest. Defaults to 256.")
+    p.add_option("-Z", "--rollover-size", dest="rollover_size", type="float", default=0,
+                 help="Start the next HDF file of the output set once the file reaches this size (MB). Defaults to hdf_rollover in the config, or no limit.")
+    p.add_option("-N", "--rollover-rows", dest="rollover_rows", type="int", default=0,
+                 help="Start the next HDF file once this many raw_data rows (all beams) have been written to it. Defaults to hdf_rollover in the config, or no limit.")
+    p.add_option("-I", "--rollover-interval", dest="rollover_interval", type="float", default=0,
+                 help="Start the next HDF file once the file is this many minutes old. Defaults to hdf_rollover in the config, or no limit.")
     (options, args) = p.parse_args(sys.argv[1:])
 
     try:
@@ -112,6 +158,13 @@ if __name__ == '__main__':
             import lib.dummy_katcp_wrapper as katcp_wrapper
             katcp_helpers.katcp_wrapper = katcp_wrapper
             KatcpServer.katcp_wrapper   = katcp_wrapper
+            katcp_wrapper.settings['acc_period']  = options.dummy_period
+            katcp_wrapper.settings['acc_len_ref'] = config.fpga_config[options.flavor].get("acc_len")
+            katcp_wrapper.configure(options.dummy_sim)
+            if options.dummy_boards > 0:
+                roaches = sorted(config.roachlist.keys(), key=lambda roach: config.roachlist[roach])
+                config.roachlist = dict([(roach, config.roachlist[roach]) for roach in roaches[:options.dummy_boards]])
+                print "Using %i dummy boards, %2.2f s accumulations"%(len(config.roachlist), options.dummy_period)
 
 
 
@@ -144,13 +197,26 @@ if __name__ == '__main__':
         roachlist    = config.roachlist
         katcp_port   = config.katcp_port
 
-        # Setup communiction queues
-        printQueue     = multiprocessing.Queue()
-        mainQueue      = multiprocessing.Queue()
+        # Setup communiction queues. Each has a bounded data lane with a drop policy,
+        # and a control lane for messages that must never be dropped
+        spectrumRing   = None
+        printQueue     = PolicyQueue('print', printPolicy, maxsize=1000)
+        mainQueue      = PolicyQueue('main', mainPolicy, maxsize=1000)
         tcsQueue       = multiprocessing.Queue()
-        hdfQueue       = multiprocessing.Queue()
-        plotterQueue   = multiprocessing.Queue()
+        hdfQueue       = PolicyQueue('hdf', hdfPolicy, maxsize=options.queue_size,
+                                     spill_dir=os.path.join(config.data_dir, 'spill'), on_drop=releaseDropped)
+        plotterQueue   = PolicyQueue('plotter', plotterPolicy, maxsize=options.queue_size)
         katcpQueue     = Queue.Queue()
+        policyQueues   = [hdfQueue, plotterQueue, printQueue, mainQueue]
+
+        printThread = threading.Thread(target=printServer)
+        printThread.daemon = True
+        printThread.start()
+
+        # Shared-memory ring for passing spectra to the HDF writer
+        # Slots are sized for the largest (16384 channel) flavors
+        if options.ring_slots > 0:
+            spectrumRing = SpectrumRing(options.ring_slots * len(roachlist), 4 * 16384 * 8 + 4096)
         
 
         # From this point, using print queue only
@@ -158,10 +224,12 @@ if __name__ == '__main__':
         mprint("-------------------"  )
 
         if options.test:
-            tcsThread = TcsServer('localhost', 8080, printQueue, mainQueue, hdfQueue, plotterQueue, debug=options.verbose)
+            tcsThread = TcsServer('localhost', 8080, printQueue, mainQueue, hdfQueue, plotterQueue, debug=options.verbose,
+                                  record=options.record_tcs)
         else:
             server, port = config.tcs_server, config.tcs_port,
-            tcsThread = TcsServer(server, port, printQueue, mainQueue, hdfQueue, plotterQueue, debug=options.verbose)
+            tcsThread = TcsServer(server, port, printQueue, mainQueue, hdfQueue, plotterQueue, debug=options.verbose,
+                                  record=options.record_tcs)
         tcsThread.daemon = True
         tcsThread.start()
         tcsThread.send_udp = True
@@ -173,9 +241,11 @@ if __name__ == '__main__':
         mprint("\nStarting Plotter server")
         mprint("-----------------------"  )
         if options.test:
-            plotterThread = PlotterServer('localhost', 59012, printQueue, mainQueue, plotterQueue)
+            plotterThread = PlotterServer('localhost', 59012, printQueue, mainQueue, plotterQueue,
+                                          frame_rate=options.plot_rate, frame_format=options.plot_format)
         else:
-            plotterThread = PlotterServer(config.plotter_host, config.plotter_port, printQueue, mainQueue, plotterQueue)
+            plotterThread = PlotterServer(config.plotter_host, config.plotter_port, printQueue, mainQueue, plotterQueue,
+                                          frame_rate=options.plot_rate, frame_format=options.plot_format)
 
         plotterThread.daemon = True
         plotterThread.start()
@@ -186,7 +256,15 @@ if __name__ == '__main__':
 
         mprint("\nStarting HDF server")
         mprint("--------------------" )
-        hdfThread = HdfServer(dir_path, mainQueue, printQueue, hdfQueue, tcsQueue, flavor=options.flavor)
+        rollover = {}
+        if options.rollover_size:
+            rollover['max_bytes'] = int(options.rollover_size * 2**20)
+        if options.rollover_rows:
+            rollover['max_rows'] = options.rollover_rows
+        if options.rollover_interval:
+            rollover['max_age'] = options.rollover_interval * 60
+        hdfThread = HdfServer(dir_path, mainQueue, printQueue, hdfQueue, tcsQueue, flavor=options.flavor,
+                              spectrumRing=spectrumRing, trace_table=options.trace_hdf, rollover=rollover)
         hdfThread.daemon = True
         hdfThread.start()
             
@@ -195,32 +273,44 @@ if __name__ == '__main__':
         mprint("\nConfiguring FPGAs")
         mprint("-----------------\n")
         
-        is_empty = False
-        while not is_empty:
-            is_empty = nbprint()
-            time.sleep(1e-6)
-        
         fpgalist  = [katcp_wrapper.FpgaClient(roach, config.katcp_port, timeout=10) for roach in config.roachlist]
-        if not options.dummy:
-            time.sleep(0.5)
         if not options.skip_reprogram:
-            katcp_helpers.reprogram(options.flavor)
-            katcp_helpers.reconfigure(options.flavor)
+            FlavorSwitcher(printQueue, options.max_program).switch(fpgalist, options.flavor)
         else:
             print "skipping reprogramming..."
             print "skipping reconfiguration.."
-        if not options.dummy:
-            time.sleep(1)
-            for fpga in fpgalist:
-                fpga.stop()
+        for fpga in fpgalist:
+            fpga.stop()
             
         
         mprint("\nStarting KATCP servers")
         mprint("------------------------")
-        katcpServer = KatcpServer(printQueue, mainQueue, hdfQueue, katcpQueue, plotterQueue, flavor=options.flavor, dummyMode=options.dummy)
+        katcpServer = KatcpServer(printQueue, mainQueue, hdfQueue, katcpQueue, plotterQueue, flavor=options.flavor, dummyMode=options.dummy,
+                                  spectrumRing=spectrumRing, plot_format=options.plot_format,
+                                  max_reads=options.max_reads, pipelined=not options.wait_capture,
+                                  deadline_frac=options.deadline_frac, max_program=options.max_program)
         #katcpThread = KatcpServer(printQueue, mainQueue,  hdfQueue, katcpQueue, plotterQueue, 
         katcpServer.daemon = True
         katcpServer.start()
+
+        metrics = Metrics()
+        for name, queue in (('main', mainQueue), ('print', printQueue), ('tcs', tcsQueue), ('hdf', hdfQueue),
+                            ('plotter', plotterQueue), ('katcp', katcpQueue)):
+            metrics.addQueue(name, queue)
+        for name, pid in (('main', os.getpid()), ('tcs_server', tcsThread.pid),
+                          ('plotter_server', plotterThread.pid), ('hdf_server', hdfThread.pid)):
+            metrics.addProcess(name, pid)
+        metrics.setKatcpServer(katcpServer)
+        metricsServer = None
+        if options.metrics_port:
+            try:
+                metricsServer = MetricsServer(metrics, 'localhost', options.metrics_port)
+                metricsServer.daemon = True
+                metricsServer.start()
+                mprint("Metrics served on http://localhost:%i/metrics"%options.metrics_port)
+            except socket.error as e:
+                mprint("WARNING: cannot serve metrics on port %i: %s"%(options.metrics_port, e))
+                metricsServer = None
         #mprint("%i KATCP server daemons started."%len(fpgalist))
         
         # Now to start data accumulation while loop
@@ -228,6 +318,9 @@ if __name__ == '__main__':
         mprint("------------------------")
         #getSpectraThreaded(fpgalist, katcpQueue)
         acc_old, acc_new = 0, 0
+        acc_time         = None
+        traceBuffer      = TraceBuffer()
+        t_report, last_report = time.time(), None
         current_ra, current_dec = 0, 0
         allSystemsGo     = True
         crash = False
@@ -238,14 +331,15 @@ if __name__ == '__main__':
         while allSystemsGo:
 
             try:
-                # Print all items in print queue
-                is_empty = False
-                while not is_empty:
-                    is_empty = nbprint()
-                    time.sleep(1e-6)
-                
+                # Wake on the next message (e.g. acc_new from the accumulation watcher)
+                try:
+                    msgs = [mainQueue.get(timeout=1)]
+                except Queue.Empty:
+                    msgs = []
                 while not mainQueue.empty():
-                    msg = mainQueue.get()
+                    msgs.append(mainQueue.get())
+
+                for msg in msgs:
                     #print "HERE: %s"%msg
                     for key in msg.keys():
                         if options.verbose:
@@ -274,9 +368,16 @@ if __name__ == '__main__':
                                 current_flavor = msg[key]
                                 #current_flavor = changeFlavor(current_flavor, msg[key])
                         if key == 'acc_new':
-                            acc_new = msg[key]
-
-                if acc_new > acc_old:
+                            acc_new  = msg[key]
+                            acc_time = msg.get('acc_time')
+                        if key == 'trace':
+                            traceBuffer.add(msg[key])
+                        if key == 'trace_summary':
+                            mprint(traceBuffer.summary())
+                        if key == 'stats':
+                            metrics.update(msg[key])
+
+                if acc_new != acc_old:
                     if hdf_write_enable:
                         wr_en = "[WE]"
                     else:
@@ -289,11 +390,15 @@ if __name__ == '__main__':
                     ra, dec = float(current_ra), float(current_dec)
                     print("%s UTC: %s, RA: %02.2f, DEC: %02.2f, Acc: %i"%(wr_en, now_fmt, ra, dec, acc_new))
                     acc_old = acc_new
-                    katcpQueue.put({'new_acc': True})
+                    metrics.accumulation()
+                    katcpQueue.put({'new_acc': acc_new, 'acc_time': acc_time})
                     katcpQueue.put({'timestamp': timestamp})
-                   
-                katcpQueue.put({'check_acc': acc_old})
-                time.sleep(0.5)
+
+                if time.time() - t_report > 60:
+                    report = queueReport(policyQueues)
+                    if report != last_report:
+                        mprint("WARNING: %s"%report)
+                    t_report, last_report = time.time(), report
             except:
                 allSystemsGo = False
                 crash = True
@@ -305,19 +410,17 @@ if __name__ == '__main__':
                 mprint("ERROR: One or more server threads has crashed! This script will now close.")
             else:
                 mprint("INFO: Shutting down.")
-            # Print all items in print queue
-            try:
-                hdfQueue.put({'safe_exit': ''})
-                time.sleep(0.1)
-            except:
-                raise
-            is_empty = False
-            #mprint("INFO: Flushing print queue")
-            while not is_empty:
-                is_empty = nbprint()
-                time.sleep(1e-6)
+            # Send shutdown sentinels, then wait for the HDF file to close
             hdfQueue.put({'safe_exit': ''})
-            hdfThread.join(0.1)
+            hdfQueue.put(None)
+            plotterQueue.put(None)
+            katcpQueue.put(None)
+            hdfThread.join(5)
+            if metricsServer is not None:
+                metricsServer.stop()
+            mprint(traceBuffer.summary())
+            mprint(queueReport(policyQueues) or "queues: nothing dropped")
+            flushPrints()
             tcsThread.join(0.1)
             plotterThread.join(0.1)
             #katcpThread.join(0.1)
@@ -327,11 +430,9 @@ if __name__ == '__main__':
         allSystemsGo = False
         mprint("Keyboard interrupt caught. Closing threads...")
         hdfQueue.put({'safe_exit': ''})
-        time.sleep(0.1)
-        is_empty = False
-        while not is_empty:
-            is_empty = nbprint()
-            time.sleep(1e-6)
+        hdfQueue.put(None)
+        hdfThread.join(5)
+        flushPrints()
         try:
             katcp.terminate()
             hdfThread.terminate()
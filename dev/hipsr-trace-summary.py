@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-trace-summary.py
+======================
+
+Print p50, p95 and p99 of each pipeline stage from the /trace table of HIPSR HDF
+files, as written by hipsr-server.py --trace-hdf.
+
+Usage: python hipsr-trace-summary.py file.h5 [file2.h5 ...]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import sys
+import numpy as np
+import tables
+
+from lib.acc_trace import STAGES, TraceBuffer
+
+
+def readTraces(filename):
+    """ Return the traces in a file's /trace table as a list of dictionaries """
+    h5 = tables.openFile(filename)
+    try:
+        if 'trace' not in h5.root:
+            print "%s has no trace table"%filename
+            return []
+        rows = h5.root.trace[:]
+    finally:
+        h5.close()
+
+    traces = []
+    for row in rows:
+        trace = {'acc': int(row['acc']), 'beam_id': row['beam_id']}
+        for stage in STAGES:
+            if not np.isnan(row[stage]):
+                trace[stage] = float(row[stage])
+        traces.append(trace)
+    return traces
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit()
+
+    traces = []
+    for filename in sys.argv[1:]:
+        traces += readTraces(filename)
+
+    traceBuffer = TraceBuffer(maxlen=max(len(traces), 1))
+    for trace in traces:
+        traceBuffer.add(trace)
+    print traceBuffer.summary()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+acc_trace.py
+============
+
+Per-accumulation latency traces through the server pipeline.
+
+A trace is a dictionary carried with each beam's data from the KATCP threads to
+the HDF writer and the plotter, with the accumulation number, the beam_id and a
+unix timestamp for each stage it has passed:
+
+    detect        AccWatcher sees o_acc_cnt change
+    read_start    KatcpThread starts reading the board
+    read_end      KatcpThread has read the spectra
+    squash        squashSpectrum done
+    hdf_enqueue   data put on the HDF queue
+    hdf_dequeue   HDF writer takes the data off the queue
+    hdf_append    row appended (buffered) to the beam's raw_data table
+    hdf_flush     rows flushed to disk
+    plot_enqueue  frame put on the plotter queue
+    plot_dequeue  plotter takes the frame off the queue
+    udp_send      frame sent to the GUI
+
+The HDF writer and the plotter send finished traces to the main process as
+{'trace': trace} messages, where a TraceBuffer keeps the most recent ones and
+the statistics of the time spent in each stage.
+"""
+
+from collections import OrderedDict
+from latency import LatencyStats
+
+STAGES = ['detect', 'read_start', 'read_end', 'squash', 'hdf_enqueue', 'hdf_dequeue', 'hdf_append',
+          'hdf_flush', 'plot_enqueue', 'plot_dequeue', 'udp_send']
+
+# (name, from stage, to stage) of the reported intervals
+INTERVALS = [
+    ('wait',        'detect',       'read_start'),
+    ('read',        'read_start',   'read_end'),
+    ('squash',      'read_end',     'squash'),
+    ('hdf_enqueue', 'squash',       'hdf_enqueue'),
+    ('hdf_queue',   'hdf_enqueue',  'hdf_dequeue'),
+    ('hdf_append',  'hdf_dequeue',  'hdf_append'),
+    ('hdf_flush',   'hdf_append',   'hdf_flush'),
+    ('plot_encode', 'hdf_enqueue',  'plot_enqueue'),
+    ('plot_queue',  'plot_enqueue', 'plot_dequeue'),
+    ('udp_send',    'plot_dequeue', 'udp_send'),
+    ('to_disk',     'detect',       'hdf_flush'),
+    ('to_gui',      'detect',       'udp_send')
+]
+
+
+def traceIntervals(trace):
+    """ Return a list of (name, seconds) for the intervals a trace has both ends of """
+    intervals = []
+    for name, start, end in INTERVALS:
+        if trace.get(start) is not None and trace.get(end) is not None:
+            intervals.append((name, trace[end] - trace[start]))
+    return intervals
+
+
+class TraceBuffer(object):
+    """ Rolling buffer of accumulation traces, merged by accumulation and beam """
+    def __init__(self, maxlen=2000):
+        self.maxlen = maxlen
+        self.traces = OrderedDict()     # (acc, beam_id): merged trace
+        self.counted = {}               # (acc, beam_id): intervals already in stats
+        self.stats  = LatencyStats(maxlen)
+
+    def add(self, trace):
+        """ Merge a (partial) trace into the buffer, and update the stage statistics """
+        key = (trace.get('acc'), trace.get('beam_id'))
+        if key in self.traces:
+            self.traces[key].update(trace)
+        else:
+            self.traces[key]  = dict(trace)
+            self.counted[key] = set()
+            while len(self.traces) > self.maxlen:
+                old_key, old = self.traces.popitem(last=False)
+                del self.counted[old_key]
+
+        counted = self.counted[key]
+        for name, latency in traceIntervals(self.traces[key]):
+            if name not in counted:
+                self.stats.add(name, latency)
+                counted.add(name)
+
+    def getTraces(self):
+        """ Return the merged traces in the buffer, oldest first """
+        return self.traces.values()
+
+    def summary(self, qs=(50, 95, 99)):
+        """ Return a table of percentiles (ms) of each stage """
+        keys = [name for name, start, end in INTERVALS]
+        return "Trace summary (%i traces)\n"%len(self.traces) + self.stats.summary(qs, keys)
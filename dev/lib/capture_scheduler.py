@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+capture_scheduler.py
+====================
+
+Plans when each ROACH board is read after an accumulation dump.
+
+The read latency of every board is measured on each capture and smoothed with an
+EWMA. For the next dump, boards are assigned to a fixed number of read lanes,
+longest expected read first, each board going to the lane that frees up earliest
+(longest processing time first scheduling). At most max_reads boards are read at
+once, so reads do not pile up on the network, and the slowest boards start first,
+so the whole set finishes as soon as possible after the dump.
+
+Captures are tracked by accumulation number rather than with a barrier, so the
+reads of one accumulation can overlap the writing of the previous one.
+"""
+
+import threading, time
+from collections import OrderedDict, deque
+from latency import LatencyStats
+
+
+class CaptureScheduler(object):
+    """ Staggers board reads using measured per-board read latencies """
+    def __init__(self, max_reads=4, default_latency=0.1, alpha=0.25, maxlen=1000, max_accs=8):
+        self.max_reads       = max(int(max_reads), 1)
+        self.default_latency = default_latency   # Estimate for boards never read
+        self.alpha           = alpha             # EWMA weight of a new measurement
+        self.estimates       = {}
+        self.acc_latency     = OrderedDict()         # Read latencies of accumulations not yet summarized
+        self.max_accs        = max_accs
+        self.summarized      = deque(maxlen=max_accs)
+        self.stats           = LatencyStats(maxlen)
+        self.lock            = threading.Lock()
+
+    def estimate(self, beam_id):
+        """ Return the expected read latency of a board, in seconds """
+        try:
+            return self.estimates[beam_id]
+        except KeyError:
+            if self.estimates:
+                return max(self.estimates.values())
+            return self.default_latency
+
+    def plan(self, beam_ids):
+        """ Return a dictionary of read start offsets (s after the dump) per beam_id """
+        with self.lock:
+            expected = dict([(beam_id, self.estimate(beam_id)) for beam_id in beam_ids])
+        lanes   = [0.0] * min(self.max_reads, max(len(beam_ids), 1))
+        offsets = {}
+        for beam_id in sorted(beam_ids, key=lambda b: expected[b], reverse=True):
+            lane = lanes.index(min(lanes))
+            offsets[beam_id] = lanes[lane]
+            lanes[lane] += expected[beam_id]
+        return offsets
+
+    def record(self, beam_id, latency, acc=None):
+        """ Record the measured read latency of a board for accumulation acc """
+        with self.lock:
+            if beam_id in self.estimates:
+                self.estimates[beam_id] += self.alpha * (latency - self.estimates[beam_id])
+            else:
+                self.estimates[beam_id] = latency
+            self.stats.add(beam_id, latency)
+            if acc in self.summarized:
+                # A late read of an accumulation that has already been summarized
+                return
+            if acc not in self.acc_latency and len(self.acc_latency) >= self.max_accs:
+                # Accumulations that were never summarized
+                self.acc_latency.popitem(last=False)
+            self.acc_latency.setdefault(acc, {})[beam_id] = latency
+
+    def accSummary(self, acc=None):
+        """ Return a one-line summary of the read latencies (ms) of accumulation acc """
+        with self.lock:
+            latency = self.acc_latency.pop(acc, {})
+            self.summarized.append(acc)
+        items = ["%s=%.1f"%(beam_id, latency[beam_id] * 1e3) for beam_id in sorted(latency.keys())]
+        if latency:
+            items.append("max=%.1f"%(max(latency.values()) * 1e3))
+        return " ".join(items)
+
+
+class AccTracker(object):
+    """ Tracks which boards are still being read, by accumulation number.
+
+    A board's data is only passed on if claim() succeeds, i.e. the board has not
+    been expired for missing its deadline. on_complete(acc, t_elapsed) is called,
+    from the thread that finished last, once every board of an accumulation has
+    either been read or expired.
+    """
+    def __init__(self, on_complete=None):
+        self.on_complete = on_complete
+        self.pending     = {}       # acc: beam_ids not yet claimed or expired
+        self.outstanding = {}       # acc: beam_ids not yet done or expired
+        self.t_start     = {}
+        self.busy        = set()
+        self.missed      = {}       # beam_id: number of missed deadlines
+        self.late        = {}       # beam_id: number of reads dropped after a deadline
+        self.lock        = threading.Condition()
+
+    def isBusy(self, beam_id):
+        """ Return True if a board is still being read for an earlier accumulation """
+        with self.lock:
+            return beam_id in self.busy
+
+    def start(self, acc, beam_ids):
+        """ Register the boards being read for accumulation acc """
+        if not beam_ids:
+            return
+        with self.lock:
+            self.pending.setdefault(acc, set()).update(beam_ids)
+            self.outstanding.setdefault(acc, set()).update(beam_ids)
+            self.t_start.setdefault(acc, time.time())
+            self.busy.update(beam_ids)
+
+    def skip(self, beam_id):
+        """ Count a board that was not read at all for an accumulation """
+        with self.lock:
+            self.missed[beam_id] = self.missed.get(beam_id, 0) + 1
+
+    def claim(self, acc, beam_id):
+        """ Return True if a board's data for acc should be passed on, False if it is late """
+        with self.lock:
+            beams = self.pending.get(acc)
+            if beams is not None and beam_id in beams:
+                beams.discard(beam_id)
+                return True
+            self.late[beam_id] = self.late.get(beam_id, 0) + 1
+            return False
+
+    def expire(self, acc):
+        """ Give up on the boards of acc that have not been read. Returns their beam_ids. """
+        with self.lock:
+            missing = sorted(self.pending.pop(acc, set()))
+            for beam_id in missing:
+                self.outstanding[acc].discard(beam_id)
+                self.missed[beam_id] = self.missed.get(beam_id, 0) + 1
+            t_elapsed = self.checkComplete(acc)
+        if t_elapsed is not None and self.on_complete is not None:
+            self.on_complete(acc, t_elapsed)
+        return missing
+
+    def done(self, acc, beam_id):
+        """ Mark a board as finished with accumulation acc, whether or not it was read """
+        with self.lock:
+            self.busy.discard(beam_id)
+            if acc in self.outstanding:
+                self.outstanding[acc].discard(beam_id)
+            t_elapsed = self.checkComplete(acc)
+        if t_elapsed is not None and self.on_complete is not None:
+            self.on_complete(acc, t_elapsed)
+
+    def checkComplete(self, acc):
+        """ Forget acc if every board is finished, returning its capture time. Call with the lock held. """
+        if acc not in self.outstanding or self.outstanding[acc]:
+            return None
+        del self.outstanding[acc]
+        self.pending.pop(acc, None)
+        self.lock.notifyAll()
+        return time.time() - self.t_start.pop(acc)
+
+    def wait(self, acc):
+        """ Block until every board of acc has been read or expired """
+        with self.lock:
+            while acc in self.outstanding:
+                self.lock.wait(1)
+
+    def inFlight(self):
+        """ Return the accumulation numbers that are still being read """
+        with self.lock:
+            return sorted(self.outstanding.keys())
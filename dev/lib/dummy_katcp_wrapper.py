@@ -20,105 +20,254 @@ Add this to your file:
 
 And then let the dodgy magic of this script take over. Note that if you include things that use
 katcp_wrapper, after you include them you'l have to do as I've done above for katcp_helpers...
+
+
+Simulator
+~~~~~~~~~
+Each host is a simulated board, which outlives its FpgaClient connections:
+
+* A board starts unprogrammed, and lists no registers. progdev loads the ROACH
+  system registers (sys_clkcounter, sys_scratchpad, sys_board_id, sys_rev) and
+  the design registers of every flavor in hipsr_core.config that uses the bof file.
+* o_acc_cnt follows a clock: it counts accumulations of acc_period seconds since the
+  last master_reset, scaled by acc_len / acc_len_ref if both are known.
+* Snap brams are served from a bank of pregenerated bandpasses, as big-endian
+  uint32 strings made once per bram size. Any number of channels works: a read of
+  n words from snap_xx0_bram / snap_xx1_bram returns the even / odd channels of a
+  2n channel spectrum, so 16384 channel flavors work too.
+* Every read and write takes latency + |gauss(jitter)| + bytes / read_rate
+  seconds. fail_rate is the chance that a call raises RuntimeError (a timed out
+  request), hang_rate the chance that it takes hang_time longer, and
+  disconnect_rate the chance that the board drops off for down_time seconds.
+
+The settings apply to all boards, and can be overridden per board:
+
+    configure("latency=0.01,jitter=0.005,roach03:hang_rate=0.1")
 """
 
 import numpy as np
-import struct, time
+import random, threading, time
+import hipsr_core.config as config
+
+# Simulator settings for all boards. Per-board overrides are in board_settings[host].
+settings = {
+    'acc_period'      : 0.5,    # Seconds per accumulation at acc_len_ref
+    'acc_len_ref'     : None,   # acc_len that gives acc_period, or None to ignore acc_len
+    'latency'         : 0.002,  # Seconds per KATCP request
+    'jitter'          : 0.001,  # Standard deviation of the extra request time (s)
+    'read_rate'       : 20e6,   # Bytes per second read or written
+    'fail_rate'       : 0.0,    # Probability that a request raises RuntimeError
+    'hang_rate'       : 0.0,    # Probability that a request hangs for hang_time
+    'hang_time'       : 2.0,
+    'disconnect_rate' : 0.0,    # Probability that a request drops the connection for down_time
+    'down_time'       : 5.0,
+    'n_bank'          : 16      # Number of pregenerated spectra
+}
+board_settings = {}
+
+_boards     = {}                # host: SimulatedBoard
+_bank_cache = {}                # (n_chans, ...): bank of spectra, or of packed bram strings
+_lock       = threading.Lock()
+
+
+def configure(spec):
+    """ Update the simulator settings from a "key=val,host:key=val" string """
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        key, val = item.split('=', 1)
+        host, _, key = key.strip().rpartition(':')
+        if key not in settings:
+            raise KeyError("unknown simulator setting %s"%key)
+        val = None if val.strip() == 'None' else float(val)
+        if host:
+            board_settings.setdefault(host, {})[key] = val
+        else:
+            settings[key] = val
+
+def makeBank(n_chans, n_spectra):
+    """ Generate an (n_spectra, n_chans) array of fake bandpasses with noise and a spike """
+    edge = n_chans / 8
+    bandpass = np.ones(n_chans) * 1e5
+    bandpass[:edge]  = 1e2
+    bandpass[-edge:] = 1e2
+    bank = bandpass + np.random.randint(0, 101, (n_spectra, n_chans))
+    for spectrum in bank:
+        spike_bin = np.random.randint(edge, n_chans - edge)
+        spectrum[spike_bin-2:spike_bin+2] += 1e6 * np.random.random()
+    return bank
+
+def getBramBank(n_words, part, n_parts=2):
+    """ Return a list of packed (big-endian uint32) strings of one part of each bank spectrum """
+    key = (n_words * n_parts, part, n_parts)
+    with _lock:
+        if key not in _bank_cache:
+            n_chans = n_words * n_parts
+            if n_chans not in _bank_cache:
+                _bank_cache[n_chans] = makeBank(n_chans, int(settings['n_bank']))
+            spectra = _bank_cache[n_chans][:, part::n_parts].astype('>u4')
+            _bank_cache[key] = [spectrum.tostring() for spectrum in spectra]
+        return _bank_cache[key]
+
+def getNoiseBank(num_bytes):
+    """ Return a list of random byte strings, for brams without a bandpass """
+    key = ('noise', num_bytes)
+    with _lock:
+        if key not in _bank_cache:
+            noise = np.random.randint(0, 256, (int(settings['n_bank']), num_bytes)).astype('uint8')
+            _bank_cache[key] = [row.tostring() for row in noise]
+        return _bank_cache[key]
+
+def getBoard(host):
+    """ Return the simulated board for a host, creating it if needed """
+    with _lock:
+        if host not in _boards:
+            _boards[host] = SimulatedBoard(host, len(_boards))
+        return _boards[host]
+
+
+class SimulatedBoard(object):
+    """ The state of a simulated ROACH board: registers, brams and the accumulation clock """
+    def __init__(self, host, index):
+        self.host       = host
+        self.index      = index
+        self.registers  = {}
+        self.brams      = {}
+        self.t_reset    = time.time()
+        self.acc_offset = 0
+        self.down_until = 0
+
+    def setting(self, key):
+        """ Return a simulator setting, with this board's override if it has one """
+        return board_settings.get(self.host, {}).get(key, settings[key])
+
+    def accPeriod(self):
+        """ Return the accumulation period (s) for the current acc_len """
+        period  = self.setting('acc_period')
+        acc_len = self.registers.get('acc_len')
+        ref     = self.setting('acc_len_ref')
+        if acc_len and ref:
+            period = period * float(acc_len) / float(ref)
+        return period
+
+    def accCount(self, now=None):
+        """ Return the number of accumulations since the last reset """
+        if now is None:
+            now = time.time()
+        return self.acc_offset + int((now - self.t_reset) / self.accPeriod())
+
+    def writeRegister(self, reg_id, value):
+        """ Write a register. acc_len keeps the count going at the new rate; master_reset restarts it. """
+        now = time.time()
+        if reg_id == 'acc_len':
+            self.acc_offset = self.accCount(now)
+            self.t_reset    = now
+        elif reg_id == 'master_reset' and value and not self.registers.get('master_reset'):
+            self.acc_offset = 0
+            self.t_reset    = now
+        self.registers[reg_id] = value
+
+    def program(self, boffile):
+        """ Load a design: the system registers, and the registers of the flavors that use boffile """
+        self.registers.clear()
+        self.brams.clear()
+        self.registers.update({
+            'sys_clkcounter' : 0,
+            'sys_scratchpad' : 0,
+            'sys_board_id'   : 0,
+            'sys_rev'        : 0,
+            'master_reset'   : 0,
+            'o_acc_cnt'      : 0
+        })
+        for fpga_config in config.fpga_config.values():
+            if fpga_config["firmware"] == boffile:
+                for key in fpga_config.keys():
+                    if key != "firmware":
+                        self.registers.setdefault(key, 0)
+        self.acc_offset = 0
+        self.t_reset    = time.time()
+
+    def isConnected(self):
+        return time.time() >= self.down_until
+
+    def request(self, num_bytes=4):
+        """ Take the time of a KATCP request, injecting failures """
+        if not self.isConnected():
+            raise RuntimeError("%s: not connected"%self.host)
+        if random.random() < self.setting('disconnect_rate'):
+            self.down_until = time.time() + self.setting('down_time')
+            raise RuntimeError("%s: connection lost"%self.host)
+        delay = (self.setting('latency') + abs(random.gauss(0, self.setting('jitter'))) +
+                 num_bytes / self.setting('read_rate'))
+        if random.random() < self.setting('hang_rate'):
+            delay += self.setting('hang_time')
+        time.sleep(delay)
+        if random.random() < self.setting('fail_rate'):
+            raise RuntimeError("%s: request timed out"%self.host)
 
 
 class FpgaClient(object):
     def __init__(self, fpga, katcp_port=714, timeout=10):
-        
-        self.fpga       = fpga 
+
+        self.fpga       = fpga
         self.host       = fpga
-        self.katcp_port = katcp_port 
+        self.katcp_port = katcp_port
         self.timeout    = timeout
-        self.registers  = {
-            'sys_clk' : 200e6, 
-            'sys_scratchpad' : 'test'
-        }
-        
-        self.brams      = {}
-        
-        # HIPSR design specific register values
-        self.acc_regs =  {
-            'acc_cnt': 0, 
-            'o_acc_cnt': 0, 
-            'acc_counter' : 0 
-            }
-
-        self.data_brams = {
-            'snap_xx0_bram': self.random_bandpass()[::2],
-            'snap_xx1_bram': self.random_bandpass()[1::2],
-            'snap_yy0_bram': self.random_bandpass()[::2],
-            'snap_yy1_bram': self.random_bandpass()[1::2]
-        }
-        
+        self.board      = getBoard(fpga)
+        self.registers  = self.board.registers
+        self.brams      = self.board.brams
+
+        # HIPSR design specific registers, which follow the accumulation clock
+        self.acc_regs   = ('acc_cnt', 'o_acc_cnt', 'acc_counter')
+
     def progdev(self, boffile):
+        self.board.request()
         self.boffile = boffile
+        self.board.program(boffile)
         return "ok"
-    
+
     def is_connected(self):
-        return True
-    
+        return self.board.isConnected()
+
     def listdev(self):
+        self.board.request()
         return self.registers.keys()
-    
+
     def write_int(self, reg_id, value, blindwrite=True):
-        self.registers[reg_id] = value
+        self.board.request()
+        self.board.writeRegister(reg_id, value)
         return  "ok"
-    
+
     def read_int(self, reg_id, blindwrite=True):
-        try:
-            if self.acc_regs.has_key(reg_id):
-                self.acc_regs[reg_id] += 1
-                if reg_id == 'o_acc_cnt':
-                    pass
-                    #print "%s: reading acc %i"%(self.host, self.acc_regs[reg_id])
-                time.sleep(0.5)
-
-                return self.acc_regs[reg_id]
-            elif self.registers.has_key(reg_id):
-                return self.registers[reg_id]
-            else:
-                return 0
-        except:
-            raise
-    
+        self.board.request()
+        if reg_id in self.acc_regs:
+            return self.board.accCount()
+        return self.registers.get(reg_id, 0)
+
     def read(self, bram_id, num_bytes):
-        try:
-            if self.data_brams.has_key(bram_id):
-                fmt = '>%iL'%(num_bytes/4)
-                data = self.random_bandpass()[::2]
-                packed = struct.pack(fmt, *data)
-                return packed
-            elif self.brams.has_key(bram_id):
-                data = self.brams[bram_id]
-                return data
-            else:
-                fmt    = '%iB'%num_bytes
-                data   = np.random.random_integers(0, 255, num_bytes).tolist()
-                packed = struct.pack(fmt, *data)
-                return packed
-        except:
-            raise
+        self.board.request(num_bytes)
+        if bram_id in self.brams:
+            return self.brams[bram_id]
+
+        # Different spectra for each board, polarisation and accumulation
+        idx = self.board.accCount() + 3 * self.board.index
+        if bram_id.startswith('snap_') and bram_id.endswith('_bram') and bram_id[-6].isdigit():
+            if bram_id.startswith('snap_yy'):
+                idx += 1
+            bank = getBramBank(num_bytes / 4, int(bram_id[-6]))
+        else:
+            bank = getNoiseBank(num_bytes)
+        return bank[idx % len(bank)]
 
     def write(self, bram_id, packed):
+        self.board.request(len(packed))
         self.brams[bram_id] = packed
         return "ok"
-    
-    def random_bandpass(self):
+
+    def random_bandpass(self, n_chans=8192):
         """ Generate a fake bandpass with some noise on it """
-        lo = np.ones([1024]) * 1e2
-        hi = np.ones([8192-2048]) * 1e5
-        bp = np.append(np.append(lo, hi), lo) 
-        noise = np.random.random_integers(0, 100, 8192)
-        spike = 1e6 * np.random.random()
-        spike_bin = np.random.random_integers(1024, 6976)
-        bp[spike_bin-2:spike_bin+2] += spike
-    
-        return bp + noise
+        return makeBank(n_chans, 1)[0]
 
     def stop(self):
         """ Fake stop """
-        return True
\ No newline at end of file
+        return True
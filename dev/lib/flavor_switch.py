@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+flavor_switch.py
+================
+
+Programs and configures the ROACH boards for a firmware flavor.
+
+All boards are programmed at the same time, with at most max_parallel boards
+being programmed at once. Rather than sleeping for a fixed time after progdev,
+each board is polled until its registers show up, so a flavor change takes as
+long as the slowest board actually needs. Progress and timing are reported per
+board.
+
+When switching from a known flavor, the change is planned first: if the firmware
+is unchanged, boards that are still programmed are not reprogrammed, and only
+the registers whose values differ are written before the master_reset cycle.
+"""
+
+import time, threading
+import hipsr_core.config as config
+
+
+def planReconfigure(current_flavor, flavor):
+    """ Plan the change from current_flavor to flavor.
+
+    Returns a dictionary with 'progdev' (True if the firmware must be loaded) and
+    'registers' (the register values to write). current_flavor may be None if the
+    state of the boards is not known.
+    """
+    target = config.fpga_config[flavor]
+    registers = dict([(key, val) for key, val in target.items() if key != "firmware"])
+    if current_flavor is None or current_flavor not in config.fpga_config:
+        return {'progdev': True, 'registers': registers}
+
+    current = config.fpga_config[current_flavor]
+    if current["firmware"] != target["firmware"]:
+        return {'progdev': True, 'registers': registers}
+
+    changed = dict([(key, val) for key, val in registers.items()
+                    if key not in current or current[key] != val])
+    return {'progdev': False, 'registers': changed}
+
+
+class FlavorSwitcher(object):
+    """ Programs and configures ROACH boards in parallel """
+    def __init__(self, printQueue, max_parallel=4, connect_timeout=10.0, ready_timeout=20.0, poll=0.05):
+        self.printQueue      = printQueue
+        self.max_parallel    = max(int(max_parallel), 1)
+        self.connect_timeout = connect_timeout
+        self.ready_timeout   = ready_timeout
+        self.poll            = poll
+        # System registers listed by any programmed design. The flavor's own registers are checked too.
+        self.ready_registers = getattr(config, 'fpga_ready_registers', ['sys_clkcounter'])
+
+    def mprint(self, msg):
+        """ Send a message to the multiprocessing print queue """
+        self.printQueue.put(msg)
+
+    def waitConnected(self, fpga):
+        """ Wait until a board's KATCP connection is up. Returns True if connected. """
+        t_stop = time.time() + self.connect_timeout
+        while not fpga.is_connected():
+            if time.time() > t_stop:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def isReady(self, fpga, flavor=None):
+        """ Return True if a board is programmed: its system registers, and the registers
+        of flavor if given, are listed """
+        registers = fpga.listdev()
+        if len(registers) == 0:
+            return False
+        required = list(self.ready_registers)
+        if flavor is not None:
+            required += [key for key in config.fpga_config[flavor].keys() if key != "firmware"]
+        for reg_id in required:
+            if reg_id not in registers:
+                return False
+        return True
+
+    def waitReady(self, fpga, flavor=None):
+        """ Poll a board until it is programmed. Returns True if ready within ready_timeout. """
+        t_stop = time.time() + self.ready_timeout
+        while not self.isReady(fpga, flavor):
+            if time.time() > t_stop:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def writeRegisters(self, fpga, registers):
+        """ Write a dictionary of register values, then cycle master_reset """
+        for key in sorted(registers.keys()):
+            fpga.write_int(key, registers[key])
+        fpga.write_int('master_reset', 0)
+        fpga.write_int('master_reset', 1)
+
+    def programBoard(self, fpga, flavor, plan=None):
+        """ Program and configure one board for flavor, following plan if given.
+
+        A board that is not programmed is always programmed and fully configured.
+        Returns a dictionary of timings (s) for each step. Raises RuntimeError if
+        the board cannot be programmed.
+        """
+        fpga_config = config.fpga_config[flavor]
+        if plan is None:
+            plan = planReconfigure(None, flavor)
+        timing = {}
+
+        t0 = time.time()
+        if not self.waitConnected(fpga):
+            raise RuntimeError("%s is not connected"%fpga.host)
+        timing['connect'] = time.time() - t0
+
+        t0 = time.time()
+        registers = plan['registers']
+        if plan['progdev'] or not self.isReady(fpga, flavor):
+            if not plan['progdev']:
+                self.mprint("flavor_switch: %s is not programmed, programming"%fpga.host)
+                registers = planReconfigure(None, flavor)['registers']
+            fpga.progdev(fpga_config["firmware"])
+            if not self.waitReady(fpga, flavor):
+                self.mprint("flavor_switch: %s doesn't appear to be programmed, reprogramming"%fpga.host)
+                fpga.progdev(fpga_config["firmware"])
+                if not self.waitReady(fpga, flavor):
+                    raise RuntimeError("%s did not program with %s"%(fpga.host, fpga_config["firmware"]))
+        timing['program'] = time.time() - t0
+
+        t0 = time.time()
+        if registers:
+            self.writeRegisters(fpga, registers)
+        timing['registers'] = time.time() - t0
+        return timing
+
+    def switchBoard(self, fpga, flavor, plan, limit, results):
+        """ Program one board once a programming slot is free, storing the result """
+        with limit:
+            t0 = time.time()
+            try:
+                timing = self.programBoard(fpga, flavor, plan)
+                timing['total'] = time.time() - t0
+                results[fpga.host] = timing
+                self.mprint("flavor_switch: %s ready in %2.2f s (%s)"%(fpga.host, timing['total'],
+                            ", ".join(["%s %2.2f s"%(key, timing[key]) for key in ('connect', 'program', 'registers')])))
+            except Exception as e:
+                results[fpga.host] = None
+                self.mprint("flavor_switch: ERROR: %s failed after %2.2f s: %s"%(fpga.host, time.time() - t0, e))
+
+    def switch(self, fpgalist, flavor, current_flavor=None):
+        """ Program and configure a list of boards for flavor, in parallel.
+
+        current_flavor is the flavor the boards are running, or None if not known.
+        Returns a dictionary of per-board timings, keyed by host; failed boards
+        have a value of None.
+        """
+        plan = planReconfigure(current_flavor, flavor)
+        if plan['progdev']:
+            self.mprint("flavor_switch: programming %i boards with %s (%s), %i at a time"%
+                        (len(fpgalist), flavor, config.fpga_config[flavor]["firmware"], self.max_parallel))
+        elif plan['registers']:
+            self.mprint("flavor_switch: %s to %s uses the same firmware, writing %s"%
+                        (current_flavor, flavor, ", ".join(sorted(plan['registers'].keys()))))
+        else:
+            self.mprint("flavor_switch: %s to %s uses the same firmware and registers"%(current_flavor, flavor))
+        t0      = time.time()
+        limit   = threading.BoundedSemaphore(self.max_parallel)
+        results = {}
+        threads = [threading.Thread(target=self.switchBoard, args=(fpga, flavor, plan, limit, results))
+                   for fpga in fpgalist]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+        done = [host for host in results if results[host] is not None]
+        if done:
+            slowest = max(done, key=lambda host: results[host]['total'])
+            self.mprint("flavor_switch: %i/%i boards ready in %2.2f s, slowest %s (%2.2f s)"%
+                        (len(done), len(fpgalist), time.time() - t0, slowest, results[slowest]['total']))
+        else:
+            self.mprint("flavor_switch: ERROR: no boards programmed")
+        return results
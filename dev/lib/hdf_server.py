@@ -8,13 +8,357 @@ HDF Server class for hipsr.
 """
 
 import time, sys, os, socket, random, select, re
+import Queue, threading, json
+import numpy as np
+import tables
 import hipsr_core.config as config
 from   hipsr_core.hipsr6 import createMultiBeam
 import mpserver
+from acc_trace import STAGES
+
+# Default flush limits. Per-flavor overrides can be set in hipsr_core.config as
+# hdf_flush_policies = {'hipsr_400_8192': {'max_rows': 128}, ...}
+DEFAULT_FLUSH_POLICY = {
+    'max_rows'  : 64,            # Rows appended since last flush
+    'max_bytes' : 8 * 2**20,     # Bytes appended since last flush
+    'max_age'   : 2.0            # Seconds since the first unflushed row
+}
+
+# Default storage profile of the raw_data tables. Per-flavor overrides can be set in
+# hipsr_core.config as hdf_storage_profiles = {'hipsr_200_16384': {'complib': 'blosc:lz4'}, ...}
+DEFAULT_STORAGE_PROFILE = {
+    'complib'       : None,      # None (uncompressed), 'blosc', 'blosc:lz4', 'blosc:zstd', 'zlib', 'lzo' ...
+    'complevel'     : 5,         # 0 - 9, used if complib is set
+    'shuffle'       : True,      # Byte shuffle before compression
+    'chunk_rows'    : None,      # Rows per chunk, or None to let PyTables choose from expected_rows
+    'expected_rows' : 10000      # Rows per beam in a file, raised to dwell_time / acc_len if longer
+}
+
+# Default rollover limits: the writer moves on to the next file of the output set once
+# one is reached. 0 disables a limit. Can be set in hipsr_core.config as
+# hdf_rollover = {'max_bytes': 2 * 2**30, ...}, and overridden by hipsr-server options.
+DEFAULT_ROLLOVER = {
+    'max_bytes' : 0,             # File size
+    'max_rows'  : 0,             # raw_data rows, all beams
+    'max_age'   : 0              # Seconds since the file was created
+}
+
+def makeFilters(profile):
+    """ Return the tables.Filters of a storage profile """
+    if not profile['complib'] or not profile['complevel']:
+        return tables.Filters(complevel=0)
+    return tables.Filters(complevel=int(profile['complevel']), complib=profile['complib'],
+                          shuffle=bool(profile['shuffle']))
+
+def applyStorageProfile(h5file, profile, expected_rows=None):
+    """ Recreate the empty raw_data tables of a file with the filters and chunk shape of a storage profile.
+
+    The profile, and the chunk rows and expected rows used, are written to the /raw_data
+    attributes. Returns the expected rows used.
+    """
+    if expected_rows is None:
+        expected_rows = profile['expected_rows']
+    filters    = makeFilters(profile)
+    chunkshape = (int(profile['chunk_rows']),) if profile['chunk_rows'] else None
+    group      = h5file.root.raw_data
+    for table in h5file.listNodes(group, 'Table'):
+        if table.nrows:
+            raise ValueError("%s has data: can't change its storage"%table._v_pathname)
+        name, title, description = table.name, table.title, table.description
+        attrs = dict([(key, table._v_attrs[key]) for key in table._v_attrs._v_attrnamesuser])
+        table._f_remove()
+        table = h5file.createTable(group, name, description, title, filters=filters,
+                                   expectedrows=expected_rows, chunkshape=chunkshape)
+        for key, val in attrs.items():
+            table._v_attrs[key] = val
+        chunkshape = table.chunkshape
+
+    group._v_attrs.storage_profile = str(profile.get('name', ''))
+    group._v_attrs.complib         = str(filters.complib if filters.complevel else 'none')
+    group._v_attrs.complevel       = filters.complevel
+    group._v_attrs.shuffle         = filters.shuffle
+    group._v_attrs.chunk_rows      = chunkshape[0] if chunkshape else 0
+    group._v_attrs.expected_rows   = expected_rows
+    return expected_rows
+
+def expectedRows(observation, profile):
+    """ Return rows per beam expected from an observation's dwell_time / acc_len, or None if not known """
+    try:
+        rows = float(observation['dwell_time']) / float(observation['acc_len'])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+    return max(int(rows), profile['expected_rows'])
+
+class FlushPolicy(object):
+    """ Decides when rows appended to the HDF file are flushed to disk.
+
+    Rows are flushed in blocks once the number of rows, number of bytes or the age
+    of the oldest unflushed row reaches its limit. Flush counts and latencies are
+    kept so the limits can be tuned.
+    """
+    def __init__(self, max_rows=64, max_bytes=8 * 2**20, max_age=2.0):
+        self.max_rows     = max_rows
+        self.max_bytes    = max_bytes
+        self.max_age      = max_age
+        self.pending_rows  = 0
+        self.pending_bytes = 0
+        self.t_first       = None
+        self.resetStats()
+
+    def resetStats(self):
+        """ Reset flush counters """
+        self.n_flushes     = 0
+        self.n_rows        = 0
+        self.t_flush_total = 0.0
+        self.t_flush_max   = 0.0
+
+    def added(self, n_rows, n_bytes):
+        """ Record rows appended to a table """
+        if self.t_first is None:
+            self.t_first = time.time()
+        self.pending_rows  += n_rows
+        self.pending_bytes += n_bytes
+
+    def isPending(self):
+        """ Return True if there are unflushed rows """
+        return self.pending_rows > 0
+
+    def timeUntilDue(self):
+        """ Return seconds until pending rows reach max_age, or None if nothing is pending """
+        if not self.pending_rows:
+            return None
+        return self.t_first + self.max_age - time.time()
+
+    def isDue(self):
+        """ Return True if the pending rows should be flushed now """
+        if not self.pending_rows:
+            return False
+        return (self.pending_rows >= self.max_rows or
+                self.pending_bytes >= self.max_bytes or
+                time.time() - self.t_first >= self.max_age)
+
+    def flushed(self, latency):
+        """ Record a completed flush """
+        self.n_flushes     += 1
+        self.n_rows        += self.pending_rows
+        self.t_flush_total += latency
+        self.t_flush_max    = max(self.t_flush_max, latency)
+        self.pending_rows   = 0
+        self.pending_bytes  = 0
+        self.t_first        = None
+
+    def getStats(self):
+        """ Return flush statistics as a dictionary """
+        if self.n_flushes:
+            t_mean = self.t_flush_total / self.n_flushes
+            rows_per_flush = float(self.n_rows) / self.n_flushes
+        else:
+            t_mean, rows_per_flush = 0, 0
+        return {
+            'flushes'        : self.n_flushes,
+            'rows'           : self.n_rows,
+            'rows_per_flush' : "%2.1f"%rows_per_flush,
+            'flush_ms_mean'  : "%2.2f"%(t_mean * 1e3),
+            'flush_ms_max'   : "%2.2f"%(self.t_flush_max * 1e3)
+        }
+
+
+class RowBuffer(object):
+    """ Collects rows for one table in a numpy structured array.
+
+    Rows are filled field by field in a preallocated array matching the table's
+    description, and added to the table with a single Table.append call when the
+    buffer is full or committed. Unset fields take the column defaults, as they
+    would with Table.row. If a lock is given, it is held while appending to the table.
+    """
+    def __init__(self, table, n_rows=64, lock=None):
+        self.table    = table
+        self.lock     = lock
+        self.dtype    = table.description._v_dtype
+        self.defaults = np.zeros(1, dtype=self.dtype)
+        for key, dflt in table.description._v_dflts.items():
+            try:
+                self.defaults[key] = dflt
+            except (ValueError, KeyError):
+                pass
+        self.rows     = np.repeat(self.defaults, max(n_rows, 1))
+        self.n_rows   = 0
+        self.n_fields = len(self.dtype.names)
+
+    def add(self, data, lower_keys=False):
+        """ Add a row from a dictionary of column values """
+        idx = self.n_rows
+        if len(data) < self.n_fields:
+            self.rows[idx] = self.defaults[0]
+        for key, val in data.items():
+            if lower_keys:
+                key = key.lower()
+            self.rows[key][idx] = val
+        self.n_rows += 1
+        if self.n_rows == len(self.rows):
+            self.commit()
+
+    def addRecords(self, records):
+        """ Add rows from a numpy structured array with matching field names """
+        records = np.atleast_1d(records)
+        for name in records.dtype.names:
+            if name not in self.dtype.names:
+                raise KeyError("no column named %s in %s"%(name, self.table._v_pathname))
+
+        if self.n_rows + len(records) > len(self.rows):
+            self.commit()
+        if len(records) > len(self.rows):
+            block = np.repeat(self.defaults, len(records))
+            for name in records.dtype.names:
+                block[name] = records[name]
+            self.append(block)
+            return
+
+        block = self.rows[self.n_rows:self.n_rows + len(records)]
+        if len(records.dtype.names) < self.n_fields:
+            block[:] = self.defaults[0]
+        for name in records.dtype.names:
+            block[name] = records[name]
+        self.n_rows += len(records)
+        if self.n_rows == len(self.rows):
+            self.commit()
+
+    def append(self, rows):
+        if self.lock is None:
+            self.table.append(rows)
+        else:
+            with self.lock:
+                self.table.append(rows)
+
+    def commit(self):
+        """ Append buffered rows to the table """
+        if self.n_rows:
+            self.append(self.rows[:self.n_rows])
+            self.n_rows = 0
+
+
+class MissingData(tables.IsDescription):
+    """ Row description of the /missing_data table: beams with no data for an accumulation """
+    beam_id   = tables.StringCol(16, pos=0)
+    acc       = tables.Int64Col(pos=1)
+    timestamp = tables.Float64Col(pos=2)
+
+
+# Row description of the optional /trace table: stage timestamps of each beam's data
+TRACE_DESCRIPTION = dict([('acc', tables.Int64Col(pos=0)), ('beam_id', tables.StringCol(16, pos=1))] +
+                         [(stage, tables.Float64Col(dflt=np.nan, pos=i + 2)) for i, stage in enumerate(STAGES)])
+
+
+class FileCloser(threading.Thread):
+    """ Flushes and closes finished HDF files in the background, so the writer can go on to the next file.
+
+    The HDF5 library is not thread safe, so the closer holds the lock while it works, and
+    the writer holds the same lock for its own HDF5 calls.
+    """
+    def __init__(self, lock, mprint):
+        threading.Thread.__init__(self)
+        self.daemon      = True
+        self.lock        = lock
+        self.mprint      = mprint
+        self.files       = Queue.Queue()
+        self.count_lock  = threading.Lock()
+        self.pending     = set()
+        self.n_pending   = 0
+
+    def close(self, h5file, on_closed=None):
+        """ Queue a file to be flushed and closed. on_closed(filename) is called, holding lock, once it is. """
+        with self.count_lock:
+            self.n_pending += 1
+            self.pending.add(os.path.abspath(h5file.filename))
+        self.files.put((h5file, on_closed))
+
+    def isPending(self, filename):
+        """ Return True if a file is waiting to be closed """
+        with self.count_lock:
+            return os.path.abspath(filename) in self.pending
+
+    def wait(self):
+        """ Wait until every queued file has been closed """
+        self.files.join()
+
+    def run(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                self.files.task_done()
+                return
+            h5file, on_closed = item
+            filename = h5file.filename
+            t0 = time.time()
+            with self.lock:
+                try:
+                    h5file.flush()
+                    h5file.close()
+                    if on_closed is not None:
+                        on_closed(filename)
+                except Exception as e:
+                    self.mprint("hdf_server: ERROR: closing %s failed: %s"%(filename, e))
+            t_close = time.time() - t0
+            with self.count_lock:
+                self.pending.discard(os.path.abspath(filename))
+                self.n_pending -= 1
+            self.mprint("hdf_server: closed %s in %2.2f s"%(filename, t_close))
+            self.files.task_done()
+
+    def stop(self):
+        """ Close the queued files and stop """
+        self.files.put(None)
+        self.join()
+
+
+class Manifest(object):
+    """ The list of files in an output set, and the time range of the data in each, saved as JSON """
+    def __init__(self, path, name):
+        self.path  = path
+        self.name  = name
+        self.files = []
+
+    def addFile(self, filename):
+        """ Start an entry for a new file of the set """
+        self.files.append({
+            'filename' : os.path.basename(filename),
+            'created'  : time.time(),
+            'closed'   : None,
+            't_first'  : None,
+            't_last'   : None,
+            'rows'     : 0,
+            'bytes'    : None
+        })
+        self.save()
+
+    def getFile(self, filename):
+        for entry in self.files:
+            if entry['filename'] == os.path.basename(filename):
+                return entry
+
+    def update(self, filename, **kwargs):
+        """ Update the entry of a file, and save the manifest """
+        entry = self.getFile(filename)
+        if entry is not None:
+            entry.update(kwargs)
+            self.save()
+
+    def closed(self, filename):
+        """ Note that a file has been closed """
+        self.update(filename, closed=time.time(), bytes=os.path.getsize(filename))
+
+    def save(self):
+        """ Write the manifest, replacing the old one in a single step """
+        filename = os.path.join(self.path, "%s.manifest.json"%self.name)
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump({'name': self.name, 'files': self.files}, fh, indent=2, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
 
 class HdfServer(mpserver.MpServer):
     """ HDF5 Writer thread """
-    def __init__(self, dir_path, mainQueue, printQueue, hdfQueue, tcsQueue, flavor=None):
+    def __init__(self, dir_path, mainQueue, printQueue, hdfQueue, tcsQueue, flavor=None, spectrumRing=None,
+                 trace_table=False, rollover=None):
         self.name = 'hdf_server'
         self.project_id       = 'PXXX'
         self.dir_path         = dir_path
@@ -30,13 +374,46 @@ class HdfServer(mpserver.MpServer):
         self.tbWeather        = None
         self.tbFirmwareConfig = None
         self.tbScanPointing   = None
+        self.tbMissingData    = None
+        self.tbTrace          = None
+        self.trace_table      = trace_table
+        self.pendingTraces    = []
         self.new_file_each_obs= False 
+        self.spectrumRing     = spectrumRing
+        self.tbBeams          = {}
+        self.rowBuffers       = {}
         self.debug = False
+        self.stats_interval   = 60
+        self.t_stats          = time.time()
+        self.rows_written     = 0
+        self.bytes_written    = 0
+        self.expected_rows    = None
+
+        # Output set: the file created by create_new_file, and the files it rolled over to
+        self.rollover         = dict(DEFAULT_ROLLOVER)
+        self.rollover.update(getattr(config, 'hdf_rollover', {}))
+        self.rollover.update(rollover or {})
+        self.set_dir          = None
+        self.manifest         = None
+        self.headers          = {}      # Last observation and pointing rows, for the rolled files
+        self.accBeams         = set()   # Beams written since the current accumulation started
+        self.file_rows        = 0
+        self.t_file           = None
+        self.t_first          = None
+        self.t_last           = None
+        self.n_rolled         = 0
+        self.discarded        = 0       # Raw data messages received while writing is disabled
+        self.t_publish        = 0
+        self.draining         = False   # Shutdown sentinel seen: write what is still queued, then exit
+        self.hdfLock          = threading.RLock()
+        self.closer           = None
 
         if flavor is None:
             self.flavor = 'hipsr_400_8192'
         else:
             self.flavor = flavor
+        self.flushPolicy = FlushPolicy(**self.getFlushPolicy(self.flavor))
+        self.storageProfile = self.getStorageProfile(self.flavor)
 
         super(HdfServer, self).__init__(self.name, printQueue, mainQueue)
     
@@ -48,14 +425,135 @@ class HdfServer(mpserver.MpServer):
         else:
             self.mprint("HDF Thread: Write disabled.")
         
+    def getFlushPolicy(self, flavor):
+        """ Return flush policy limits for a flavor """
+        policy = dict(DEFAULT_FLUSH_POLICY)
+        flavor_policies = getattr(config, 'hdf_flush_policies', {})
+        policy.update(flavor_policies.get(flavor, {}))
+        return policy
+
+    def getStorageProfile(self, flavor):
+        """ Return the raw_data storage profile for a flavor """
+        profile = dict(DEFAULT_STORAGE_PROFILE)
+        flavor_profiles = getattr(config, 'hdf_storage_profiles', {})
+        profile.update(flavor_profiles.get(flavor, {}))
+        profile['name'] = flavor if flavor in flavor_profiles else 'default'
+        return profile
+
+    def applyStorageProfile(self, expected_rows=None):
+        """ Set the storage of the new file's raw_data tables """
+        with self.hdfLock:
+            try:
+                self.expected_rows = applyStorageProfile(self.hdf_file, self.storageProfile, expected_rows)
+            except ValueError as e:
+                self.mprint("hdf_server: WARNING: storage profile %s not applied: %s"%(self.storageProfile['name'], e))
+                return
+            attrs = self.hdf_file.root.raw_data._v_attrs
+            msg = "Storage: %s (%s level %i), %i rows per chunk, %i expected rows"%(attrs.storage_profile,
+                  attrs.complib, attrs.complevel, attrs.chunk_rows, attrs.expected_rows)
+        self.tbBeams = {}
+        self.mprint(msg)
+
+    def getRowBuffer(self, table):
+        """ Return the row buffer for a table, creating it if needed """
+        try:
+            return self.rowBuffers[table._v_pathname]
+        except KeyError:
+            rowBuffer = RowBuffer(table, self.flushPolicy.max_rows, self.hdfLock)
+            self.rowBuffers[table._v_pathname] = rowBuffer
+            return rowBuffer
+
+    def getBeamTable(self, beam_id):
+        """ Return the raw_data table for a beam """
+        try:
+            return self.tbBeams[beam_id]
+        except KeyError:
+            with self.hdfLock:
+                beam = self.hdf_file.getNode('/raw_data', beam_id)
+            self.tbBeams[beam_id] = beam
+            return beam
+
+    def appendRow(self, table, data, lower_keys=False):
+        """ Buffer a row for a table from a dictionary of column values """
+        self.getRowBuffer(table).add(data, lower_keys)
+        self.rowsAdded(table)
+
+    def appendRecords(self, table, records):
+        """ Buffer rows for a table from a numpy structured array """
+        records = np.atleast_1d(records)
+        self.getRowBuffer(table).addRecords(records)
+        self.rowsAdded(table, len(records))
+
+    def rowsAdded(self, table, n_rows=1):
+        """ Record rows appended to a table, and flush if the flush policy says so """
+        self.flushPolicy.added(n_rows, n_rows * table.rowsize)
+        if self.flushPolicy.isDue():
+            self.flushFile()
+
+    def flushFile(self, sync=True):
+        """ Flush all pending rows to disk. If sync is False, the rows are only appended to
+        the tables, and the file is left for the closer to flush. """
+        with self.hdfLock:
+            t0 = time.time()
+            for rowBuffer in self.rowBuffers.values():
+                rowBuffer.commit()
+            if sync:
+                self.hdf_file.flush()
+            self.rows_written  += self.flushPolicy.pending_rows
+            self.bytes_written += self.flushPolicy.pending_bytes
+            self.flushPolicy.flushed(time.time() - t0)
+            self.finishTraces(time.time())
+        self.publishWriterStats()
+
+    def publishWriterStats(self):
+        """ Send the writer's counters to the main process """
+        self.publishStats({'rows_written': self.rows_written, 'bytes_written': self.bytes_written,
+                           'files_rolled': self.n_rolled, 'raw_data_discarded': self.discarded,
+                           'files_closing': self.closer.n_pending if self.closer is not None else 0})
+        self.t_publish = time.time()
+
+    def addTrace(self, trace):
+        """ Hold the trace of written data until it has been flushed """
+        trace['hdf_append'] = time.time()
+        self.pendingTraces.append(trace)
+
+    def finishTraces(self, t_flush):
+        """ Send the traces of flushed data to the main process, and to the trace table if enabled """
+        if not self.pendingTraces:
+            return
+        if self.trace_table and self.tbTrace is None:
+            if 'trace' in self.hdf_file.root:
+                self.tbTrace = self.hdf_file.root.trace
+            else:
+                self.tbTrace = self.hdf_file.createTable('/', 'trace', TRACE_DESCRIPTION,
+                                                         "Pipeline stage timestamps of each beam's data")
+        for trace in self.pendingTraces:
+            trace['hdf_flush'] = t_flush
+            self.mainQueue.put({'trace': trace})
+            if self.tbTrace is not None:
+                self.getRowBuffer(self.tbTrace).add(dict([(key, val) for key, val in trace.items() if val is not None]))
+        if self.tbTrace is not None:
+            self.getRowBuffer(self.tbTrace).commit()
+        self.pendingTraces = []
+
+    def reportFlushStats(self):
+        """ Report flush statistics for the current flavor """
+        stats = self.flushPolicy.getStats()
+        stats['flavor'] = self.flavor
+        self.reportStats(stats)
+        self.flushPolicy.resetStats()
+        self.t_stats = time.time()
+
     def createNewFile(self, tcs_filename=None):
-        """ Closes current file and creates a new one"""
+        """ Hands the current file to the closer, and starts a new output set """
         #print "HERE2: %s"%tcs_filename
+        oldFile = None
         if self.hdf_is_open:
             self.hdf_write_enable = False
             self.hdf_is_open      = False
             self.mprint("closing %s"%self.hdf_file.filename)
-            self.hdf_file.close()
+            oldFile, oldManifest = self.finishFile(), self.manifest
+            self.reportFlushStats()
 
         try:
             timestamp = time.time()
@@ -76,14 +574,33 @@ class HdfServer(mpserver.MpServer):
 
             if tcs_filename: filename = tcs_filename
             else:            filename = '%s.h5'%filestamp
-            self.mprint("Creating file %s"%filename)
-            self.mprint("Flavor: %s"%self.flavor)
-            self.hdf_file = createMultiBeam(filename, os.path.join(self.dir_path, dirstamp), flavor=self.flavor)
-            time.sleep(1e-3) # Make sure file has created successfully...
-
-            self.hdf_is_open      = True
-            self.tcsQueue.put({'hdf_is_open': True})
-            self.data             = None
+            self.set_dir = os.path.join(self.dir_path, dirstamp)
+
+            # A file can't be created again until it has been closed
+            path = os.path.join(self.set_dir, filename)
+            if oldFile is not None and os.path.abspath(oldFile.filename) == os.path.abspath(path):
+                self.closeInBackground(oldFile, oldManifest)
+                oldFile = None
+            if self.closer is not None and self.closer.isPending(path):
+                self.closer.wait()
+
+            self.manifest = Manifest(self.set_dir, os.path.splitext(filename)[0])
+            self.headers  = {}
+            self.openFile(filename)
+        finally:
+            if oldFile is not None:
+                self.closeInBackground(oldFile, oldManifest)
+
+    def openFile(self, filename, expected_rows=None):
+        """ Create a file of the current output set, and write its firmware config and the stored headers """
+        self.mprint("Creating file %s"%filename)
+        self.mprint("Flavor: %s"%self.flavor)
+        self.tbBeams, self.rowBuffers, self.tbMissingData, self.tbTrace = {}, {}, None, None
+        with self.hdfLock:
+            self.hdf_file = createMultiBeam(filename, self.set_dir, flavor=self.flavor)
+            self.applyStorageProfile(expected_rows)
+            self.manifest.addFile(filename)
+
             self.tbPointing       = self.hdf_file.root.pointing
             self.tbRawData        = self.hdf_file.root.raw_data
             self.tbObservation    = self.hdf_file.root.observation
@@ -91,73 +608,156 @@ class HdfServer(mpserver.MpServer):
             self.tbFirmwareConfig = self.hdf_file.root.firmware_config
             self.tbScanPointing   = self.hdf_file.root.scan_pointing
 
-            # Write firmware config
-            fpga_config = config.fpga_config[self.flavor]
-            fpga_config["firmware"] = fpga_config["firmware"]
-            self.data = {'firmware_config': fpga_config}
-            self.writeFirmwareConfig()
-            self.data = None
+        self.hdf_is_open      = True
+        self.tcsQueue.put({'hdf_is_open': True})
+        self.accBeams         = set()
+        self.file_rows        = 0
+        self.t_file           = time.time()
+        self.t_first          = None
+        self.t_last           = None
+
+        # Write firmware config
+        fpga_config = config.fpga_config[self.flavor]
+        fpga_config["firmware"] = fpga_config["firmware"]
+        self.appendRow(self.tbFirmwareConfig, fpga_config)
+
+        # Files after the first of a set repeat its header rows
+        if 'observation' in self.headers:
+            self.appendRow(self.tbObservation, self.headers['observation'])
+        if 'pointing' in self.headers:
+            self.appendRow(self.tbPointing, self.headers['pointing'])
+
+    def finishFile(self):
+        """ Write the pending rows of the current file to its tables. Returns the file, for closeInBackground. """
+        self.flushFile(sync=False)
+        with self.hdfLock:
+            self.manifest.update(self.hdf_file.filename, rows=self.file_rows, t_first=self.t_first, t_last=self.t_last)
+        return self.hdf_file
+
+    def closeInBackground(self, h5file, manifest):
+        """ Hand a finished file to the closer thread """
+        if self.closer is None:
+            self.closer = FileCloser(self.hdfLock, self.mprint)
+            self.closer.start()
+        self.closer.close(h5file, manifest.closed)
+
+    def stopCloser(self):
+        """ Wait for the closer to close every file handed to it """
+        if self.closer is not None:
+            self.closer.stop()
+            self.closer = None
+
+    def rolloverDue(self):
+        """ Return why the current file should be rolled over, or None if it shouldn't """
+        if not self.file_rows:
+            return None
+        if self.rollover['max_rows'] and self.file_rows >= self.rollover['max_rows']:
+            return "%i rows"%self.file_rows
+        if self.rollover['max_age'] and time.time() - self.t_file >= self.rollover['max_age']:
+            return "%i s old"%(time.time() - self.t_file)
+        if self.rollover['max_bytes']:
+            n_bytes = os.path.getsize(self.hdf_file.filename) + self.flushPolicy.pending_bytes
+            if n_bytes >= self.rollover['max_bytes']:
+                return "%2.1f MB"%(n_bytes / 2.0**20)
+        return None
+
+    def rollOver(self, reason):
+        """ Go straight on to the next file of the output set, and hand the finished one to the closer """
+        self.mprint("hdf_server: rolling over %s (%s)"%(self.hdf_file.filename, reason))
+        oldFile = self.finishFile()
+        try:
+            self.openFile("%s_%03i.h5"%(self.manifest.name, len(self.manifest.files)), self.expected_rows)
+        finally:
+            self.closeInBackground(oldFile, self.manifest)
+        self.n_rolled += 1
+
+    def startBeamRow(self, beam_id, timestamp):
+        """ Count a raw_data row about to be written. A beam that already has a row since the
+        current accumulation started begins the next one: the file is rolled over then, if due. """
+        if beam_id in self.accBeams:
+            self.accBeams = set()
+            reason = self.rolloverDue()
+            if reason is not None:
+                self.rollOver(reason)
+        self.accBeams.add(beam_id)
+        self.file_rows += 1
+        if self.t_first is None:
+            self.t_first = timestamp
+        self.t_last = timestamp
 
-        except:
-            raise
-    
     def writePointing(self, val=None):
         """ Write pointing row from stored data """
         if self.hdf_is_open and self.data:
-          for key in self.data["pointing"].keys():
-              self.tbPointing.row[key] = self.data["pointing"][key]
-          self.tbPointing.row.append()
-          self.tbPointing.flush()
+            self.headers['pointing'] = self.data["pointing"]
+            self.appendRow(self.tbPointing, self.data["pointing"])
 
     def writeObservation(self, val=None):
         """ Write observation row from stored data """
         if self.hdf_is_open and self.data:
-            for key in self.data["observation"].keys():
-                if key != 'conf_name': 
-                  self.tbObservation.row[key]  = self.data["observation"][key]    
-            self.tbObservation.row.append()
-            self.tbObservation.flush()
+            observation = dict(self.data["observation"])
+            observation.pop('conf_name', None)
+
+            # Size the raw_data tables for the observation, if no data has been written yet
+            expected_rows = expectedRows(observation, self.storageProfile)
+            if expected_rows and expected_rows != self.expected_rows and not self.tbBeams:
+                self.applyStorageProfile(expected_rows)
+            self.headers['observation'] = observation
+            self.appendRow(self.tbObservation, observation)
   
     def writeRawData(self, val=None):
         """ Write raw_data row from stored data """
         if self.hdf_is_open and self.data:
-            timestamp = time.time()
-            for beam_id in self.data["raw_data"].keys():
+            self.appendRawData(self.data["raw_data"])
+
+    def writeRawDataSlot(self, desc):
+        """ Write raw_data row from a shared-memory spectrum ring slot """
+        if self.hdf_is_open:
+            self.appendRawData({desc['beam_id']: self.spectrumRing.get(desc)})
 
-                # Timestamp when data is written
-                # This will likely be overwritten in SD-FITS writer
-                self.data["raw_data"][beam_id]["timestamp"] = timestamp
+    def appendRawData(self, raw_data):
+        """ Append a row to each beam's raw_data table """
+        timestamp = time.time()
+        for beam_id in raw_data.keys():
 
-                beam = self.hdf_file.getNode('/raw_data', beam_id)
-                for key in self.data["raw_data"][beam_id].keys():
-                    beam.row[key]  = self.data["raw_data"][beam_id][key]
-                beam.row.append()
-                beam.flush()
+            # Timestamp when data is written
+            # This will likely be overwritten in SD-FITS writer
+            raw_data[beam_id]["timestamp"] = timestamp
+
+            self.startBeamRow(beam_id, timestamp)
+            self.appendRow(self.getBeamTable(beam_id), raw_data[beam_id])
+
+    def writeMissingData(self, val=None):
+        """ Write a zero-filled raw_data row for a beam with no data, and note it in /missing_data """
+        self.startBeamRow(val['beam_id'], val['timestamp'])
+        if self.tbMissingData is None:
+            with self.hdfLock:
+                if 'missing_data' in self.hdf_file.root:
+                    self.tbMissingData = self.hdf_file.root.missing_data
+                else:
+                    self.tbMissingData = self.hdf_file.createTable('/', 'missing_data', MissingData,
+                                                                   "Beams with no data for an accumulation")
+        self.appendRow(self.getBeamTable(val['beam_id']), {'timestamp': val['timestamp']})
+        self.appendRow(self.tbMissingData, val)
 
     def writeWeather(self, val=None):
         """ Write weather row from stored data """
         if self.hdf_is_open and self.data:
-            for key in self.data["weather"].keys():
-                self.tbWeather.row[key] = self.data["weather"][key]
-            self.tbWeather.row.append()
-            self.tbWeather.flush()
+            self.appendRow(self.tbWeather, self.data["weather"])
       
     def writeFirmwareConfig(self, val=None):
         """ Write firmware_config row from stored data """
         if self.hdf_is_open and self.data:
-            for key in self.data["firmware_config"].keys():
-                self.tbFirmwareConfig.row[key]        = self.data["firmware_config"][key]
-            self.tbFirmwareConfig.row.append()
-            self.tbFirmwareConfig.flush()
+            self.appendRow(self.tbFirmwareConfig, self.data["firmware_config"])
 
     def writeScanPointing(self, val=None):
         """ Write scan_pointing row from stored data """
         if self.hdf_is_open and self.data:
-            for key in self.data["scan_pointing"].keys():
+            scan_pointing = self.data["scan_pointing"]
+            if isinstance(scan_pointing, np.ndarray):
+                self.appendRecords(self.tbScanPointing, scan_pointing)
+            else:
                 # Look out for capitals!
-                self.tbScanPointing.row[key.lower()] = self.data["scan_pointing"][key]
-            self.tbScanPointing.row.append()
-            self.tbScanPointing.flush()
+                self.appendRow(self.tbScanPointing, scan_pointing, lower_keys=True)
 
     def safeExit(self, val=None):
         """ Uh oh. That escalated quickly. """
@@ -168,10 +768,16 @@ class HdfServer(mpserver.MpServer):
                 self.hdf_write_enable = False
                 self.hdf_is_open      = False
                 self.mprint("hdf_server: closing %s"%self.hdf_file.filename)
-                self.hdf_file.flush()
-                self.hdf_file.close()
+                self.finishFile()
+                with self.hdfLock:
+                    self.hdf_file.flush()
+                    self.hdf_file.close()
+                    self.manifest.closed(self.hdf_file.filename)
                 self.tcsQueue.put({'hdf_is_open': False})
                 del(self.hdf_file)
+                self.tbBeams, self.rowBuffers, self.tbMissingData, self.tbTrace = {}, {}, None, None
+                self.reportFlushStats()
+            self.stopCloser()
 
         except:
             self.mprint("hdf_server: ERROR: Safe exit failed")
@@ -182,51 +788,109 @@ class HdfServer(mpserver.MpServer):
         self.hdf_write_enable = False
         self.hdf_is_open      = False
         self.mprint("hdf_server: closing %s"%self.hdf_file.filename)
-        self.hdf_file.flush()
-        self.hdf_file.close()
+        self.closeInBackground(self.finishFile(), self.manifest)
         self.tcsQueue.put({'hdf_is_open': False})
         del(self.hdf_file)
+        self.tbBeams, self.rowBuffers, self.tbMissingData, self.tbTrace = {}, {}, None, None
+        self.reportFlushStats()
 
     def changeFlavor(self, flavor):
         """ Change FPGA config flavor """
+        if self.hdf_is_open and self.flushPolicy.isPending():
+            self.flushFile()
+        self.reportFlushStats()
         self.flavor = flavor
+        self.flushPolicy = FlushPolicy(**self.getFlushPolicy(self.flavor))
+        self.storageProfile = self.getStorageProfile(self.flavor)
         #self.closeFile()
 
+    def getTimeout(self):
+        """ Return seconds to wait for data before a flush or stats report is due """
+        timeout = self.t_stats + self.stats_interval - time.time()
+        t_flush = self.flushPolicy.timeUntilDue()
+        if t_flush is not None:
+            timeout = min(timeout, t_flush)
+        return max(timeout, 1e-3)
+
     def serverMain(self):
         """ Main HDF writer routine """
         self.mprint("HDF server: writing to directory %s..."%self.dir_path)
+
+        validKeys = {
+          'pointing'        : self.writePointing,
+          'raw_data'        : self.writeRawData,
+          'observation'     : self.writeObservation,
+          'weather'         : self.writeWeather,
+          'firmware'        : self.writeFirmwareConfig,
+          'scan_pointing'   : self.writeScanPointing,
+          'missing_data'    : self.writeMissingData,
+          'create_new_file' : self.createNewFile,
+          'write_enable'    : self.setWriteEnable,
+          'close_file'      : self.closeFile
+        }
+
         while self.server_enabled:
             # Note that no data will be written to queue when TCS thread is set to disabled,
             # So no need to check self.hdf_write_enable
-            while not self.hdfQueue.empty():
-
-                self.data = self.hdfQueue.get()
-
-                validKeys = {
-                  'pointing'        : self.writePointing,
-                  'raw_data'        : self.writeRawData,
-                  'observation'     : self.writeObservation,
-                  'weather'         : self.writeWeather,
-                  'firmware'        : self.writeFirmwareConfig,
-                  'scan_pointing'   : self.writeScanPointing,
-                  'create_new_file' : self.createNewFile,
-                  'write_enable'    : self.setWriteEnable,
-                  'close_file'      : self.closeFile
-                }
-
-                for key in self.data.keys():
-                    if key == 'write_enable':
-                        self.mprint("%s: %s"%(key, self.data[key]))
-                        self.setWriteEnable(self.data[key])
-                    elif key == 'create_new_file':
-                        #print "HERE: %s"%self.data
-                        self.createNewFile(self.data[key])
-                    elif key == 'safe_exit':
-                        self.safeExit()
-                    elif key == 'change_flavor':
-                        self.changeFlavor(self.data[key])
-                    elif self.hdf_write_enable and self.hdf_is_open:
-                         validKeys[key](self.data[key])
-                time.sleep(1e-6)
+            # Block until data arrives, or until a flush or stats report is due
+            try:
+                self.data = self.hdfQueue.get(not self.draining, self.getTimeout())
+            except Queue.Empty:
+                if self.draining:
+                    break
+                self.data = {}
+
+            if self.data is None:
+                # Shutdown sentinel. It overtakes the queue, so write the rows and the
+                # safe_exit still queued or spilled behind it first.
+                self.draining = True
+                continue
+            trace = self.data.pop('trace', None)
+            if trace is not None:
+                trace['hdf_dequeue'] = time.time()
+            for key in self.data.keys():
+                if key == 'write_enable':
+                    self.mprint("%s: %s"%(key, self.data[key]))
+                    self.setWriteEnable(self.data[key])
+                elif key == 'create_new_file':
+                    #print "HERE: %s"%self.data
+                    self.createNewFile(self.data[key])
+                elif key == 'safe_exit':
+                    self.safeExit()
+                elif key == 'change_flavor':
+                    self.changeFlavor(self.data[key])
+                elif key == 'raw_data_slot':
+                    # Slots must go back to the ring even if writing is disabled
+                    try:
+                        if self.hdf_write_enable and self.hdf_is_open:
+                            self.writeRawDataSlot(self.data[key])
+                        else:
+                            self.discarded += 1
+                    finally:
+                        self.spectrumRing.release(self.data[key])
+                elif self.hdf_write_enable and self.hdf_is_open:
+                     validKeys[key](self.data[key])
+                elif key in ('raw_data', 'missing_data'):
+                    self.discarded += 1
 
+            if trace is not None:
+                if self.hdf_write_enable and self.hdf_is_open:
+                    self.addTrace(trace)
+                else:
+                    self.mainQueue.put({'trace': trace})
+
+            # Flush rows that have been waiting too long
+            if self.hdf_is_open and self.flushPolicy.isDue():
+                self.flushFile()
+            if time.time() - self.t_publish > 1:
+                self.publishWriterStats()
+            if time.time() - self.t_stats > self.stats_interval:
+                if self.flushPolicy.n_flushes:
+                    self.reportFlushStats()
+                else:
+                    self.t_stats = time.time()
+
+        if self.hdf_is_open:
+            self.safeExit()
+        self.stopCloser()
         self.mprint("hdf_server: exiting.")
\ No newline at end of file
@@ -20,6 +20,10 @@ import hipsr_core.katcp_wrapper as katcp_wrapper
 import hipsr_core.katcp_helpers as katcp_helpers
 from   hipsr_core.katcp_helpers import squashData, squashSpectrum, getSpectrum
 import hipsr_core.config as config
+from plotter_frame import encodeFrame
+from spectrum_json import SpectrumEncoder
+from capture_scheduler import CaptureScheduler, AccTracker
+from flavor_switch import FlavorSwitcher
 
 try:
     import ujson as json
@@ -30,94 +34,357 @@ except:
 
 class KatcpThread(threading.Thread):
     """ Server to control ROACH boards"""
-    def __init__(self, queue, queue_out, queue_plotter):
+    def __init__(self, queue, queue_out, queue_plotter, spectrumRing=None, plot_format='json', scheduler=None,
+                 tracker=None):
         threading.Thread.__init__(self)
         self.queue          = queue
         self.queue_out      = queue_out
         self.queue_plotter  = queue_plotter
+        self.spectrumRing   = spectrumRing
+        self.plot_format    = plot_format
+        self.encoder        = SpectrumEncoder(precision=3)
+        self.scheduler      = scheduler
+        self.tracker        = tracker
         self.server_enabled = True
 
     def toJson(self, npDict):
-        """ Converts a dictionary of numpy arrays into a dictionary of lists."""
-        for key in npDict.keys():
-            for datakey in npDict[key]:
-                try:
-                    npDict[key][datakey] = npDict[key][datakey].tolist()
-                except AttributeError:
-                    pass
-                    #print npDict
-                    #mprint("katcpServer toJSON is acting strange...")
-                    #raise
-
-        if USES_UJSON:
-            return json.dumps(npDict, double_precision=3)
-        else:
-            return json.dumps(npDict)
+        """ Converts a dictionary of numpy arrays into a JSON encoded dictionary of lists."""
+        return self.encoder.encode(npDict)
 
     def run(self):
         """ Thread run method. Fetch data from roach"""
         while self.server_enabled:
             try:
                 # Get input queue info (FPGA object)
-                [fpga, flavor, cmd] = self.queue.get()
+                [fpga, flavor, cmd, acc, t_start, trace] = self.queue.get()
                 beam_id = config.roachlist[fpga.host]
 
-                # Grab data from the FPGA
-                time.sleep(float(beam_id.split("_")[1]) / 26)         # Spread out
-
                 if cmd == 'trigger_capture':
+                    # Wait for this board's planned slot, then grab data from the FPGA
+                    if t_start is not None:
+                        wait = t_start - time.time()
+                        if wait > 0:
+                            time.sleep(wait)
+                    trace = dict(trace, beam_id=beam_id)
+                    trace['read_start'] = time.time()
                     data = getSpectrum(fpga, flavor)
+                    trace['read_end'] = time.time()
+                    if self.scheduler is not None:
+                        self.scheduler.record(beam_id, trace['read_end'] - trace['read_start'], acc)
+                    if self.tracker is not None and not self.tracker.claim(acc, beam_id):
+                        # Missed its deadline: a missing data marker has already been written
+                        continue
                     #data["timestamp"] = self.timestamp
-                    hdfData = {'raw_data': { beam_id : data }}
                     plotData = squashSpectrum(data)
+                    trace['squash'] = time.time()
+
+                    # Pass spectra through shared memory if a slot is free
+                    desc = None
+                    if self.spectrumRing is not None:
+                        desc = self.spectrumRing.put(beam_id, acc, data)
+                    trace['hdf_enqueue'] = time.time()
+                    if desc is not None:
+                        self.queue_out.put({'raw_data_slot': desc, 'trace': trace})
+                    else:
+                        self.queue_out.put({'raw_data': { beam_id : data }, 'trace': trace})
+
+                    timestamp = time.time()
+                    if self.plot_format == 'binary':
+                        for pol in ('xx', 'yy'):
+                            msg = encodeFrame(beam_id, pol, timestamp, plotData[pol])
+                            self.queue_plotter.put(("%s_%s"%(beam_id, pol), timestamp, msg,
+                                                    dict(trace, plot_enqueue=time.time())))
+                    else:
+                        msgdata = {beam_id: {
+                                       'xx': plotData['xx'],
+                                       'yy': plotData['yy'],
+                                       'timestamp': timestamp}
+                                   }
+
+                        msg = self.toJson(msgdata)
+                        self.queue_plotter.put((beam_id, timestamp, msg, dict(trace, plot_enqueue=time.time())))
+
+            except RuntimeError:
+                time.sleep(2)
+                print "Warning, FPGA % (fpga.host, beam_id) not responding"
+
+            finally:
+                # Signal to queue task complete
+                if cmd == 'trigger_capture' and self.tracker is not None:
+                    self.tracker.done(acc, beam_id)
+                self.queue.task_done()
+
 
-                    self.queue_out.put(hdfData)
 
-                    msgdata = {beam_id: {
-                                   'xx': plotData['xx'],
-                                   'yy': plotData['yy'],
-                                   'timestamp': time.time()}
-                               }
 
-                    msg = self.toJson(msgdata)
-                    self.queue_plotter.put(msg)
+class AccWatcher(threading.Thread):
+    """ Watches the accumulation counter and signals new accumulations.
 
-                elif cmd == 'change_flavor':
-                    msg = "\tProgramming %s" % fpga.host
-                    print msg
-                    fpga.progdev(config.fpga_config[flavor]["firmware"])
-                    time.sleep(2)
+    The dump period is learnt from successive changes of o_acc_cnt, and rescaled
+    by the flavor's acc_len when the flavor changes. Once the period is known, the
+    watcher sleeps until just before the next expected dump and then polls quickly
+    until the counter moves, so a new accumulation is reported within one fast
+    poll interval instead of within a fixed polling period.
 
-                    registers = fpga.listdev()
-                    if len(registers) == 0:
-                        print "Warning: %s doesn't appear to be programmed. Attempting to reprogram...." % fpga.host
-                        try:
-                            fpga.progdev(config.fpga_config[flavor]["firmware"])
-                            time.sleep(1)
-                        except:
-                            print "programming timed out. There's probably something up"
+    The counter is read from one board of fpgalist at a time. While that board is
+    usable it is kept; when it drops, the first usable board takes over, so one
+    board being down or recovered does not stop the others being read.
+    """
+    def __init__(self, fpgalist, flavor, mainQueue, printQueue, usable=None,
+                 poll_fast=0.01, poll_learn=0.05, guard=0.05):
+        threading.Thread.__init__(self)
+        self.name        = 'acc_watcher'
+        self.fpgalist    = fpgalist
+        self.usable      = usable or (lambda fpga: fpga.is_connected())
+        self.fpga        = None
+        self.mainQueue   = mainQueue
+        self.printQueue  = printQueue
+        self.poll_fast   = poll_fast     # Poll interval around an expected dump
+        self.poll_learn  = poll_learn    # Poll interval while the period is unknown
+        self.guard       = guard         # Start polling this long before a dump
+        self.acc_len     = self.getAccLen(flavor)
+        self.acc_cnt     = None
+        self.t_dump      = None
+        self.period      = None
+        self.wake        = threading.Event()
+        self.watcher_enabled = True
+
+    def mprint(self, msg):
+        """ Send a message to the multiprocessing print queue """
+        self.printQueue.put(msg)
+
+    def getAccLen(self, flavor):
+        """ Return the acc_len register value for a flavor, or None. """
+        try:
+            return float(config.fpga_config[flavor]["acc_len"])
+        except (KeyError, ValueError, TypeError):
+            return None
 
-                    for key in config.fpga_config[flavor].keys():
-                        if key != "firmware":
-                            fpga.write_int(key, config.fpga_config[flavor][key])
+    def setFlavor(self, flavor):
+        """ Rescale the learnt dump period to a new flavor's acc_len.
 
-                    fpga.write_int('master_reset', 0)
-                    fpga.write_int('master_reset', 1)
+        Changing flavor resets the accumulation counter, so the phase of the
+        next dump is relearnt from scratch.
+        """
+        acc_len = self.getAccLen(flavor)
+        if self.period and acc_len and self.acc_len:
+            self.period = self.period * acc_len / self.acc_len
+        else:
+            self.period = None
+        self.acc_len = acc_len
+        self.acc_cnt = None
+        self.t_dump  = None
+        self.wake.set()
+
+    def nextPoll(self, now):
+        """ Return the number of seconds to wait before polling the counter. """
+        if self.period is None or self.t_dump is None:
+            return self.poll_learn
+        wait = self.t_dump + self.period - self.guard - now
+        return max(wait, self.poll_fast)
+
+    def updatePeriod(self, acc_cnt, now):
+        """ Update the dump period estimate from a counter change. """
+        if self.acc_cnt is not None and self.t_dump is not None:
+            n_dumps = acc_cnt - self.acc_cnt
+            if n_dumps > 0:
+                sample = (now - self.t_dump) / n_dumps
+                if self.period is None:
+                    self.period = sample
+                else:
+                    self.period += 0.25 * (sample - self.period)
+        self.acc_cnt = acc_cnt
+        self.t_dump  = now
+
+    def selectFpga(self):
+        """ Return the board to poll: the current one if still usable, else the first usable one, or None """
+        if self.fpga is not None and self.fpga in self.fpgalist and self.usable(self.fpga):
+            return self.fpga
+        for fpga in self.fpgalist:
+            if self.usable(fpga):
+                return fpga
+        return None
+
+    def stop(self):
+        """ Stop watching. """
+        self.watcher_enabled = False
+        self.wake.set()
 
+    def run(self):
+        """ Thread run method. Poll o_acc_cnt in phase with the dumps. """
+        while self.watcher_enabled:
+            self.wake.wait(self.nextPoll(time.time()))
+            self.wake.clear()
+            if not self.watcher_enabled:
+                break
+            fpga = self.selectFpga()
+            if fpga is None:
+                if self.fpga is not None:
+                    self.mprint("acc_watcher: warning: no connected board to poll.")
+                self.fpga   = None
+                self.t_dump = None
+                self.wake.wait(1)
+                continue
+            if fpga is not self.fpga:
+                if self.fpga is not None:
+                    self.mprint("acc_watcher: %s dropped, polling %s"%(self.fpga.host, fpga.host))
+                # The counters of different boards need not agree: relearn the phase, keep the period
+                self.fpga    = fpga
+                self.acc_cnt = None
+                self.t_dump  = None
+            try:
+                acc_cnt = self.fpga.read_int('o_acc_cnt')
             except RuntimeError:
-                time.sleep(2)
-                print "Warning, FPGA % (fpga.host, beam_id) not responding"
+                self.mprint("acc_watcher: warning: cannot read o_acc_cnt from %s"%self.fpga.host)
+                continue
+            now = time.time()
+
+            if self.acc_cnt is None:
+                # First reading after start or flavor change: just record the phase
+                self.acc_cnt = acc_cnt
+                self.t_dump  = None
+            elif acc_cnt != self.acc_cnt:
+                if acc_cnt < self.acc_cnt:
+                    # Counter was reset, so this interval can't be used for the period
+                    self.acc_cnt = None
+                self.updatePeriod(acc_cnt, now)
+                self.mainQueue.put({'acc_new': acc_cnt, 'acc_time': now})
+
+
+class FpgaSupervisor(threading.Thread):
+    """ Reconnects dropped ROACH boards in the background.
+
+    A board that is found disconnected is taken out of capture. Its FpgaClient
+    is replaced by a new one, retrying with exponential backoff. Once connected,
+    the board is checked against the current flavor's firmware and registers,
+    reprogrammed or reconfigured if needed, and put back into capture from the
+    next accumulation. Only the board being recovered is touched.
+    """
+    def __init__(self, server, katcp_wrapper, poll=1.0, backoff_min=1.0, backoff_max=60.0,
+                 connect_timeout=10.0):
+        threading.Thread.__init__(self)
+        self.name            = 'fpga_supervisor'
+        self.server          = server
+        self.katcp_wrapper   = katcp_wrapper
+        self.poll            = poll
+        self.backoff_min     = backoff_min
+        self.backoff_max     = backoff_max
+        self.connect_timeout = connect_timeout
+        self.recovering      = {}       # beam_id: [backoff, time of next attempt]
+        self.reconnects      = {}       # beam_id: number of successful reconnects
+        self.lock            = threading.Lock()
+        self.wake            = threading.Event()
+        self.supervisor_enabled = True
 
-            finally:
-                # Signal to queue task complete
-                self.queue.task_done()
+    def mprint(self, msg):
+        """ Send a message to the multiprocessing print queue """
+        self.server.mprint(msg)
+
+    def isRecovering(self, beam_id):
+        """ Return True if a board is being reconnected, and should not be read """
+        with self.lock:
+            return beam_id in self.recovering
+
+    def checkConnections(self):
+        """ Take boards that have dropped out of capture """
+        for fpga in self.server.fpgalist:
+            beam_id = config.roachlist[fpga.host]
+            if not fpga.is_connected() and not self.isRecovering(beam_id):
+                self.mprint("fpga_supervisor: %s (%s) dropped, reconnecting"%(fpga.host, beam_id))
+                with self.lock:
+                    self.recovering[beam_id] = [self.backoff_min, time.time()]
+
+    def connect(self, host):
+        """ Return a new connected FpgaClient for host, or None """
+        fpga = self.katcp_wrapper.FpgaClient(host, config.katcp_port, timeout=10)
+        t_stop = time.time() + self.connect_timeout
+        while not fpga.is_connected():
+            if time.time() > t_stop or not self.supervisor_enabled:
+                fpga.stop()
+                return None
+            time.sleep(0.1)
+        return fpga
+
+    def checkFlavor(self, fpga, flavor):
+        """ Make sure a board is programmed and configured for flavor """
+        fpga_config = config.fpga_config[flavor]
+        switcher    = self.server.switcher
+        if not switcher.isReady(fpga, flavor):
+            self.mprint("fpga_supervisor: %s is not programmed, programming %s"%(fpga.host, fpga_config["firmware"]))
+            switcher.programBoard(fpga, flavor)
+            return
+
+        changed = dict([(key, val) for key, val in fpga_config.items()
+                        if key != "firmware" and fpga.read_int(key) != val])
+        if changed:
+            self.mprint("fpga_supervisor: %s writing registers %s"%(fpga.host, ", ".join(sorted(changed.keys()))))
+            switcher.writeRegisters(fpga, changed)
+
+    def recover(self, index, beam_id):
+        """ Try once to reconnect and check a board. Returns True on success. """
+        old = self.server.fpgalist[index]
+        try:
+            old.stop()
+        except:
+            pass
 
+        fpga = self.connect(old.host)
+        if fpga is None:
+            self.mprint("fpga_supervisor: %s (%s) not reachable"%(old.host, beam_id))
+            return False
+        try:
+            self.checkFlavor(fpga, self.server.flavor)
+        except RuntimeError as e:
+            self.mprint("fpga_supervisor: %s (%s) check failed: %s"%(old.host, beam_id, e))
+            fpga.stop()
+            return False
+
+        self.server.replaceFpga(index, fpga)
+        return True
+
+    def recoverDue(self):
+        """ Attempt to recover boards whose backoff has expired """
+        now = time.time()
+        for index, fpga in enumerate(self.server.fpgalist):
+            beam_id = config.roachlist[fpga.host]
+            with self.lock:
+                if beam_id not in self.recovering or self.recovering[beam_id][1] > now:
+                    continue
+                backoff = self.recovering[beam_id][0]
+
+            if self.recover(index, beam_id):
+                with self.lock:
+                    del self.recovering[beam_id]
+                self.reconnects[beam_id] = self.reconnects.get(beam_id, 0) + 1
+                self.mprint("fpga_supervisor: %s (%s) reconnected, back in capture from the next accumulation"%
+                            (fpga.host, beam_id))
+            else:
+                backoff = min(backoff * 2, self.backoff_max)
+                with self.lock:
+                    self.recovering[beam_id] = [backoff, time.time() + backoff]
+                self.mprint("fpga_supervisor: retrying %s in %.1f s"%(beam_id, backoff))
+
+    def stop(self):
+        """ Stop supervising. """
+        self.supervisor_enabled = False
+        self.wake.set()
 
+    def run(self):
+        """ Thread run method. Check connections and recover dropped boards. """
+        while self.supervisor_enabled:
+            self.wake.wait(self.poll)
+            self.wake.clear()
+            if not self.supervisor_enabled:
+                break
+            self.checkConnections()
+            self.recoverDue()
 
 
 class KatcpServer(threading.Thread):
     """ Server to control ROACH boards"""
-    def __init__(self, printQueue, mainQueue, hdfQueue, katcpQueue, plotterQueue, flavor, dummyMode=False):
+    def __init__(self, printQueue, mainQueue, hdfQueue, katcpQueue, plotterQueue, flavor, dummyMode=False,
+                 spectrumRing=None, plot_format='json', max_reads=4, pipelined=True, deadline_frac=0.8,
+                 max_program=4):
         threading.Thread.__init__(self)
         self.name = 'katcp_server'
 
@@ -132,12 +399,26 @@ class KatcpServer(threading.Thread):
         self.hdfQueue         = hdfQueue
         self.katcpQueue       = katcpQueue
         self.flavor           = flavor
+        self.spectrumRing     = spectrumRing
+        self.plot_format      = plot_format
+        self.acc_cnt          = None
+        self.acc_time         = None
+        self.pipelined        = pipelined
+        self.deadline_frac    = deadline_frac      # Capture deadline, as a fraction of the dump period
+        self.scheduler        = CaptureScheduler(max_reads)
+        self.tracker          = AccTracker(self.captureComplete)
+        self.switcher         = FlavorSwitcher(printQueue, max_program)
         self.server_enabled   = True
 
-        # Internal threads
+        # Internal threads. When pipelined, each board's data goes straight to the
+        # HDF and plotter queues as soon as it has been read.
         self.threadQueue          = Queue.Queue()
-        self.threadQueue_out      = Queue.Queue()
-        self.threadQueue_plotter  = Queue.Queue()
+        if self.pipelined:
+            self.threadQueue_out      = self.hdfQueue
+            self.threadQueue_plotter  = self.plotterQueue
+        else:
+            self.threadQueue_out      = Queue.Queue()
+            self.threadQueue_plotter  = Queue.Queue()
 
         self.fpgalist  = [katcp_wrapper.FpgaClient(roach, config.katcp_port, timeout=10) for roach in config.roachlist]
 
@@ -145,51 +426,136 @@ class KatcpServer(threading.Thread):
             self.mprint("%s %s"%(roach, config.katcp_port))
 
         for i in range(len(self.fpgalist)):
-           t = KatcpThread(self.threadQueue, self.threadQueue_out, self.threadQueue_plotter)
+           t = KatcpThread(self.threadQueue, self.threadQueue_out, self.threadQueue_plotter, self.spectrumRing,
+                           self.plot_format, self.scheduler, self.tracker)
            t.setDaemon(True)
            t.start()
 
+        self.accWatcher = AccWatcher(self.fpgalist, self.flavor, self.mainQueue, self.printQueue, self.canPoll)
+        self.accWatcher.setDaemon(True)
+
+        self.supervisor = FpgaSupervisor(self, katcp_wrapper)
+        self.supervisor.setDaemon(True)
+
         #super(KatcpServer, self).__init__(self.name, printQueue, mainQueue)
 
     def mprint(self, msg):
         """ Send a message to the multiprocessing print queue """
         self.printQueue.put(msg)
 
+    def replaceFpga(self, index, fpga):
+        """ Replace the FpgaClient of a board, after it has been reconnected """
+        self.fpgalist[index] = fpga
+
+    def canPoll(self, fpga):
+        """ Return True if the accumulation counter can be read from a board """
+        return fpga.is_connected() and not self.supervisor.isRecovering(config.roachlist[fpga.host])
+
+    def captureComplete(self, acc, t_elapsed):
+        """ Called by the acc tracker once every board of an accumulation has been read """
+        self.mprint("katcp_server: acc %s read in %.1f ms, read latency (ms): %s"%
+                    (acc, t_elapsed * 1e3, self.scheduler.accSummary(acc)))
+
+    def getDeadline(self):
+        """ Return the capture deadline in seconds after the dump, or None if the period is not known """
+        if self.deadline_frac and self.accWatcher.period:
+            return self.deadline_frac * self.accWatcher.period
+        return None
+
+    def markMissing(self, acc, beam_ids, reason):
+        """ Write missing data markers for boards that will not be read for acc """
+        timestamp = time.time()
+        for beam_id in beam_ids:
+            self.mprint("katcp_server: warning: %s %s for acc %s (%i missed)"%
+                        (beam_id, reason, acc, self.tracker.missed.get(beam_id, 0)))
+            self.hdfQueue.put({'missing_data': {'beam_id': beam_id, 'acc': acc, 'timestamp': timestamp}})
+
+    def checkDeadline(self, acc):
+        """ Expire the boards of acc that have not been read by the deadline """
+        self.markMissing(acc, self.tracker.expire(acc), "missed the deadline")
+
     def triggerDataCapture(self):
         """ Starts multiple KATCP servers to collect data from ROACH boards
 
         Spawns multiple threads, with each thread retrieving from a single board.
-        A queue is used to block until all threads have completed.
+        Reads are staggered as planned by the capture scheduler. When pipelined,
+        this returns straight away, and boards still being read for an earlier
+        accumulation are skipped. Otherwise it blocks until all boards have been
+        read. Boards not read by the deadline are marked as missing for this
+        accumulation, and their data is dropped if it arrives later.
         """
-        # Run threads using queue
+        acc     = self.acc_cnt
+        capture = []
         for fpga in self.fpgalist:
-            if fpga.is_connected():
-                self.threadQueue.put([fpga, self.flavor, 'trigger_capture'])
+            beam_id = config.roachlist[fpga.host]
+            if self.supervisor.isRecovering(beam_id):
+                self.tracker.skip(beam_id)
+                self.markMissing(acc, [beam_id], "reconnecting")
+            elif not fpga.is_connected():
+                self.tracker.skip(beam_id)
+                self.markMissing(acc, [beam_id], "not connected")
+                self.supervisor.wake.set()
+            elif self.tracker.isBusy(beam_id):
+                self.tracker.skip(beam_id)
+                self.markMissing(acc, [beam_id], "still busy")
             else:
-                self.mprint("Warning: %s not connected"%fpga.host)
+                capture.append((beam_id, fpga))
 
-        # Make sure all threads have completed
-        self.threadQueue.join()
+        # Run threads using queue
+        t0      = time.time()
+        offsets = self.scheduler.plan([beam_id for beam_id, fpga in capture])
+        self.tracker.start(acc, [beam_id for beam_id, fpga in capture])
+        for beam_id, fpga in capture:
+            self.threadQueue.put([fpga, self.flavor, 'trigger_capture', acc, t0 + offsets[beam_id],
+                                  {'acc': acc, 'detect': self.acc_time}])
+
+        # The deadline is measured from the dump, not from when it was noticed
+        deadline = self.getDeadline()
+        if capture and deadline is not None:
+            t_dump = t0 if self.acc_time is None else self.acc_time
+            timer = threading.Timer(max(deadline - (time.time() - t_dump), 0), self.checkDeadline, [acc])
+            timer.setDaemon(True)
+            timer.start()
+
+        # Make sure all boards have been read or have missed the deadline
+        if not self.pipelined:
+            self.tracker.wait(acc)
+
+    def forwardResults(self):
+        """ Pass captured data on to the HDF and plotter queues, if not pipelined """
+        if self.pipelined:
+            return
+        while not self.threadQueue_out.empty():
+            self.hdfQueue.put(self.threadQueue_out.get())
+        while not self.threadQueue_plotter.empty():
+            self.plotterQueue.put(self.threadQueue_plotter.get())
 
     def changeFlavor(self, flavor):
-        """ Starts multiple KATCP servers to collect data from ROACH boards
+        """ Reprogram the ROACH boards for a new flavor
 
-        Spawns multiple threads, with each thread retrieving from a single board.
-        A queue is used to block until all threads have completed.
+        Waits for captures in progress, then programs all connected boards in
+        parallel. Boards being reconnected are programmed by the supervisor.
         """
-        self.flavor = flavor
-        # Run threads using queue
+        for acc in self.tracker.inFlight():
+            self.tracker.wait(acc)
+
+        current_flavor = self.flavor
+        self.flavor    = flavor
+        self.accWatcher.setFlavor(flavor)
+        fpgalist = []
         for fpga in self.fpgalist:
-            if fpga.is_connected():
-                self.threadQueue.put([fpga, self.flavor, 'change_flavor'])
+            if self.supervisor.isRecovering(config.roachlist[fpga.host]):
+                continue
+            elif fpga.is_connected():
+                fpgalist.append(fpga)
             else:
                 self.mprint("Warning: %s not connected"%fpga.host)
-
-        # Make sure all threads have completed
-        self.threadQueue.join()
+        self.switcher.switch(fpgalist, flavor, current_flavor)
 
     def safeExit(self):
         """ Attempt to close safely. """
+        self.accWatcher.stop()
+        self.supervisor.stop()
         self.mprint("katcp_server: Closing FPGA connections")
         for fpga in self.fpgalist:
             fpga.stop()
@@ -199,39 +565,33 @@ class KatcpServer(threading.Thread):
     def serverMain(self):
         """ Thread run method. Fetch data from roach"""
         # Start servers threads up
+        self.accWatcher.start()
+        self.supervisor.start()
         while self.server_enabled:
             # Get input queue info (FPGA object)
             #self.mprint("HERE2!")
             msg = self.katcpQueue.get()
             #self.mprint("HERE3!")
+            if msg is None:
+                # Shutdown sentinel
+                self.safeExit()
+                break
             for key in msg.keys():
 
                 if key == 'timestamp':
                     self.timestamp = msg['timestamp']
 
-                if key == 'check_acc':
-                    if self.fpgalist[0].is_connected():
-                        acc_new = self.fpgalist[0].read_int('o_acc_cnt')
-                        self.mainQueue.put({'acc_new': acc_new})
-                    else:
-                        self.mprint("katcp_server: warning: %s is not connected."%self.fpgalist[0].host)
-                        self.mainQueue.put({'acc_new' : msg[key]})
-
                 if key == 'new_acc':
                     #self.mprint("HERE!")
+                    self.acc_cnt  = msg[key]
+                    self.acc_time = msg.get('acc_time')
                     self.triggerDataCapture()
-                    while not self.threadQueue_out.empty():
-                        self.hdfQueue.put(self.threadQueue_out.get())
-                    while not self.threadQueue_plotter.empty():
-                        self.plotterQueue.put(self.threadQueue_plotter.get())
+                    self.forwardResults()
 
                 if key == 'change_flavor':
                     self.mprint("katcp_server: FPGA config change required")
                     self.changeFlavor(msg[key])
-                    while not self.threadQueue_out.empty():
-                        self.hdfQueue.put(self.threadQueue_out.get())
-                    while not self.threadQueue_plotter.empty():
-                        self.plotterQueue.put(self.threadQueue_plotter.get())
+                    self.forwardResults()
 
 
     def run(self):
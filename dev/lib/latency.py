@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+latency.py
+==========
+
+Rolling latency statistics, used to report percentiles of per-command and
+per-stage timings.
+"""
+
+import time, ctypes, ctypes.util
+from collections import deque
+
+CLOCK_MONOTONIC = 1
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clockGettime():
+    """ Return a monotonic clock function using clock_gettime, or None if not available """
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    def monotonic():
+        """ Seconds from CLOCK_MONOTONIC """
+        ts = Timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds from a clock that doesn't jump when the system time is set, for timing
+# intervals. Falls back to time.time if there is no monotonic clock.
+monotonic = getattr(time, 'monotonic', None) or _clockGettime() or time.time
+
+
+def percentile(values, q):
+    """ Return the q-th percentile (0-100) of a list of values, by linear interpolation """
+    if not values:
+        return 0.0
+    data = sorted(values)
+    pos  = (len(data) - 1) * q / 100.0
+    lo   = int(pos)
+    hi   = min(lo + 1, len(data) - 1)
+    return data[lo] + (data[hi] - data[lo]) * (pos - lo)
+
+
+class LatencyStats(object):
+    """ Keeps the most recent latency measurements (in seconds) for one or more keys """
+    def __init__(self, maxlen=10000):
+        self.maxlen  = maxlen
+        self.samples = {}
+        self.counts  = {}
+
+    def add(self, key, latency):
+        """ Add a measurement for key """
+        try:
+            self.samples[key].append(latency)
+        except KeyError:
+            self.samples[key] = deque([latency], maxlen=self.maxlen)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def keys(self):
+        """ Return the keys that have measurements """
+        return sorted(self.samples.keys())
+
+    def percentiles(self, key, qs=(50, 95, 99)):
+        """ Return a list of percentiles for key """
+        values = list(self.samples.get(key, []))
+        return [percentile(values, q) for q in qs]
+
+    def summary(self, qs=(50, 95, 99), keys=None):
+        """ Return a formatted table of count, percentiles (in ms) and max per key """
+        if keys is None:
+            keys = self.keys()
+        header = "%-16s %8s "%("", "count") + " ".join(["%8s"%("p%i"%q) for q in qs]) + " %8s"%"max"
+        lines  = [header]
+        for key in keys:
+            values = list(self.samples.get(key, []))
+            if not values:
+                continue
+            pcts = [percentile(values, q) * 1e3 for q in qs]
+            lines.append("%-16s %8i "%(key, self.counts[key]) +
+                         " ".join(["%8.2f"%p for p in pcts]) + " %8.2f"%(max(values) * 1e3))
+        return "\n".join(lines)
+
+    def clear(self):
+        """ Forget all measurements """
+        self.samples = {}
+        self.counts  = {}
@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+metrics.py
+==========
+
+Local HTTP metrics endpoint for hipsr-server, in the Prometheus plain-text format.
+
+The main process keeps a Metrics object up to date: the subprocesses send their
+cumulative counters as {'stats': {...}} messages on the main queue, queue depths
+are read when the endpoint is scraped, and the RSS and CPU time of each process
+are read from /proc. Try:
+
+    curl http://localhost:9180/metrics
+"""
+
+import os, time, threading
+from collections import deque
+import BaseHTTPServer
+
+CLK_TCK   = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def procStats(pid):
+    """ Return (rss_bytes, cpu_seconds) of a process from /proc, or None if it has exited """
+    try:
+        with open('/proc/%i/stat'%pid) as fh:
+            stat = fh.read()
+    except (IOError, OSError):
+        return None
+    # Fields after the command name, which may contain spaces: state is fields[0]
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] == 'Z':
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / float(CLK_TCK)
+    rss = int(fields[21]) * PAGE_SIZE
+    return rss, cpu
+
+
+class RateCounter(object):
+    """ A running total, with its rate over a sliding time window """
+    def __init__(self, window=10.0):
+        self.window  = window
+        self.total   = 0
+        self.samples = deque()
+
+    def set(self, total, now=None):
+        """ Set the running total """
+        if now is None:
+            now = time.time()
+        self.total = total
+        self.samples.append((now, total))
+        while len(self.samples) > 2 and now - self.samples[1][0] > self.window:
+            self.samples.popleft()
+
+    def add(self, n=1, now=None):
+        """ Add to the running total """
+        self.set(self.total + n, now)
+
+    def rate(self, now=None):
+        """ Return the rate per second over the window """
+        if now is None:
+            now = time.time()
+        if len(self.samples) < 2:
+            return 0.0
+        t0, v0 = self.samples[0]
+        if now - t0 <= 0:
+            return 0.0
+        return (self.total - v0) / (now - t0)
+
+
+class Metrics(object):
+    """ Collects the metrics exposed by the endpoint """
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.queues     = {}    # name: queue
+        self.processes  = {}    # name: pid
+        self.stats      = {}    # server name: latest cumulative counters
+        self.accs       = RateCounter()
+        self.bytes      = RateCounter()
+        self.katcpServer = None
+
+    def addQueue(self, name, queue):
+        """ Report the depth of a queue """
+        self.queues[name] = queue
+
+    def addProcess(self, name, pid):
+        """ Report the RSS and CPU time of a process """
+        self.processes[name] = pid
+
+    def setKatcpServer(self, katcpServer):
+        """ Report the per-board statistics of a KatcpServer """
+        self.katcpServer = katcpServer
+
+    def accumulation(self):
+        """ Count a new accumulation """
+        with self.lock:
+            self.accs.add()
+
+    def update(self, stats):
+        """ Store the cumulative counters sent by a server """
+        with self.lock:
+            self.stats[stats['name']] = stats
+            if 'bytes_written' in stats:
+                self.bytes.set(stats['bytes_written'])
+
+    def render(self):
+        """ Return all metrics as Prometheus plain text """
+        lines = []
+        def metric(name, mtype, helptext, values):
+            lines.append("# HELP %s %s"%(name, helptext))
+            lines.append("# TYPE %s %s"%(name, mtype))
+            for labels, value in values:
+                if labels:
+                    label_str = ",".join(['%s="%s"'%(key, val) for key, val in sorted(labels.items())])
+                    lines.append("%s{%s} %s"%(name, label_str, repr(float(value))))
+                else:
+                    lines.append("%s %s"%(name, repr(float(value))))
+
+        depths = []
+        for name in sorted(self.queues.keys()):
+            try:
+                depths.append(({'queue': name}, self.queues[name].qsize()))
+            except NotImplementedError:
+                pass
+        metric("hipsr_queue_depth", "gauge", "Items waiting on each queue", depths)
+
+        drops, spills = [], []
+        for name in sorted(self.queues.keys()):
+            if hasattr(self.queues[name], 'getStats'):
+                stats = self.queues[name].getStats()
+                drops += [({'queue': name, 'reason': reason}, stats[reason])
+                          for reason in ('dropped_oldest', 'dropped_full', 'rate_limited')]
+                spills.append(({'queue': name}, stats['spilled']))
+        metric("hipsr_queue_dropped_total", "counter", "Messages dropped by each queue's policy", drops)
+        metric("hipsr_queue_spilled_total", "counter", "Messages spilled to disk by each queue", spills)
+
+        with self.lock:
+            metric("hipsr_accumulations_total", "counter", "Accumulations seen by the main loop",
+                   [({}, self.accs.total)])
+            metric("hipsr_accumulations_per_second", "gauge", "Accumulation rate over the last 10 s",
+                   [({}, self.accs.rate())])
+            metric("hipsr_bytes_written_total", "counter", "Bytes of rows written to the HDF file",
+                   [({}, self.bytes.total)])
+            metric("hipsr_bytes_written_per_second", "gauge", "HDF write rate over the last 10 s",
+                   [({}, self.bytes.rate())])
+            plotter = self.stats.get('plotter_server', {})
+            hdf     = self.stats.get('hdf_server', {})
+
+        metric("hipsr_hdf_rows_written_total", "counter", "Rows written to the HDF file",
+               [({}, hdf.get('rows_written', 0))])
+        metric("hipsr_hdf_raw_data_discarded_total", "counter", "Raw data messages received while HDF writing was disabled",
+               [({}, hdf.get('raw_data_discarded', 0))])
+        metric("hipsr_hdf_files_rolled_total", "counter", "HDF files rolled over to the next file of their output set",
+               [({}, hdf.get('files_rolled', 0))])
+        metric("hipsr_hdf_files_closing", "gauge", "Finished HDF files waiting to be closed in the background",
+               [({}, hdf.get('files_closing', 0))])
+        metric("hipsr_udp_frames_sent_total", "counter", "Frames sent to the plotter",
+               [({}, plotter.get('sent', 0))])
+        metric("hipsr_udp_frames_dropped_total", "counter", "Frames not sent to the plotter",
+               [({'reason': reason}, plotter.get(reason, 0)) for reason in ('coalesced', 'stale', 'send_errors')])
+
+        if self.katcpServer is not None:
+            scheduler, tracker = self.katcpServer.scheduler, self.katcpServer.tracker
+            with scheduler.lock:
+                estimates = dict(scheduler.estimates)
+                p95       = dict([(beam_id, scheduler.stats.percentiles(beam_id, (95,))[0]) for beam_id in estimates])
+            metric("hipsr_board_read_latency_seconds", "gauge", "Smoothed read latency of each board",
+                   [({'beam': beam_id}, estimates[beam_id]) for beam_id in sorted(estimates.keys())])
+            metric("hipsr_board_read_latency_p95_seconds", "gauge", "95th percentile read latency of each board",
+                   [({'beam': beam_id}, p95[beam_id]) for beam_id in sorted(p95.keys())])
+            with tracker.lock:
+                missed = dict(tracker.missed)
+            metric("hipsr_board_missed_total", "counter", "Accumulations each board was not read for",
+                   [({'beam': beam_id}, missed[beam_id]) for beam_id in sorted(missed.keys())])
+
+        rss, cpu = [], []
+        for name in sorted(self.processes.keys()):
+            proc = procStats(self.processes[name])
+            if proc is not None:
+                rss.append(({'process': name}, proc[0]))
+                cpu.append(({'process': name}, proc[1]))
+        metric("hipsr_process_resident_memory_bytes", "gauge", "Resident memory of each process", rss)
+        metric("hipsr_process_cpu_seconds_total", "counter", "CPU time used by each process", cpu)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the metrics text on any path """
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Don't log every scrape """
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """ HTTP server thread for the metrics endpoint """
+    def __init__(self, metrics, host='localhost', port=9180):
+        threading.Thread.__init__(self)
+        self.name = 'metrics_server'
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.httpd.metrics = metrics
+
+    def stop(self):
+        """ Stop serving """
+        self.httpd.shutdown()
+
+    def run(self):
+        self.httpd.serve_forever(poll_interval=0.5)
@@ -13,6 +13,7 @@ processes communicate with each other.
 import time, sys, os, socket, random, select, re
 import multiprocessing
 import numpy as np
+from spectrum_json import SpectrumEncoder
 
 try:
     import ujson as json
@@ -31,31 +32,32 @@ class MpServer(multiprocessing.Process):
         self.printQueue     = printQueue
         self.mainQueue      = mainQueue
         self.server_enabled = True
+        self.encoder        = None
 
     def mprint(self, msg):
         """ Send a message to the multiprocessing print queue """
         self.printQueue.put(msg)
     
+    def reportStats(self, stats):
+        """ Report a dictionary of server statistics """
+        items = ["%s=%s"%(key, stats[key]) for key in sorted(stats.keys())]
+        self.mprint("%s: stats: %s"%(self.name, " ".join(items)))
+
+    def publishStats(self, stats):
+        """ Send a dictionary of cumulative counters to the main process, for the metrics endpoint """
+        stats = dict(stats)
+        stats['name'] = self.name
+        self.mainQueue.put({'stats': stats})
+
     def toJsonCmd(self, cmd, val):
         """ Converts a command value pair into a JSON encoded python dictionary."""
         return json.dumps({cmd : val})
 
     def toJsonDict(self, npDict):
         """ Converts a dictionary of numpy arrays into a JSON encoded dictionary of lists."""
-        for key in npDict.keys():
-            for datakey in npDict[key]:
-                try:
-                    if type(npDict[key][datakey]) == type(np.array([0])):
-                        npDict[key][datakey] = npDict[key][datakey].tolist()
-                except:
-                    print key, datakey, npDict[key][datakey]
-                    self.mprint("%s: WARNING: toJsonDict is acting strange"%self.name)
-                    #raise
-        
-        if USES_UJSON:            
-            return json.dumps(npDict, double_precision=3)
-        else:
-            return json.dumps(npDict)
+        if self.encoder is None:
+            self.encoder = SpectrumEncoder(precision=3)
+        return self.encoder.encode(npDict)
     
     def safeExit(self):
         """ Attempt to die with more dignity. """
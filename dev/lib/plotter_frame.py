@@ -0,0 +1,88 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+plotter_frame.py
+================
+
+Compact binary frame format for the hipsr-gui UDP plotter feed, as an alternative to
+JSON encoded spectra.
+
+Each frame carries one polarisation of one beam:
+
+    offset  type     field
+    0       4s       magic, 'HPSR'
+    4       uint8    format version (FRAME_VERSION)
+    5       uint8    beam number (1-13)
+    6       uint8    polarisation (see POLS)
+    7       uint8    flags (FLAG_LOG10: samples are log10 of the spectrum)
+    8       uint32   number of channels
+    12      float64  timestamp (unix time)
+    20      float32  offset
+    24      float32  scale
+    28      uint16[] samples, value = offset + sample * scale
+
+All fields are little-endian. The magic can never start a JSON message, so a GUI
+can tell binary frames and JSON commands apart on the same socket, and can ignore
+frames with a version it does not understand. The plotter server also announces
+the format with a JSON 'frame-format' command.
+"""
+
+import struct
+import numpy as np
+
+FRAME_MAGIC   = 'HPSR'
+FRAME_VERSION = 1
+FRAME_HEADER  = struct.Struct('<4sBBBBIdff')
+FLAG_LOG10    = 0x01
+POLS          = ['xx', 'yy', 're_xy', 'im_xy']
+Q_MAX         = 65535
+
+
+def isBinaryFrame(data):
+    """ Return True if a datagram is a binary plotter frame """
+    return data[:4] == FRAME_MAGIC
+
+def encodeFrame(beam_id, pol, timestamp, spectrum, log=True):
+    """ Encode one polarisation of a spectrum as a binary frame.
+
+    beam_id: beam name, e.g. 'beam_01'
+    pol: polarisation name, one of POLS
+    timestamp: unix timestamp of the spectrum
+    spectrum: numpy array of channel values
+    log: quantize log10 of the spectrum, to keep the dynamic range of the bandpass
+    """
+    data  = np.asarray(spectrum, dtype='float32')
+    flags = 0
+    if log:
+        data  = np.log10(np.maximum(data, 1e-10))
+        flags = FLAG_LOG10
+
+    offset = float(data.min())
+    scale  = float(data.max() - offset) / Q_MAX
+    if scale == 0 or not np.isfinite(scale):
+        scale = 1.0
+    samples = ((data - offset) * (1.0 / scale) + 0.5).astype('<u2')
+
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, int(beam_id.split("_")[1]),
+                               POLS.index(pol), flags, len(samples), timestamp, offset, scale)
+    return header + samples.tostring()
+
+def decodeFrame(data):
+    """ Decode a binary frame into a dictionary (for use in the GUI) """
+    (magic, version, beam, pol, flags, n_chans,
+     timestamp, offset, scale) = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("not a binary plotter frame")
+    if version != FRAME_VERSION:
+        raise ValueError("unsupported frame version %i"%version)
+
+    samples  = np.frombuffer(data, dtype='<u2', count=n_chans, offset=FRAME_HEADER.size)
+    spectrum = offset + samples * np.float32(scale)
+    if flags & FLAG_LOG10:
+        spectrum = 10 ** spectrum
+    return {
+        'beam_id'   : 'beam_%02d'%beam,
+        'pol'       : POLS[pol],
+        'timestamp' : timestamp,
+        'spectrum'  : spectrum
+    }
@@ -5,10 +5,20 @@ plotter_server.py
 ===============
 
 plotter server class for hipsr.
+
+Items on the plotter queue are (key, timestamp, msg) tuples, where key is the beam_id
+for spectra or the TCS key (e.g. 'tcs-ra') for metadata, and timestamp is when the
+item was queued. Spectra carry an accumulation trace (see acc_trace.py) as a fourth
+item, which is sent to the main process once the frame has been sent. In coalescing
+mode only the newest pending frame for each key is sent, at most frame_rate times a
+second, and frames older than max_age are dropped.
 """
 
 import time, sys, os, socket, random, select, re
+import Queue
+from collections import OrderedDict
 import mpserver
+from plotter_frame import FRAME_VERSION
 try:
     import ujson as json
     USES_UJSON = True
@@ -18,34 +28,159 @@ except:
 
 class PlotterServer(mpserver.MpServer):
     """ UDP data server for hipsr-gui plotter """
-    def __init__(self, host, port, printQueue, mainQueue, plotterQueue):
+    def __init__(self, host, port, printQueue, mainQueue, plotterQueue, frame_rate=0, max_age=2.0,
+                 frame_format='json'):
         self.name = 'plotter_server'
         self.host = host
         self.port = port
         self.socket     = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         
         self.plotterQueue = plotterQueue
+        self.frame_rate   = frame_rate      # Send rounds per second. 0 sends every frame.
+        self.max_age      = max_age         # Frames older than this (in s) are dropped
+        self.frame_format = frame_format    # 'json' or 'binary' spectra
+        self.t_announce   = 0
+        self.stats_interval = 60
+        self.t_publish    = 0
+        self.totals       = {'sent': 0, 'coalesced': 0, 'stale': 0, 'send_errors': 0}
+        self.n_sent, self.n_coalesced, self.n_stale, self.n_errors = 0, 0, 0, 0
+        self.resetStats()
         
         super(PlotterServer, self).__init__(self.name, printQueue, mainQueue)
 
+    def getFrameStats(self):
+        """ Return the frame counters since the last reset """
+        return {
+            'sent'        : self.n_sent,
+            'coalesced'   : self.n_coalesced,
+            'stale'       : self.n_stale,
+            'send_errors' : self.n_errors
+        }
+
+    def resetStats(self):
+        """ Reset frame counters, keeping the running totals """
+        for key, val in self.getFrameStats().items():
+            self.totals[key] += val
+        self.n_sent      = 0
+        self.n_coalesced = 0
+        self.n_stale     = 0
+        self.n_errors    = 0
+        self.t_stats     = time.time()
+
+    def reportFrameStats(self):
+        """ Report frame counters """
+        self.reportStats(self.getFrameStats())
+        self.resetStats()
+
+    def publishFrameStats(self):
+        """ Send the running frame totals to the main process, at most once a second """
+        now = time.time()
+        if now - self.t_publish < 1:
+            return
+        self.t_publish = now
+        stats = self.getFrameStats()
+        for key in stats:
+            stats[key] += self.totals[key]
+        self.publishStats(stats)
+
+    def sendFrame(self, msg):
+        """ Send a UDP datagram to the plotter """
+        try:
+            #self.mprint("sending UDP packet to %s"%self.host)
+            self.socket.send(msg)
+            self.n_sent += 1
+        except:
+            #self.mprint("Warning: cannot connect to UDP plotter. Sleeping.")
+            self.n_errors += 1
+
+    def announceFormat(self):
+        """ Tell the GUI which spectrum frame format is in use, every few seconds """
+        now = time.time()
+        if self.frame_format == 'binary' and now - self.t_announce > 5:
+            self.sendFrame(self.toJsonCmd('frame-format', {'format': 'binary', 'version': FRAME_VERSION}))
+            self.t_announce = now
+
+    def sendTraced(self, msg, trace):
+        """ Send a frame, and report its accumulation trace (if any) """
+        self.sendFrame(msg)
+        if trace is not None:
+            trace['udp_send'] = time.time()
+            self.mainQueue.put({'trace': trace})
+
+    def sendPending(self, pending):
+        """ Send the newest pending frame for each key, dropping stale frames """
+        now = time.time()
+        for key, (t_queued, msg, trace) in pending.items():
+            if now - t_queued > self.max_age:
+                self.n_stale += 1
+            else:
+                self.sendTraced(msg, trace)
+        pending.clear()
+
+    def unpackItem(self, item):
+        """ Split a plotter queue item into key, timestamp, msg and trace """
+        if len(item) > 3:
+            key, t_queued, msg, trace = item
+            trace['plot_dequeue'] = time.time()
+        else:
+            key, t_queued, msg = item
+            trace = None
+        return key, t_queued, msg, trace
+
+    def serveAll(self):
+        """ Send every frame in the queue, in order """
+        while self.server_enabled:
+            item = self.plotterQueue.get()
+            if item is None:
+                # Shutdown sentinel
+                break
+            key, t_queued, msg, trace = self.unpackItem(item)
+            self.announceFormat()
+            self.sendTraced(msg, trace)
+            time.sleep(0.01)
+            self.publishFrameStats()
+            if time.time() - self.t_stats > self.stats_interval:
+                self.reportFrameStats()
+
+    def serveCoalesced(self):
+        """ Send the newest frame for each key, at most frame_rate times per second """
+        pending = OrderedDict()
+        t_next  = time.time()
+        while self.server_enabled:
+            try:
+                if pending:
+                    item = self.plotterQueue.get(timeout=max(t_next - time.time(), 0))
+                else:
+                    item = self.plotterQueue.get(timeout=self.stats_interval)
+            except Queue.Empty:
+                item = ()
+
+            if item is None:
+                # Shutdown sentinel
+                break
+            if item:
+                key, t_queued, msg, trace = self.unpackItem(item)
+                if key in pending:
+                    self.n_coalesced += 1
+                    del(pending[key])
+                pending[key] = (t_queued, msg, trace)
+
+            now = time.time()
+            if pending and now >= t_next:
+                self.announceFormat()
+                self.sendPending(pending)
+                t_next = now + 1.0 / self.frame_rate
+                self.publishFrameStats()
+            if now - self.t_stats > self.stats_interval:
+                self.reportFrameStats()
+
     def serverMain(self):
         """ Main loop"""
         self.socket.connect((self.host, self.port))
         self.mprint("Plotter : serving UDP packets on %s port %s... "%(self.host, self.port))
         
-        while self.server_enabled:
-            #self.mprint("Info: plotter server enabled")
-            try:
-                msg = self.plotterQueue.get()
-                #self.mprint(json.loads(msg).keys())
-                try:
-                    #self.mprint("sending UDP packet to %s"%self.host)
-                    self.socket.send(msg)
-                    time.sleep(0.01)
-                except:
-                    #self.mprint("Warning: cannot connect to UDP plotter. Sleeping.")
-                    time.sleep(0.01)
-                    #raise
-            except:
-                #time.sleep()
-               raise
+        if self.frame_rate > 0:
+            self.mprint("Plotter : coalescing frames, %s frames per second"%self.frame_rate)
+            self.serveCoalesced()
+        else:
+            self.serveAll()
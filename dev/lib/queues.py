@@ -0,0 +1,333 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+queues.py
+=========
+
+Bounded inter-process queues with a policy for each kind of message.
+
+A PolicyQueue has two lanes: a bounded data lane, and a control lane that is never
+full and never dropped. A policy function maps each message to one of:
+
+    CONTROL      control lane. get() returns control messages before data, so only
+                 messages that may overtake everything queued (shutdown) belong here.
+    BLOCK        wait up to block_timeout for room, then spill the message to disk.
+                 Spilled messages are read back, in order, once the lane drains.
+                 Nothing is dropped, and order is kept.
+    DROP_OLDEST  make room by dropping the oldest queued message
+    DROP_NEWEST  drop the message if the lane is full
+    RATE_LIMIT   token bucket per producing process, then DROP_NEWEST
+
+Every drop, spill and rate-limited message is counted in shared memory, so the
+counts seen by any process are the totals.
+"""
+
+import os, time, Queue, multiprocessing
+import cPickle as pickle
+
+CONTROL, BLOCK, DROP_OLDEST, DROP_NEWEST, RATE_LIMIT = range(5)
+
+COUNTERS = ['put', 'dropped_oldest', 'dropped_full', 'rate_limited', 'blocked', 'spilled', 'unspilled',
+            'spill_cleared']
+
+# Put on the data lane after a control message, to wake a blocked get()
+WAKE = '__policy_queue_wake__'
+
+
+def hdfPolicy(item):
+    """ The shutdown sentinel is control. Everything else blocks and spills, in order: file
+    and write state changes, safe_exit included, must apply after the rows queued before them. """
+    if item is None:
+        return CONTROL
+    return BLOCK
+
+def plotterPolicy(item):
+    """ Plotter frames drop the oldest; the shutdown sentinel is control """
+    if item is None:
+        return CONTROL
+    return DROP_OLDEST
+
+def printPolicy(item):
+    """ Prints are rate limited; the shutdown sentinel is control """
+    if item is None:
+        return CONTROL
+    return RATE_LIMIT
+
+def mainPolicy(item):
+    """ Traces and stats are telemetry, dropped when full; everything else is control """
+    if isinstance(item, dict) and ('trace' in item or 'stats' in item):
+        return DROP_NEWEST
+    return CONTROL
+
+
+class PolicyQueue(object):
+    """ A bounded multiprocessing queue with per-message drop policies.
+
+    Has the put / get / qsize / empty interface of multiprocessing.Queue.
+    on_drop(item) is called for each dropped message, to free its resources.
+    """
+    def __init__(self, name, policy, maxsize=256, block_timeout=2.0, spill_dir=None,
+                 rate=50.0, burst=200, on_drop=None):
+        self.name          = name
+        self.policy        = policy
+        self.maxsize       = maxsize
+        self.block_timeout = block_timeout
+        self.spill_dir     = spill_dir
+        self.rate          = rate
+        self.burst         = burst
+        self.on_drop       = on_drop
+        self.data          = multiprocessing.Queue(maxsize)
+        self.control       = multiprocessing.Queue()
+        self.counts        = multiprocessing.Array('l', len(COUNTERS))
+        self.spill_lock    = multiprocessing.Lock()
+        self.spill_seq     = multiprocessing.RawValue('l', 0)     # Last spill file written
+        self.unspill_seq   = multiprocessing.RawValue('l', 0)     # Last spill file read back
+        self.spilling      = multiprocessing.RawValue('b', 0)
+        self.wakes         = multiprocessing.Value('l', 0)
+        self.controls      = multiprocessing.Value('l', 0)
+
+        # Token bucket, per producing process
+        self.tokens        = burst
+        self.t_tokens      = time.time()
+        self.suppressed    = 0
+
+        self.clearSpill()
+
+    def count(self, key, n=1):
+        """ Add to a shared counter """
+        with self.counts.get_lock():
+            self.counts[COUNTERS.index(key)] += n
+
+    def addWakes(self, n):
+        """ Count wake tokens on the data lane, so qsize() can leave them out """
+        with self.wakes.get_lock():
+            self.wakes.value += n
+
+    def addControls(self, n):
+        """ Count control messages not yet returned by get() """
+        with self.controls.get_lock():
+            self.controls.value += n
+
+    def getStats(self):
+        """ Return the shared counters as a dictionary """
+        with self.counts.get_lock():
+            return dict(zip(COUNTERS, self.counts[:]))
+
+    def drop(self, item, reason):
+        """ Count a dropped message """
+        self.count(reason)
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def allowRate(self):
+        """ Take a token from this process's bucket. Returns False if the rate is exceeded. """
+        now = time.time()
+        self.tokens   = min(self.burst, self.tokens + (now - self.t_tokens) * self.rate)
+        self.t_tokens = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def put(self, item, block=True, timeout=None):
+        """ Queue a message according to its policy """
+        policy = self.policy(item)
+        if policy == CONTROL:
+            self.addControls(1)
+            self.control.put(item)
+            # Count the token first, so a consumer never sees more tokens than counted
+            self.addWakes(1)
+            try:
+                self.data.put_nowait(WAKE)
+            except Queue.Full:
+                self.addWakes(-1)
+            return
+        self.count('put')
+
+        if policy == BLOCK:
+            self.putBlocking(item)
+        elif policy == DROP_OLDEST:
+            self.putDropOldest(item)
+        elif policy == RATE_LIMIT:
+            if not self.allowRate():
+                self.suppressed += 1
+                self.count('rate_limited')
+                return
+            if self.suppressed:
+                self.putDropNewest("%s: %i messages suppressed"%(self.name, self.suppressed))
+                self.suppressed = 0
+            self.putDropNewest(item)
+        else:
+            self.putDropNewest(item)
+
+    def putDropNewest(self, item):
+        try:
+            self.data.put_nowait(item)
+        except Queue.Full:
+            self.drop(item, 'dropped_full')
+
+    def putDropOldest(self, item):
+        for attempt in range(4):
+            try:
+                self.data.put_nowait(item)
+                return
+            except Queue.Full:
+                try:
+                    # The lane is full, but the oldest message may still be in the feeder thread
+                    old = self.data.get(True, 0.05)
+                except Queue.Empty:
+                    continue
+                if old == WAKE:
+                    self.addWakes(-1)
+                    continue
+                self.drop(old, 'dropped_oldest')
+        self.drop(item, 'dropped_full')
+
+    def putBlocking(self, item):
+        """ Wait for room on the data lane, then spill. Once spilling, keep spilling until the spill drains. """
+        if not self.spilling.value:
+            try:
+                self.data.put(item, True, self.block_timeout)
+                return
+            except Queue.Full:
+                self.count('blocked')
+        with self.spill_lock:
+            self.spill(item)
+
+    def clearSpill(self):
+        """ Remove spill files left by an earlier run, which would otherwise be replayed, or overwritten
+        as spill_seq restarts at 0. They are counted as spill_cleared, so the loss shows in the report. """
+        if self.spill_dir is None or not os.path.isdir(self.spill_dir):
+            return
+        prefix = self.name + "_"
+        for f in os.listdir(self.spill_dir):
+            if f.startswith(prefix) and (f.endswith('.pkl') or f.endswith('.pkl.tmp')):
+                try:
+                    os.remove(os.path.join(self.spill_dir, f))
+                except OSError:
+                    continue
+                if f.endswith('.pkl'):
+                    self.count('spill_cleared')
+
+    def spill(self, item):
+        """ Write a message to the spill directory. Returns False, and drops it, if it can't. Hold spill_lock. """
+        if self.spill_dir is None:
+            self.drop(item, 'dropped_full')
+            return False
+        try:
+            if not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            filename = self.spillFile(self.spill_seq.value + 1)
+            with open(filename + '.tmp', 'wb') as fh:
+                pickle.dump(item, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError, pickle.PicklingError):
+            self.drop(item, 'dropped_full')
+            return False
+        self.spill_seq.value += 1
+        self.spilling.value = 1
+        self.count('spilled')
+        return True
+
+    def spillFile(self, seq):
+        """ Return the name of spill file number seq """
+        return os.path.join(self.spill_dir, "%s_%012i.pkl"%(self.name, seq))
+
+    def unspill(self):
+        """ Read back the oldest spilled message, or return None (and stop spilling) if there are none """
+        with self.spill_lock:
+            while self.spilling.value:
+                if self.unspill_seq.value >= self.spill_seq.value:
+                    self.spilling.value = 0
+                    return None
+                self.unspill_seq.value += 1
+                filename = self.spillFile(self.unspill_seq.value)
+                try:
+                    with open(filename, 'rb') as fh:
+                        item = pickle.load(fh)
+                    os.remove(filename)
+                except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                    self.count('unspilled')
+                    self.count('dropped_full')
+                    continue
+                self.count('unspilled')
+                return item
+        return None
+
+    def get(self, block=True, timeout=None):
+        """ Return the next message: control first, then data, then spilled data """
+        t_stop = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                item = self.control.get_nowait()
+                self.addControls(-1)
+                return item
+            except Queue.Empty:
+                pass
+            try:
+                item = self.data.get_nowait()
+            except Queue.Empty:
+                # Older messages may still be in the feeder thread; they go before any spilled ones
+                if self.data.qsize() > 0:
+                    try:
+                        item = self.data.get(True, 0.05)
+                    except Queue.Empty:
+                        continue
+                    if item != WAKE:
+                        return item
+                    self.addWakes(-1)
+                    continue
+                item = self.unspill()
+                if item is not None:
+                    return item
+                if not block:
+                    raise
+                wait = None if t_stop is None else t_stop - time.time()
+                if wait is not None and wait <= 0:
+                    raise
+                # Sleep until data or a wake token arrives. A control message put while the
+                # lane was full has no token, so only then wait in short slices.
+                if self.controls.value > self.wakes.value:
+                    wait = 0.05 if wait is None else min(wait, 0.05)
+                try:
+                    item = self.data.get(True, wait)
+                except Queue.Empty:
+                    continue
+            if item != WAKE:
+                return item
+            self.addWakes(-1)
+            if self.controls.value <= 0:
+                # Its control message was already returned
+                continue
+            # A control message is on its way
+            try:
+                item = self.control.get(True, 0.05)
+                self.addControls(-1)
+                return item
+            except Queue.Empty:
+                pass
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        """ Approximate number of queued messages, including spilled ones """
+        counts = self.getStats()
+        return max(self.data.qsize() - self.wakes.value + self.control.qsize() +
+                   counts['spilled'] - counts['unspilled'], 0)
+
+    def empty(self):
+        return self.qsize() <= 0
+
+
+def queueReport(queues):
+    """ Return a line with the non-zero drop and spill counts of a list of PolicyQueues, or None """
+    items = []
+    for queue in queues:
+        stats  = queue.getStats()
+        counts = ["%s=%i"%(key, stats[key]) for key in COUNTERS if key not in ('put', 'unspilled') and stats[key]]
+        if counts:
+            items.append("%s %s"%(queue.name, " ".join(counts)))
+    if not items:
+        return None
+    return "queues: " + ", ".join(items)
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+spectrum_json.py
+================
+
+JSON encoding of dictionaries of numpy arrays for the hipsr-gui plotter feed.
+
+Numpy arrays are written straight into the JSON text at a fixed precision. The digits
+of every value are computed with vectorized integer arithmetic into a character
+buffer that is reused between calls, so no Python list or float objects are created
+per channel, and the caller's dictionary is not modified.
+
+Arrays that contain NaN/inf or values too large for fixed-point formatting fall
+back to the json module.
+"""
+
+import numpy as np
+
+try:
+    import ujson as json
+    USES_UJSON = True
+except:
+    import json
+    USES_UJSON = False
+
+# Largest magnitude that can be formatted after scaling by 10**precision
+MAX_SCALED = 1e17
+
+
+class SpectrumEncoder(object):
+    """ Fixed-precision JSON encoder for dictionaries of numpy arrays.
+
+    An encoder keeps scratch buffers for the array sizes it has seen, so each thread
+    should use its own encoder.
+    """
+    def __init__(self, precision=3):
+        self.precision = precision
+        self.scratch   = {}
+
+    def getScratch(self, n):
+        """ Return per-value scratch buffers for arrays of n values """
+        try:
+            return self.scratch[n]
+        except KeyError:
+            buffers = {
+                'float' : np.empty(n, dtype='float64'),
+                'mag'   : np.empty(n, dtype='int64'),
+                'digit' : np.empty(n, dtype='int64'),
+                'ndig'  : np.empty(n, dtype='int64'),
+                'neg'   : np.empty(n, dtype='bool'),
+                'more'  : np.empty(n, dtype='bool')
+            }
+            self.scratch[n] = buffers
+            return buffers
+
+    def getCharBuffers(self, n, width):
+        """ Return the character and mask buffers for n values of width characters """
+        try:
+            return self.scratch[(n, width)]
+        except KeyError:
+            buffers = (np.empty((n, width), dtype='uint8'), np.empty((n, width), dtype='bool'))
+            self.scratch[(n, width)] = buffers
+            return buffers
+
+    def fallback(self, arr):
+        """ Encode an array with the json module """
+        if USES_UJSON:
+            return json.dumps(arr.tolist(), double_precision=self.precision)
+        else:
+            return json.dumps(arr.tolist())
+
+    def encodeArray(self, arr):
+        """ Encode a 1D numpy array as a JSON list """
+        arr = np.asarray(arr).ravel()
+        n   = len(arr)
+        if n == 0:
+            return "[]"
+        if arr.dtype.kind in 'iu':
+            precision = 0
+        elif arr.dtype.kind == 'f':
+            precision = self.precision
+        else:
+            return self.fallback(arr)
+
+        # Scale to fixed-point integers, checking they can be formatted
+        buf = self.getScratch(n)
+        flt = buf['float']
+        np.multiply(arr, 10 ** precision, out=flt)
+        np.rint(flt, out=flt)
+        vmax, vmin = flt.max(), flt.min()
+        if not (np.isfinite(vmax) and np.isfinite(vmin)) or max(vmax, -vmin) >= MAX_SCALED:
+            return self.fallback(arr)
+
+        mag   = buf['mag']
+        digit = buf['digit']
+        ndig  = buf['ndig']
+        np.less(flt, 0, out=buf['neg'])
+        np.abs(flt, out=flt)
+        mag[...] = flt
+
+        # Character layout of each value: [sign][integer digits][.][fraction digits][,]
+        n_digits = max(len("%i"%max(vmax, -vmin)), precision + 1)
+        n_int    = n_digits - precision
+        has_dot  = 1 if precision else 0
+        width    = n_digits + has_dot + 2
+        chars, mask = self.getCharBuffers(n, width)
+
+        chars[:, 0]  = ord('-')
+        chars[:, -1] = ord(',')
+        if has_dot:
+            chars[:, 1 + n_int] = ord('.')
+
+        # Digits, least significant first, counting the significant integer digits
+        ndig.fill(1)
+        for k in range(n_digits):
+            if k < precision:
+                col = width - 2 - k
+            else:
+                col = width - 2 - has_dot - k
+            np.remainder(mag, 10, out=digit)
+            digit += ord('0')
+            chars[:, col] = digit
+            np.floor_divide(mag, 10, out=mag)
+            if k >= precision:
+                np.greater(mag, 0, out=buf['more'])
+                ndig += buf['more']
+
+        # Keep the sign of negative values, and drop leading zeros of the integer part.
+        # Column 1 + j holds the integer digit of power n_int - 1 - j.
+        mask[:, 0]  = buf['neg']
+        mask[:, 1:] = True
+        for j in range(n_int - 1):
+            np.greater(ndig, n_int - 1 - j, out=mask[:, 1 + j])
+
+        text = chars[mask].tostring()
+        return "[" + text[:-1] + "]"
+
+    def encode(self, obj):
+        """ Encode a (nested) dictionary of numpy arrays and scalars as JSON text """
+        if isinstance(obj, dict):
+            items = [json.dumps(str(key)) + ":" + self.encode(val) for key, val in obj.items()]
+            return "{" + ",".join(items) + "}"
+        elif isinstance(obj, np.ndarray):
+            return self.encodeArray(obj)
+        elif isinstance(obj, (list, tuple)):
+            return "[" + ",".join([self.encode(val) for val in obj]) + "]"
+        elif isinstance(obj, np.generic):
+            return self.encode(obj.item())
+        elif isinstance(obj, float) and USES_UJSON:
+            return json.dumps(obj, double_precision=self.precision)
+        else:
+            return json.dumps(obj)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+spectrum_ring.py
+================
+
+Shared-memory ring buffer for passing spectra from the KATCP capture threads to the
+HDF writer process without pickling them.
+
+The ring is a single block of shared memory split into fixed-size slots. A capture
+thread copies the numpy arrays returned by getSpectrum into a free slot, and only a
+small slot descriptor (slot number, beam, accumulation number and array layout) is
+sent through hdfQueue. The HDF writer reads the arrays as zero-copy views on the slot,
+appends them to the file, and then releases the slot back to the ring.
+
+The ring must be created before the HDF server process is started, so that both
+processes share the same memory.
+"""
+
+import multiprocessing
+import numpy as np
+
+
+class SpectrumRing(object):
+    """ Fixed-size shared-memory slots for spectrum data, keyed by beam and accumulation """
+    def __init__(self, n_slots, slot_bytes):
+        self.n_slots    = n_slots
+        self.slot_bytes = slot_bytes
+        self.shm        = multiprocessing.RawArray('B', n_slots * slot_bytes)
+        self.slot_acc   = multiprocessing.RawArray('l', n_slots)
+        self.slot_beam  = multiprocessing.RawArray('i', n_slots)
+        self.in_use     = multiprocessing.RawArray('b', n_slots)
+        self.n_free     = multiprocessing.Semaphore(n_slots)
+        self.lock       = multiprocessing.Lock()
+        self.buf        = None
+
+    def getBuffer(self):
+        """ Return a numpy view of the shared memory (created lazily in each process). """
+        if self.buf is None:
+            self.buf = np.ctypeslib.as_array(self.shm)
+        return self.buf
+
+    def beamNumber(self, beam_id):
+        """ Convert a beam_id such as 'beam_01' into its beam number. """
+        try:
+            return int(beam_id.split("_")[1])
+        except (IndexError, ValueError):
+            return -1
+
+    def acquireSlot(self):
+        """ Mark the first free slot as in use and return it. The caller must hold n_free. """
+        self.lock.acquire()
+        try:
+            for slot in range(self.n_slots):
+                if not self.in_use[slot]:
+                    self.in_use[slot] = 1
+                    return slot
+        finally:
+            self.lock.release()
+        raise RuntimeError("spectrum_ring: no free slot")
+
+    def releaseSlot(self, slot):
+        """ Mark a slot as free. """
+        self.lock.acquire()
+        try:
+            self.in_use[slot] = 0
+        finally:
+            self.lock.release()
+        self.n_free.release()
+
+    def put(self, beam_id, acc, data, timeout=None):
+        """ Copy a dictionary of spectrum data into a free slot.
+
+        Numpy arrays are copied into the slot, other values are carried in the
+        descriptor. Returns the slot descriptor, or None if no slot is free within
+        timeout or the data does not fit in a slot; the caller should then send
+        the data inline.
+        """
+        if timeout:
+            got_slot = self.n_free.acquire(True, timeout)
+        else:
+            got_slot = self.n_free.acquire(False)
+        if not got_slot:
+            return None
+        slot = self.acquireSlot()
+
+        buf     = self.getBuffer()
+        base    = slot * self.slot_bytes
+        offset  = 0
+        fields  = []
+        scalars = {}
+        for key, val in data.items():
+            if isinstance(val, np.ndarray):
+                if offset + val.nbytes > self.slot_bytes:
+                    self.releaseSlot(slot)
+                    return None
+                dest = np.ndarray(val.shape, dtype=val.dtype, buffer=buf, offset=base + offset)
+                dest[...] = val
+                fields.append((key, val.dtype.str, val.shape, offset))
+                offset += (val.nbytes + 7) & ~7         # Keep fields 8-byte aligned
+            else:
+                scalars[key] = val
+
+        self.slot_acc[slot]  = acc if acc is not None else -1
+        self.slot_beam[slot] = self.beamNumber(beam_id)
+
+        return {'slot': slot, 'beam_id': beam_id, 'acc': acc, 'fields': fields, 'scalars': scalars}
+
+    def get(self, desc):
+        """ Return the data dictionary for a slot descriptor.
+
+        Arrays are zero-copy views on shared memory, and are only valid until the
+        slot is released.
+        """
+        slot = desc['slot']
+        acc  = desc['acc'] if desc['acc'] is not None else -1
+        if self.slot_acc[slot] != acc or self.slot_beam[slot] != self.beamNumber(desc['beam_id']):
+            raise ValueError("spectrum_ring: slot %i does not hold %s acc %s"%(slot, desc['beam_id'], desc['acc']))
+
+        buf  = self.getBuffer()
+        base = slot * self.slot_bytes
+        data = dict(desc['scalars'])
+        for key, dtype, shape, offset in desc['fields']:
+            data[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf, offset=base + offset)
+        return data
+
+    def release(self, desc):
+        """ Return a slot to the ring once its data has been written. """
+        self.releaseSlot(desc['slot'])
@@ -8,10 +8,99 @@ TCS Server class for hipsr.
 """
 
 import time, sys, os, socket, select, re
+import asyncore, asynchat
 from datetime import datetime
 import hipsr_core.config as config
 import hipsr_core.astroCoords as coords
+import numpy as np
 import mpserver
+from latency import LatencyStats, monotonic
+
+# scan_pointing record, as written to the scan_pointing table. All fields are float64
+# so the record can also be viewed as a flat array of values; RA/Dec are in degrees.
+SCAN_POINTING_FIELDS = (['timestamp', 'azimuth', 'elevation', 'par_angle',
+                         'focus_tan', 'focus_axi', 'focus_rot'] +
+                        ["mb%02d_raj" % b_id for b_id in range(1, 14)] +
+                        ["mb%02d_dcj" % b_id for b_id in range(1, 14)])
+SCAN_POINTING_DTYPE  = np.dtype([(name, 'float64') for name in SCAN_POINTING_FIELDS])
+SCAN_POINTING_MB     = SCAN_POINTING_FIELDS.index('mb01_raj')
+
+
+def sexagesimalToDeg(values):
+    """ Convert a list of sexagesimal strings ('dd:mm:ss.s' or 'hh:mm:ss.s') to decimal.
+
+    Strings with fewer than three fields (e.g. '10.0' or '10:30') are padded with zero
+    minutes/seconds. Each field is parsed on its own, so a bad value raises ValueError
+    rather than shifting the others. The result is in the units of the first field, so
+    sexagesimal RA values still need multiplying by 15.
+    """
+    padded = [val if val.count(':') == 2 else val + ':0' * (2 - val.count(':')) for val in values]
+    parts  = np.array([float(f) for val in padded for f in val.split(':')]).reshape(-1, 3)
+    sign   = np.where(np.signbit(parts[:, 0]), -1.0, 1.0)
+    return sign * (np.abs(parts[:, 0]) + parts[:, 1] / 60.0 + parts[:, 2] / 3600.0)
+
+
+def regexLiteral(pattern):
+    """ Return the literal string matched by an escaped regex such as config.tcs_regex_esc ('\\n', '\\r\\n') """
+    escapes = {'n': '\n', 'r': '\r', 't': '\t'}
+    return re.sub(r'(?s)\\(.)', lambda m: escapes.get(m.group(1), m.group(1)), pattern)
+
+
+class TcsChannel(asynchat.async_chat):
+    """ A single TCS connection.
+
+    Incoming data is buffered and split into lines, so commands that are split
+    across reads, or that arrive several to a read, are each dispatched once.
+    Lines end with the terminator given by config.tcs_regex_esc, as before.
+    Replies are queued with push() and written as the socket allows.
+    """
+    def __init__(self, tcs_server, sock, socket_map):
+        asynchat.async_chat.__init__(self, sock, map=socket_map)
+        self.tcs_server = tcs_server
+        self.ibuffer    = []
+        self.t_recv     = None
+        self.set_terminator(regexLiteral(config.tcs_regex_esc))
+
+    def collect_incoming_data(self, data):
+        if self.t_recv is None:
+            self.t_recv = monotonic()
+        self.ibuffer.append(data)
+
+    def found_terminator(self):
+        line, self.ibuffer = "".join(self.ibuffer), []
+        t_recv = self.t_recv or monotonic()
+        self.t_recv = None
+        self.tcs_server.handleLine(self, line, t_recv)
+
+    def handle_close(self):
+        self.tcs_server.mprint("TCS I/O: Connection closed.")
+        self.tcs_server.reportAckLatency()
+        self.close()
+
+    def handle_error(self):
+        if isinstance(sys.exc_info()[1], socket.error):
+            self.tcs_server.mprint("TCS I/O: Cannot communicate on socket. Closing connection.")
+            self.close()
+        else:
+            raise
+
+
+class TcsListener(asyncore.dispatcher):
+    """ Listening socket for TCS connections """
+    def __init__(self, tcs_server, host, port, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.tcs_server = tcs_server
+        self.socket_map = socket_map
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            new_socket, addr = pair
+            TcsChannel(self.tcs_server, new_socket, self.socket_map)
 
 
 class TcsServer(mpserver.MpServer):
@@ -21,7 +110,7 @@ class TcsServer(mpserver.MpServer):
     Values are then stored in a shared python dictionary.
     """
 
-    def __init__(self, host, port, printQueue, mainQueue, hdfQueue, plotterQueue, debug=False):
+    def __init__(self, host, port, printQueue, mainQueue, hdfQueue, plotterQueue, debug=False, record=None):
 
         self.name = 'tcs_server'
         self.hdf_write_enable = False
@@ -37,6 +126,10 @@ class TcsServer(mpserver.MpServer):
         self.send_udp = True
         self.debug = debug
         self.new_filename = None
+        self.ackLatency = LatencyStats()
+        self.record     = record        # Path of the TCS command recording, or None
+        self.recorder   = None
+        self.buildCommandTables()
 
         self.obs_setup = {
             'frequency': 0,
@@ -61,23 +154,13 @@ class TcsServer(mpserver.MpServer):
             'source': ''
         }
 
-        self.scan_pointing = {
-            'focus_tan': 0,
-            'focus_axi': 0,
-            'focus_rot': 0,
-            'par_angle': 0,
-            'azimuth': 0,
-            'elevation': 0,
-            'timestamp': 0
-        }
-
-        # Add keys for multibeam RA and DEC entries
-        raj_keys = ["MB%02d_raj" % b_id for b_id in range(1, 14)]
-        for key in raj_keys:
-            self.scan_pointing[key] = 0
-        dcj_keys = ["MB%02d_dcj" % b_id for b_id in range(1, 14)]
-        for key in dcj_keys:
-            self.scan_pointing[key] = 0
+        # Per-cycle pointing record, and the multibeam RA / DEC strings that are
+        # converted into it at the end of each cycle
+        self.scan_pointing = np.zeros(1, dtype=SCAN_POINTING_DTYPE)
+        self.scan_values   = self.scan_pointing.view(np.float64)
+        self.mb_coords     = ['0'] * 26
+        self.mb_coords_bad = None
+        self.utc_day       = (None, 0)
 
         super(TcsServer, self).__init__(self.name, printQueue, mainQueue)
 
@@ -86,7 +169,7 @@ class TcsServer(mpserver.MpServer):
         self.obs_setup["frequency"] = val.strip()
         if self.send_udp:
             msg = self.toJsonCmd('tcs-frequency', val.strip())
-            self.plotterQueue.put(msg)
+            self.plotterQueue.put(('tcs-frequency', time.time(), msg))
         return self.ack_msg
 
     def setBandwidth(self, val):
@@ -94,7 +177,7 @@ class TcsServer(mpserver.MpServer):
         self.obs_setup["bandwidth"] = val.strip()
         if self.send_udp:
             msg = self.toJsonCmd('tcs-bandwidth', val.strip())
-            self.plotterQueue.put(msg)
+            self.plotterQueue.put(('tcs-bandwidth', time.time(), msg))
         return self.ack_msg
 
     def setObserver(self, val):
@@ -178,53 +261,92 @@ class TcsServer(mpserver.MpServer):
         return self.ack_msg
 
     # The following commands may be called every cycle
+    def setScanValue(self, key, val):
+        """ Store a numeric value in the scan_pointing record """
+        try:
+            self.scan_pointing[key] = float(val)
+        except ValueError:
+            self.mprint("TCS I/O: Warning: cannot convert %s value %s"%(key, val.strip()))
+        return self.ack_msg
+
     def setScanRaDec(self, cmd, val):
         #print "Command: %s,        Value: %s"%(cmd, val.strip())
-        self.scan_pointing[cmd] = val.strip()
+        # Stored as a string, and converted with the other beams in endUtcCycle
+        self.mb_coords[self.mb_commands[cmd]] = val.strip()
         return self.ack_msg
 
     def setAzimuth(self, val):
         #print "Command: AZ,        Value: %s"%val.strip()
-        self.scan_pointing["azimuth"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("azimuth", val)
 
     def setElevation(self, val):
         #print "Command: EL,        Value: %s"%val.strip()
-        self.scan_pointing["elevation"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("elevation", val)
 
     def setParAngle(self, val):
         #print "Command: PAR,       Value: %s"%val.strip()
-        self.scan_pointing["par_angle"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("par_angle", val)
 
     def setFocusTan(self, val):
         #print "Command: FOCUSTAN,  Value: %s"%val.strip()
-        self.scan_pointing["focus_tan"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("focus_tan", val)
 
     def setFocusAxi(self, val):
         #print "Command: FOCUSAXI,  Value: %s"%val.strip()
-        self.scan_pointing["focus_axi"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("focus_axi", val)
 
     def setFocusRot(self, val):
         #print "Command: FOCUSROT,  Value: %s"%val.strip()
-        self.scan_pointing["focus_rot"] = val.strip()
-        return self.ack_msg
+        return self.setScanValue("focus_rot", val)
+
+    def parseUtc(self, utc):
+        """ Convert a YYYY-MM-DD-HH:MM:SS.ffffff UTC_CYCLE string into a timestamp.
+
+        Fixed-format parser, with the start of day cached. Gives the same result
+        as strptime followed by time.mktime, which it falls back to if the
+        string is not in the expected format.
+        """
+        if len(utc) < 19 or utc[4] != '-' or utc[10] != '-' or utc[13] != ':' or utc[16] != ':':
+            d_d = datetime.strptime(utc, "%Y-%m-%d-%H:%M:%S.%f")
+            return time.mktime(d_d.utctimetuple()) + (d_d.microsecond / 1e6)
+
+        day, t_day = self.utc_day
+        if utc[0:10] != day:
+            t_day = time.mktime((int(utc[0:4]), int(utc[5:7]), int(utc[8:10]), 0, 0, 0, 0, 0, 0))
+            self.utc_day = (utc[0:10], t_day)
+        return t_day + int(utc[11:13]) * 3600 + int(utc[14:16]) * 60 + float(utc[17:])
 
     def setUtcCycle(self, val):
         #print "Command: UTC_CYCLE,  Value: %s"%val.strip()
         # Convert time string into timestamp
-        d_d = datetime.strptime(val.strip(), "%Y-%m-%d-%H:%M:%S.%f")
-        d_t = time.mktime(d_d.utctimetuple()) + (d_d.microsecond / 1e6)
-        self.scan_pointing["timestamp"] = d_t
+        try:
+            self.scan_pointing["timestamp"] = self.parseUtc(val.strip())
+        except ValueError:
+            self.mprint("TCS I/O: Warning: cannot parse utc_cycle %s"%val.strip())
         return self.ack_msg
 
+    def updateScanCoords(self):
+        """ Convert the multibeam RA / DEC strings to degrees, for all beams at once """
+        try:
+            coords_deg = sexagesimalToDeg(self.mb_coords)
+            if coords_deg.size != 26:
+                raise ValueError("expected 26 coordinates, got %i"%coords_deg.size)
+            # Sexagesimal RA is in hours; decimal RA is already in degrees
+            ra_hours = np.array([':' in val for val in self.mb_coords[:13]])
+            coords_deg[:13][ra_hours] *= 15.0
+            self.scan_values[SCAN_POINTING_MB:SCAN_POINTING_MB + 26] = coords_deg
+            self.mb_coords_bad = None
+        except ValueError:
+            # Keep the previous pointing, and warn once until the coordinates change
+            if self.mb_coords_bad != self.mb_coords:
+                self.mprint("TCS I/O: Warning: cannot convert multibeam coordinates %s"%self.mb_coords)
+                self.mb_coords_bad = list(self.mb_coords)
+
     def endUtcCycle(self):
         #print "Command: UTC_CYCLE_END"
         if self.hdf_write_enable:
-            self.hdfQueue.put({'scan_pointing': self.scan_pointing})
+            self.updateScanCoords()
+            self.hdfQueue.put({'scan_pointing': self.scan_pointing.copy()})
         return self.ack_msg
 
     def setNoMatch(self, val=0):
@@ -283,9 +405,54 @@ class TcsServer(mpserver.MpServer):
         self.mainQueue.put({'kill': True})
         self.server_enabled = False
 
-    def commandDict(self, cmd, val):
-        """ This is essentially a case statement that searches for commands in a dict. """
-        return {
+    def traceSummary(self, val=None):
+        """ Ask the main process to print a summary of the accumulation traces """
+        self.mainQueue.put({'trace_summary': True})
+        return self.ack_msg
+
+    def startCmd(self, val=None):
+        """ Start command: start the observation and queue its header data """
+        self.mprint("TCS I/O: received start.")
+        start_msg, hdf_data = self.startObs()
+        for item in hdf_data:
+            self.hdfQueue.put(item)
+        return start_msg
+
+    def stopObs(self, val=None):
+        """ Stop command: disable writing """
+        self.hdfQueue.put({'write_enable': False})
+        self.mainQueue.put({'write_enable': False})
+        self.hdf_write_enable = False
+        self.mprint("TCS I/O: received stop. Write disabled.")
+        return self.ack_msg
+
+    def buildCommandTables(self):
+        """ Build the command dispatch tables. Called once, from __init__. """
+        # Commands sent without a value
+        self.keyword_commands = {
+            'start': self.startCmd,
+            'stop': self.stopObs,
+            'kill': self.kill,
+            'utc_cycle_end': self.endUtcCycle,
+            'trace_summary': self.traceSummary
+        }
+
+        # Per-cycle pointing commands, stored straight into scan_pointing
+        self.scan_commands = {
+            'az': 'azimuth',
+            'el': 'elevation',
+            'par': 'par_angle',
+            'focustan': 'focus_tan',
+            'focusaxi': 'focus_axi',
+            'focusrot': 'focus_rot'
+        }
+        # Multibeam RA / DEC commands, and their index into mb_coords
+        mb_keys = (["MB%02d_raj" % b_id for b_id in range(1, 14)] +
+                   ["MB%02d_dcj" % b_id for b_id in range(1, 14)])
+        self.mb_commands = dict([(key, idx) for idx, key in enumerate(mb_keys)])
+
+        # Commands sent with a value
+        self.commands = {
             'freq': self.setFreq,
             'hipsr_freq': self.setFreq,
             'src': self.setSrc,
@@ -304,7 +471,7 @@ class TcsServer(mpserver.MpServer):
             'confname': self.setConfName,
             'observer': self.setObserver,
             'obstype': self.setObsMode,
-            'start': self.startObs,
+            'start': self.startCmd,
             'az': self.setAzimuth,
             'el': self.setElevation,
             'par': self.setParAngle,
@@ -312,118 +479,111 @@ class TcsServer(mpserver.MpServer):
             'focusaxi': self.setFocusAxi,
             'focusrot': self.setFocusRot,
             'utc_cycle': self.setUtcCycle,
-            'utc_cycle_end': self.endUtcCycle,
             'new_file': self.newFile,
             'newfile': self.newFile,
             'closef' : self.closeFile,
             'scanrate': self.setScanRate
-        }.get(cmd, self.setNoMatch)(val)    # setNoMatch is default if cmd not found
+        }
+
+    def commandDict(self, cmd, val):
+        """ This is essentially a case statement that searches for commands in a dict. """
+        return self.commands.get(cmd, self.setNoMatch)(val)    # setNoMatch is default if cmd not found
+
+    def parseLine(self, line):
+        """ Split a TCS command line into (cmd, val). val is None for keyword commands. """
+        parts = line.split(None, 1)
+        if not parts:
+            return None, None
+        if len(parts) == 1:
+            return parts[0], None
+        return parts[0], parts[1]
+
+    def dispatch(self, cmd, val):
+        """ Run a parsed TCS command and return its reply (or None) """
+        if val is None:
+            handler = self.keyword_commands.get(cmd)
+            if handler is None:
+                if self.debug:
+                    self.mprint("TCS I/O: ignoring %s"%cmd)
+                return None
+            return handler()
+
+        # Fast paths for the per-cycle commands
+        scan_key = self.scan_commands.get(cmd)
+        if scan_key is not None:
+            return self.setScanValue(scan_key, val)
+
+        if cmd in self.mb_commands:
+            recv_msg = self.setScanRaDec(cmd, val)
+            if cmd == 'MB01_raj':
+                self.mainQueue.put({'update_ra' : val})
+                if self.send_udp:
+                    msg = self.toJsonCmd('tcs-ra', val.strip())
+                    self.plotterQueue.put(('tcs-ra', time.time(), msg))
+            elif cmd == 'MB01_dcj':
+                self.mainQueue.put({'update_dec' : val})
+                if self.send_udp:
+                    msg = self.toJsonCmd('tcs-dec', val.strip())
+                    self.plotterQueue.put(('tcs-dec', time.time(), msg))
+            return recv_msg
+
+        return self.commandDict(cmd, val)
+
+    def handleLine(self, channel, line, t_recv):
+        """ Parse a single TCS command line and send its acknowledgement.
+
+        t_recv is the monotonic time the line started arriving.
+        """
+        if self.debug:
+            self.mprint(repr(line))
+        if self.recorder is not None:
+            self.recorder.write("%.6f\t%s\n"%(t_recv, line))
+
+        cmd, val = self.parseLine(line)
+        if cmd is None:
+            return
+
+        reply = self.dispatch(cmd, val)
+        if reply is not None:
+            channel.push(reply)
+            if cmd in self.mb_commands:
+                cmd = 'MB'
+            self.ackLatency.add(cmd, monotonic() - t_recv)
+
+    def reportAckLatency(self):
+        """ Print per-command acknowledgement latency percentiles (in ms) """
+        if self.ackLatency.keys():
+            self.mprint("TCS I/O: ack latency (ms)\n%s"%self.ackLatency.summary())
+
+    def openRecorder(self):
+        """ Open the TCS command recording, which hipsr-tcs-replay.py can play back.
+
+        Each received line is written as "<monotonic time><tab><line>".
+        """
+        self.recorder = open(self.record, 'a')
+        self.recorder.write("# TCS recording %s:%s, started %s UTC\n"%(self.host, self.port,
+                            datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
+        self.mprint("TCS I/O: recording commands to %s"%self.record)
 
     def serverMain(self):
         """ Run TCP/IP server """
         if self.debug:
             self.mprint("TCS I/O: Debug mode")
-            tcs_regex = '(?P<cmd>\w+)\s(?P<val>.+)'
-        else:
-            tcs_regex = '(?P<cmd>\w+)\s(?P<val>.+)%s' % config.tcs_regex_esc
+        if self.record:
+            self.openRecorder()
 
         self.mprint("TCS listener: Waiting for TCS data %s:%s... " % (self.host, self.port))
-        open_sockets = []
-        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listening_socket.bind((self.host, self.port))
-        listening_socket.listen(5)
+        socket_map = {}
+        TcsListener(self, self.host, self.port, socket_map)
 
+        # Each connection is served by a TcsChannel, which frames the incoming
+        # stream into lines and buffers the acks so they never block
         while self.server_enabled:
-        # Waits for I/O being available for reading from any socket object.
-            rlist, wlist, xlist = select.select([listening_socket] + open_sockets, [], [])
-            for i in rlist:
-                if i is listening_socket:
-                    new_socket, addr = listening_socket.accept()
-                    open_sockets.append(new_socket)
-                else:
-                    try:
-                        socket_ok = True
-                        data = i.recv(1024)
-                    except:
-                        socket_ok = False
-                        self.mprint("TCS I/O: Cannot communicate on socket. Removing from socket list.")
-                    if data == "":
-                        socket_ok = False
-                        self.mprint("TCS I/O: Connection closed.")
-                    if not socket_ok:
-                        try:
-                            open_sockets.remove(i)
-                        except TypeError:
-                            self.mprint("TCS I/O: Socket already removed from open socket list.")
-                    else:
-                        if self.debug:
-                            self.mprint(repr(data))
-                        
-                        #if not self.tcsQueue.empty():
-                        #    msg = self.tcsQueue.get()
-                        #   
-                        #   for key in msg.keys():
-                        #       if key == 'hdf_is_open':
-                        #           self.hdf_is_open == msg[key]
-                        
-                        # Check for start message
-                        is_start = re.search('start%s' % config.tcs_regex_esc, data)
-                        if is_start:
-                            self.mprint("TCS I/O: received start.")
-                            start_msg, hdf_data = self.startObs()
-                            i.send(start_msg)
-                            time.sleep(1e-3)
-                            #i.close()
-
-                            for item in hdf_data:
-                                self.hdfQueue.put(item)
-
-                        # Check for stop message  
-                        is_stop = re.search('stop%s' % config.tcs_regex_esc, data)
-                        if is_stop:
-                            self.hdfQueue.put({'write_enable': False})
-                            self.mainQueue.put({'write_enable': False})
-                            self.hdf_write_enable = False
-                            self.mprint("TCS I/O: received stop. Write disabled.")
-                            i.send(self.ack_msg)
-
-                        # And check for kill
-                        is_kill = re.search('kill%s' % config.tcs_regex_esc, data)
-                        if is_kill:
-                            self.kill()
-
-                        is_utc_end = re.search('utc_cycle_end%s' % config.tcs_regex_esc, data)
-                        if is_utc_end:
-                            self.endUtcCycle()
-                            i.send(self.ack_msg)
-
-                        #is_conf = re.search('confname %s'%config.tcs_regex_esc, data)
-                        #if is_conf:
-
-                        #    self.mprint("confname rec'd.")
-                        #    i.send(self.ack_msg)
-
-                        match = re.search(tcs_regex, data)
-                        if match:
-                            (cmd, val) = (match.groupdict()["cmd"], match.groupdict()["val"])
-                            #print cmd, val
-                            if cmd[0:2] == 'MB':
-                                recv_msg = self.setScanRaDec(cmd, val)
-                                i.send(recv_msg)
-                                if cmd == 'MB01_raj':
-                                    self.mainQueue.put({'update_ra' : val})
-                                    if self.send_udp:
-                                        msg = self.toJsonCmd('tcs-ra', val.strip())
-                                        self.plotterQueue.put(msg)
-                                if cmd == 'MB01_dcj':
-                                    self.mainQueue.put({'update_dec' : val})
-                                    if self.send_udp:
-                                        msg = self.toJsonCmd('tcs-dec', val.strip())
-                                        self.plotterQueue.put(msg)
-                            elif cmd[0:8] == 'new_file':
-                                recv_msg = self.commandDict(cmd, val)
-                                i.send(recv_msg)
-                            else:
-                                recv_msg = self.commandDict(cmd, val)
-                                i.send(recv_msg)
\ No newline at end of file
+            asyncore.loop(timeout=1, map=socket_map, count=1)
+            if self.recorder is not None:
+                self.recorder.flush()
+
+        asyncore.close_all(map=socket_map)
+        if self.recorder is not None:
+            self.recorder.close()
+        self.reportAckLatency()
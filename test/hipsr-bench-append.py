@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-bench-append.py
+=====================
+
+Micro-benchmark of appending raw_data rows to HDF5 tables, comparing the per-key
+Table.row path that hdf_server used to use against the structured-array RowBuffer
+path. For testing purposes only.
+
+Usage: python hipsr-bench-append.py [-n num_chans] [-a num_accs] [-b num_beams]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os, tempfile
+from optparse import OptionParser
+import numpy as np
+import tables as tb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from lib.hdf_server import RowBuffer
+
+
+def rawDataDescription(num_chans):
+    """ A table description with the same layout as a hipsr raw_data beam table """
+    return {
+        'id'        : tb.Int32Col(pos=0),
+        'timestamp' : tb.Float64Col(pos=1),
+        'xx'        : tb.Float32Col(shape=(num_chans,), pos=2),
+        'yy'        : tb.Float32Col(shape=(num_chans,), pos=3),
+        're_xy'     : tb.Float32Col(shape=(num_chans,), pos=4),
+        'im_xy'     : tb.Float32Col(shape=(num_chans,), pos=5),
+        'fft_of'    : tb.BoolCol(pos=6),
+        'adc_clip'  : tb.BoolCol(pos=7)
+    }
+
+def fakeSpectrum(num_chans):
+    """ Generate a dictionary of data like getSpectrum returns """
+    return {
+        'id'        : 1,
+        'timestamp' : time.time(),
+        'xx'        : np.random.random(num_chans).astype('float32'),
+        'yy'        : np.random.random(num_chans).astype('float32'),
+        're_xy'     : np.random.random(num_chans).astype('float32'),
+        'im_xy'     : np.random.random(num_chans).astype('float32'),
+        'fft_of'    : False,
+        'adc_clip'  : False
+    }
+
+def createTables(filename, num_beams, num_chans):
+    """ Create a file with one raw_data table per beam """
+    h5 = tb.openFile(filename, 'w')
+    group = h5.createGroup('/', 'raw_data')
+    tables = [h5.createTable(group, 'beam_%02d'%(b + 1), rawDataDescription(num_chans))
+              for b in range(num_beams)]
+    return h5, tables
+
+def benchRowFlush(tables, data, num_accs):
+    """ Per-key row path, flushing every row (the original hdf_server behaviour) """
+    for acc in range(num_accs):
+        for table in tables:
+            for key in data.keys():
+                table.row[key] = data[key]
+            table.row.append()
+            table.flush()
+
+def benchRow(tables, data, num_accs):
+    """ Per-key row path, flushing once at the end """
+    for acc in range(num_accs):
+        for table in tables:
+            for key in data.keys():
+                table.row[key] = data[key]
+            table.row.append()
+    for table in tables:
+        table.flush()
+
+def benchBulk(tables, data, num_accs, block_rows):
+    """ Structured-array path, appending block_rows rows per Table.append """
+    rowBuffers = [RowBuffer(table, block_rows) for table in tables]
+    for acc in range(num_accs):
+        for rowBuffer in rowBuffers:
+            rowBuffer.add(data)
+    for rowBuffer in rowBuffers:
+        rowBuffer.commit()
+        rowBuffer.table.flush()
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-bench-append.py [options]')
+    p.set_description(__doc__)
+    p.add_option("-n", "--nchans", dest="num_chans", type="int", default=8192,
+                 help="Number of channels per spectrum. Defaults to 8192.")
+    p.add_option("-a", "--accs", dest="num_accs", type="int", default=200,
+                 help="Number of accumulations to write. Defaults to 200.")
+    p.add_option("-b", "--beams", dest="num_beams", type="int", default=13,
+                 help="Number of beams. Defaults to 13.")
+    p.add_option("-r", "--rows", dest="block_rows", type="int", default=64,
+                 help="Rows per block in the bulk path. Defaults to 64.")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    data   = fakeSpectrum(options.num_chans)
+    n_rows = options.num_accs * options.num_beams
+    tmpdir = tempfile.mkdtemp()
+
+    print "\nAppending %i rows of %i channels"%(n_rows, options.num_chans)
+    print "%-24s %10s %12s"%("Path", "Time (s)", "Rows / s")
+
+    benchmarks = [
+        ('row, flush every row', lambda t: benchRowFlush(t, data, options.num_accs)),
+        ('row, single flush',    lambda t: benchRow(t, data, options.num_accs)),
+        ('bulk (%i rows)'%options.block_rows,
+                                 lambda t: benchBulk(t, data, options.num_accs, options.block_rows))
+    ]
+
+    for name, bench in benchmarks:
+        filename = os.path.join(tmpdir, 'bench.h5')
+        h5, tables = createTables(filename, options.num_beams, options.num_chans)
+        t0 = time.time()
+        bench(tables)
+        t_elapsed = time.time() - t0
+        h5.close()
+        os.remove(filename)
+        print "%-24s %10.3f %12.1f"%(name, t_elapsed, n_rows / t_elapsed)
+
+    os.rmdir(tmpdir)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-bench-json.py
+===================
+
+Benchmark of JSON encoding of plotter spectra. Compares the old encoder (tolist() on
+every array, then json.dumps) with lib.spectrum_json.SpectrumEncoder, for a 13 beam
+accumulation, and checks that both produce the same values. For testing purposes only.
+
+Usage: python hipsr-bench-json.py [-n iterations] [-c n_chans]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os
+from optparse import OptionParser
+import numpy as np
+import json as std_json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from lib.spectrum_json import SpectrumEncoder, USES_UJSON, json
+
+N_BEAMS = 13
+
+
+def legacyToJson(npDict):
+    """ The old toJson, which converted every array to a list in place """
+    for key in npDict.keys():
+        for datakey in npDict[key]:
+            try:
+                npDict[key][datakey] = npDict[key][datakey].tolist()
+            except AttributeError:
+                pass
+    if USES_UJSON:
+        return json.dumps(npDict, double_precision=3)
+    else:
+        return json.dumps(npDict)
+
+def makeSpectra(n_chans):
+    """ Generate a plotter message for each beam, with bandpass-like spectra """
+    chans = np.linspace(0, 1, n_chans)
+    msgs  = []
+    for beam in range(1, N_BEAMS + 1):
+        bandpass = 1e4 * (1 + np.sin(np.pi * chans)) * beam
+        msgs.append({'beam_%02d'%beam: {
+                         'xx': bandpass * (1 + 0.01 * np.random.randn(n_chans)),
+                         'yy': bandpass * (1 + 0.01 * np.random.randn(n_chans)),
+                         'timestamp': time.time()}
+                     })
+    return msgs
+
+def copyMsg(msg):
+    """ Copy a message, as the old encoder destroys its input """
+    return dict([(key, dict(val)) for key, val in msg.items()])
+
+def checkEqual(msg, text, tol=1e-3):
+    """ Check that a JSON encoded message matches the original arrays to within tol """
+    decoded = std_json.loads(text)
+    for key, val in msg.items():
+        for datakey, data in val.items():
+            if not np.allclose(decoded[key][datakey], data, rtol=0, atol=tol):
+                return False
+    return True
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-bench-json.py [options]')
+    p.set_description(__doc__)
+    p.add_option("-n", "--iterations", dest="iterations", type="int", default=20,
+                 help="Number of accumulations to encode. Defaults to 20.")
+    p.add_option("-c", "--chans", dest="n_chans", type="int", default=0,
+                 help="Number of plotter channels. Defaults to running both 8192 and 16384.")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    if options.n_chans:
+        chan_sizes = [options.n_chans]
+    else:
+        chan_sizes = [8192, 16384]
+
+    encoder = SpectrumEncoder(precision=3)
+
+    print "\nEncoding %i accumulations of %i beams (ujson: %s)"%(options.iterations, N_BEAMS, USES_UJSON)
+    print "%-8s %-22s %10s %12s %8s"%("Chans", "Encoder", "Time (s)", "ms / beam", "Equal")
+
+    for n_chans in chan_sizes:
+        msgs = makeSpectra(n_chans)
+        n_encoded = options.iterations * len(msgs)
+
+        copies = [copyMsg(msg) for i in range(options.iterations) for msg in msgs]
+        t0 = time.time()
+        for msg in copies:
+            legacyToJson(msg)
+        t_legacy = time.time() - t0
+        ok = all([checkEqual(msg, legacyToJson(copyMsg(msg))) for msg in msgs])
+        print "%-8i %-22s %10.3f %12.3f %8s"%(n_chans, "old (tolist)", t_legacy, t_legacy / n_encoded * 1e3, ok)
+
+        t0 = time.time()
+        for i in range(options.iterations):
+            for msg in msgs:
+                encoder.encode(msg)
+        t_new = time.time() - t0
+        ok = all([checkEqual(msg, encoder.encode(msg)) for msg in msgs])
+        print "%-8i %-22s %10.3f %12.3f %8s"%(n_chans, "new (SpectrumEncoder)", t_new, t_new / n_encoded * 1e3, ok)
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-bench-pipeline.py
+=======================
+
+End-to-end throughput benchmark of hipsr-server. Starts the full pipeline in
+--dummy --test mode in a scratch directory, opens a file and starts an
+observation over the TCS port, lets it run for a fixed time while polling the
+metrics endpoint, then shuts the server down and writes a JSON report:
+
+    accumulations per second (sustained, and expected from the dump period)
+    dropped dumps, and beam reads marked missing
+    writer lag (rows not yet written, and the largest HDF queue depth seen)
+    CPU use and resident memory of each server process
+    output file size
+
+Results can be kept (-o) and compared between releases. For testing purposes only.
+
+Usage: python hipsr-bench-pipeline.py [-n boards] [-f flavor] [-a acc_period] [-t seconds] [-o report.json]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os, socket, subprocess, tempfile, shutil, urllib2, json
+from optparse import OptionParser
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev', 'hipsr-server.py')
+TCS_ADDRESS = ('localhost', 8080)
+
+
+def parseMetrics(text):
+    """ Parse metrics text into a dictionary of {(name, labels): value} """
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        labels = ()
+        if '{' in name:
+            name, label_str = name[:-1].split('{', 1)
+            labels = tuple([tuple(label.split('=', 1)) for label in label_str.split(',')])
+            labels = tuple([(key, val.strip('"')) for key, val in labels])
+        metrics[(name, labels)] = float(value)
+    return metrics
+
+def byLabel(metrics, name):
+    """ Return {label value: value} of a metric with a single label """
+    return dict([(labels[0][1], val) for (key, labels), val in metrics.items() if key == name and labels])
+
+def scrape(port, timeout=2):
+    """ Return the parsed metrics of the server, or None if it is not serving yet """
+    try:
+        return parseMetrics(urllib2.urlopen('http://localhost:%i/metrics'%port, timeout=timeout).read())
+    except (urllib2.URLError, socket.error):
+        return None
+
+def sendTcs(sock, cmd):
+    """ Send a TCS command and wait for its reply """
+    sock.sendall(cmd + "\n")
+    try:
+        return sock.recv(4096)
+    except socket.timeout:
+        return None
+
+def startObservation(options):
+    """ Connect to the TCS port, open a file and start an observation. Returns the socket. """
+    sock = socket.create_connection(TCS_ADDRESS, timeout=5)
+    commands = [
+        'new_file bench.h5', 'receiver MULTI', 'freq 1400', 'band 400', 'src Bench',
+        'ra 10:00:00', 'dec -45:00:00', 'pid P000', 'nbeam %i'%options.boards,
+        'confname %s'%options.flavor, 'observer bench', 'obstype scan', 'start'
+    ]
+    for cmd in commands:
+        sendTcs(sock, cmd)
+    return sock
+
+def fileSize(dir_path):
+    """ Total size of the HDF files written under dir_path """
+    size = 0
+    for root, dirs, files in os.walk(dir_path):
+        size += sum([os.path.getsize(os.path.join(root, f)) for f in files if f.endswith('.h5')])
+    return size
+
+def makeReport(options, first, last, t_elapsed, hdf_depth_max, file_size):
+    """ Build the benchmark report from the first and last metrics scrapes """
+    def delta(name):
+        return last.get((name, ()), 0) - first.get((name, ()), 0)
+
+    accs      = delta('hipsr_accumulations_total')
+    rows      = delta('hipsr_hdf_rows_written_total')
+    expected  = t_elapsed / options.acc_period
+    row_rate  = options.boards / options.acc_period
+    missed_0  = byLabel(first, 'hipsr_board_missed_total')
+    missed    = byLabel(last, 'hipsr_board_missed_total')
+    cpu_0     = byLabel(first, 'hipsr_process_cpu_seconds_total')
+    cpu       = byLabel(last, 'hipsr_process_cpu_seconds_total')
+    rss       = byLabel(last, 'hipsr_process_resident_memory_bytes')
+    dropped   = byLabel(last, 'hipsr_udp_frames_dropped_total')
+
+    return {
+        'config': {
+            'boards'      : options.boards,
+            'flavor'      : options.flavor,
+            'acc_period'  : options.acc_period,
+            'duration'    : options.duration,
+            'server_args' : options.server_args
+        },
+        'elapsed'                   : t_elapsed,
+        'accumulations'             : accs,
+        'accumulations_per_second'  : accs / t_elapsed,
+        'expected_per_second'       : 1.0 / options.acc_period,
+        'dropped_dumps'             : max(int(round(expected - accs)), 0),
+        'beam_reads_missed'         : sum(missed.values()) - sum(missed_0.values()),
+        'rows_written'              : rows,
+        'rows_per_second'           : rows / t_elapsed,
+        'writer_lag_rows'           : max(accs * options.boards - rows, 0),
+        'writer_lag_seconds'        : max(accs * options.boards - rows, 0) / row_rate,
+        'hdf_queue_depth_max'       : hdf_depth_max,
+        'bytes_written_per_second'  : delta('hipsr_bytes_written_total') / t_elapsed,
+        'udp_frames_sent'           : delta('hipsr_udp_frames_sent_total'),
+        'udp_frames_dropped'        : dropped,
+        'cpu_percent'               : dict([(name, 100.0 * (cpu[name] - cpu_0.get(name, 0)) / t_elapsed)
+                                            for name in cpu]),
+        'rss_bytes'                 : rss,
+        'file_size_bytes'           : file_size
+    }
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-bench-pipeline.py [options]')
+    p.set_description(__doc__)
+    p.add_option("-n", "--boards", dest="boards", type="int", default=13,
+                 help="Number of dummy ROACH boards. Defaults to 13.")
+    p.add_option("-f", "--flavor", dest="flavor", type="string", default="hipsr_400_8192",
+                 help="Firmware flavor, which sets the number of channels. Defaults to hipsr_400_8192.")
+    p.add_option("-a", "--acc-period", dest="acc_period", type="float", default=0.5,
+                 help="Accumulation period (s) of the dummy boards. Defaults to 0.5.")
+    p.add_option("-t", "--time", dest="duration", type="float", default=60,
+                 help="Measurement time (s). Defaults to 60.")
+    p.add_option("-W", "--warmup", dest="warmup", type="float", default=5,
+                 help="Time (s) to run before measuring. Defaults to 5.")
+    p.add_option("-M", "--metrics-port", dest="metrics_port", type="int", default=9189,
+                 help="Port for the server's metrics endpoint. Defaults to 9189.")
+    p.add_option("-o", "--output", dest="output", type="string", default=None,
+                 help="Write the JSON report to this file as well as stdout.")
+    p.add_option("-k", "--keep", dest="keep", action="store_true",
+                 help="Keep the scratch directory with the server log and data file.")
+    p.add_option("-s", "--server-args", dest="server_args", type="string", default="",
+                 help="Extra arguments for hipsr-server.py, e.g. \"-b binary -c 8\".")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    workdir = tempfile.mkdtemp(prefix='hipsr-bench-')
+    log     = open(os.path.join(workdir, 'server.log'), 'w')
+    cmd = [sys.executable, SERVER, '--dummy', '--test', '-f', options.flavor, '-n', str(options.boards),
+           '-a', str(options.acc_period), '-M', str(options.metrics_port)] + options.server_args.split()
+    sys.stderr.write("Starting %s\nin %s\n"%(" ".join(cmd), workdir))
+    server = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+    sock = None
+    try:
+        # The metrics endpoint comes up after the boards are programmed
+        t_stop = time.time() + 120
+        while scrape(options.metrics_port) is None:
+            if server.poll() is not None or time.time() > t_stop:
+                raise RuntimeError("server did not start, see %s"%log.name)
+            time.sleep(0.5)
+
+        sock = startObservation(options)
+        time.sleep(options.warmup)
+
+        first = scrape(options.metrics_port)
+        t0    = time.time()
+        hdf_depth_max = 0
+        while time.time() - t0 < options.duration:
+            time.sleep(1)
+            metrics = scrape(options.metrics_port)
+            if metrics is None:
+                raise RuntimeError("server stopped serving metrics, see %s"%log.name)
+            hdf_depth_max = max(hdf_depth_max, metrics.get(('hipsr_queue_depth', (('queue', 'hdf'),)), 0))
+            last = metrics
+        t_elapsed = time.time() - t0
+
+        sendTcs(sock, 'stop')
+        sock.sendall("kill\n")
+        t_stop = time.time() + 30
+        while server.poll() is None and time.time() < t_stop:
+            time.sleep(0.5)
+
+        report = makeReport(options, first, last, t_elapsed, hdf_depth_max,
+                            fileSize(os.path.join(workdir, 'test')))
+    finally:
+        if sock is not None:
+            sock.close()
+        if server.poll() is None:
+            server.kill()
+        log.close()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print text
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(text + "\n")
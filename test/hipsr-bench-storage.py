@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-bench-storage.py
+======================
+
+Compares raw_data storage profiles: writes the same dummy spectra to a multibeam
+file with each profile, the way hdf_server does (createMultiBeam, then the storage
+profile, then RowBuffer appends flushed every block), and reports write
+throughput, file size and the time to read one beam back. For testing purposes only.
+
+Profiles are given as complib:complevel[:chunk_rows], or 'none' for no compression:
+
+    python hipsr-bench-storage.py -f hipsr_200_16384 none zlib:1 blosc:lz4:5 blosc:lz4:5:16
+
+Usage: python hipsr-bench-storage.py [-f flavor] [-a num_accs] [-b num_beams] [profile ...]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os, tempfile, shutil
+from optparse import OptionParser
+import numpy as np
+import tables
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from hipsr_core.hipsr6 import createMultiBeam
+from lib.hdf_server import RowBuffer, DEFAULT_STORAGE_PROFILE, applyStorageProfile
+from lib.dummy_katcp_wrapper import makeBank
+
+DEFAULT_PROFILES = ['none', 'zlib:1', 'zlib:5', 'blosc:5', 'blosc:lz4:5']
+
+
+def parseProfile(spec, expected_rows):
+    """ Make a storage profile from a complib:complevel[:chunk_rows] string """
+    profile = dict(DEFAULT_STORAGE_PROFILE)
+    profile['name'] = spec
+    profile['expected_rows'] = expected_rows
+    if spec == 'none':
+        return profile
+    parts = spec.split(':')
+    # The complib name may itself contain a colon, as in blosc:lz4
+    if len(parts) > 1 and not parts[1].isdigit():
+        parts = [parts[0] + ':' + parts[1]] + parts[2:]
+    profile['complib']   = parts[0]
+    profile['complevel'] = int(parts[1]) if len(parts) > 1 else 5
+    if len(parts) > 2:
+        profile['chunk_rows'] = int(parts[2])
+    return profile
+
+def makeSpectra(num_chans, num_spectra):
+    """ Generate rows of dummy data like the simulated boards serve """
+    bank = makeBank(num_chans, num_spectra).astype('float32')
+    return [{
+        'id'        : i,
+        'xx'        : bank[i],
+        'yy'        : bank[(i + 1) % num_spectra],
+        're_xy'     : bank[(i + 2) % num_spectra] / 10,
+        'im_xy'     : bank[(i + 3) % num_spectra] / 100,
+        'fft_of'    : False,
+        'adc_clip'  : False
+    } for i in range(num_spectra)]
+
+def writeFile(dir_path, flavor, profile, spectra, num_beams, num_accs, block_rows):
+    """ Write num_accs rows to each beam. Returns (seconds, raw bytes, file name, chunk rows). """
+    h5 = createMultiBeam('bench.h5', dir_path, flavor=flavor)
+    applyStorageProfile(h5, profile)
+    beams = h5.listNodes('/raw_data', 'Table')[:num_beams]
+    rowBuffers = [RowBuffer(beam, block_rows) for beam in beams]
+    n_bytes = 0
+
+    t0 = time.time()
+    for acc in range(num_accs):
+        for rowBuffer in rowBuffers:
+            data = spectra[acc % len(spectra)]
+            data['timestamp'] = time.time()
+            rowBuffer.add(data)
+            n_bytes += rowBuffer.table.rowsize
+        if (acc + 1) % block_rows == 0:
+            h5.flush()
+    for rowBuffer in rowBuffers:
+        rowBuffer.commit()
+    h5.flush()
+    chunk_rows = h5.root.raw_data._v_attrs.chunk_rows
+    filename = h5.filename
+    h5.close()
+    return time.time() - t0, n_bytes, filename, chunk_rows
+
+def readBeam(filename):
+    """ Read all of one beam's xx column. Returns seconds. """
+    t0 = time.time()
+    h5 = tables.openFile(filename, 'r')
+    xx = h5.listNodes('/raw_data', 'Table')[0].col('xx')
+    h5.close()
+    return time.time() - t0
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-bench-storage.py [options] [profile ...]')
+    p.set_description(__doc__)
+    p.add_option("-f", "--flavor", dest="flavor", type="string", default="hipsr_400_8192",
+                 help="Firmware flavor, which sets the number of channels. Defaults to hipsr_400_8192.")
+    p.add_option("-a", "--accs", dest="num_accs", type="int", default=200,
+                 help="Number of accumulations to write. Defaults to 200.")
+    p.add_option("-b", "--beams", dest="num_beams", type="int", default=13,
+                 help="Number of beams to write. Defaults to 13.")
+    p.add_option("-r", "--rows", dest="block_rows", type="int", default=64,
+                 help="Rows per flush, as the flush policy max_rows. Defaults to 64.")
+    p.add_option("-d", "--dir", dest="dir_path", type="string", default=None,
+                 help="Directory to write the files in. Defaults to a temporary directory.")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    specs  = args or DEFAULT_PROFILES
+    tmpdir = tempfile.mkdtemp(dir=options.dir_path)
+    num_chans = {'16384': 16384}.get(options.flavor.split('_')[-1], 8192)
+    spectra   = makeSpectra(num_chans, 16)
+
+    print "\nWriting %i accumulations of %i beams, %s"%(options.num_accs, options.num_beams, options.flavor)
+    print "%-18s %6s %10s %10s %10s %8s %10s"%("Profile", "Chunk", "Write (s)", "MB / s", "Size (MB)",
+                                              "Ratio", "Read (s)")
+    try:
+        for spec in specs:
+            profile = parseProfile(spec, options.num_accs)
+            try:
+                available = not profile['complib'] or tables.which_lib_version(profile['complib']) is not None
+            except ValueError:
+                available = False
+            if not available:
+                print "%-18s not available"%spec
+                continue
+            t_write, n_bytes, filename, chunk_rows = writeFile(tmpdir, options.flavor, profile, spectra,
+                options.num_beams, options.num_accs, options.block_rows)
+            size   = os.path.getsize(filename)
+            t_read = readBeam(filename)
+            os.remove(filename)
+            print "%-18s %6i %10.3f %10.1f %10.1f %8.2f %10.3f"%(spec, chunk_rows, t_write, n_bytes / t_write / 2**20,
+                  size / 2.0**20, float(n_bytes) / size, t_read)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
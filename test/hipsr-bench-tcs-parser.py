@@ -0,0 +1,123 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-bench-tcs-parser.py
+=========================
+
+Benchmark of TCS command parsing and dispatch. Replays a TCS command file (scaled up
+by repeating it) through the old per-packet regex parser and through the current
+TcsServer.handleLine, and reports commands per second. For testing purposes only.
+
+Usage: python hipsr-bench-tcs-parser.py [-r repeats] [command_file]
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os, re
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from lib.tcs_server import TcsServer
+
+# Command table of the old parser, which was rebuilt on every command
+LEGACY_COMMANDS = [
+    ('freq', 'setFreq'), ('hipsr_freq', 'setFreq'), ('src', 'setSrc'), ('ra', 'setRa'),
+    ('dec', 'setDec'), ('band', 'setBandwidth'), ('hipsr_band', 'setBandwidth'),
+    ('receiver', 'setReceiver'), ('pid', 'setProjectId'), ('nbeam', 'setNumBeams'),
+    ('refbeam', 'setRefBeam'), ('feedrotation', 'setFeedRotation'), ('feedangle', 'setFeedAngle'),
+    ('taccum', 'setAccLen'), ('dwell', 'setDwellTime'), ('confname', 'setConfName'),
+    ('observer', 'setObserver'), ('obstype', 'setObsMode'), ('start', 'startObs'),
+    ('az', 'setAzimuth'), ('el', 'setElevation'), ('par', 'setParAngle'),
+    ('focustan', 'setFocusTan'), ('focusaxi', 'setFocusAxi'), ('focusrot', 'setFocusRot'),
+    ('utc_cycle', 'setUtcCycle'), ('utc_cycle_end', 'endUtcCycle'), ('new_file', 'newFile'),
+    ('newfile', 'newFile'), ('closef', 'closeFile'), ('scanrate', 'setScanRate')
+]
+
+
+class NullQueue(object):
+    """ Stands in for the multiprocessing queues, so only parsing and dispatch are timed """
+    def put(self, item):
+        pass
+
+
+class NullChannel(object):
+    """ Stands in for a TCS connection """
+    def push(self, data):
+        pass
+
+    def send(self, data):
+        pass
+
+
+def legacyCommandDict(server, cmd, val):
+    """ The old commandDict, which built its table of bound methods on every call """
+    commands = dict([(key, getattr(server, name)) for key, name in LEGACY_COMMANDS])
+    return commands.get(cmd, server.setNoMatch)(val)
+
+def legacyHandle(server, i, data):
+    """ The old per-packet parser: five uncompiled regex searches per packet """
+    esc = '\n'
+    if re.search('start%s' % esc, data):
+        start_msg, hdf_data = server.startObs()
+        i.send(start_msg)
+    if re.search('stop%s' % esc, data):
+        server.hdf_write_enable = False
+        i.send(server.ack_msg)
+    if re.search('kill%s' % esc, data):
+        pass
+    if re.search('utc_cycle_end%s' % esc, data):
+        server.endUtcCycle()
+        i.send(server.ack_msg)
+    match = re.search('(?P<cmd>\w+)\s(?P<val>.+)', data)
+    if match:
+        (cmd, val) = (match.groupdict()["cmd"], match.groupdict()["val"])
+        if cmd[0:2] == 'MB':
+            i.send(server.setScanRaDec(cmd, val))
+        else:
+            i.send(legacyCommandDict(server, cmd, val))
+
+def loadCommands(filename):
+    """ Load a TCS command file, skipping sleeps and kills """
+    lines = [line.rstrip('\n') for line in open(filename)]
+    return [line for line in lines if line.strip() and line.strip() not in ('sleep', 'kill')]
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-bench-tcs-parser.py [options] [command_file]')
+    p.set_description(__doc__)
+    p.add_option("-r", "--repeats", dest="repeats", type="int", default=1000,
+                 help="Number of times to replay the command file. Defaults to 1000.")
+    p.add_option("-c", "--cycles-only", dest="cycles_only", action="store_true",
+                 help="Only replay the per-cycle pointing commands (utc_cycle ... utc_cycle_end, MBxx).")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    if args:
+        command_filename = args[0]
+    else:
+        command_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tcs_test_hipsr_200_16384.txt')
+
+    commands = loadCommands(command_filename)
+    if options.cycles_only:
+        cycle_cmds = ('utc_cycle', 'utc_cycle_end', 'az', 'el', 'par', 'focustan', 'focusaxi', 'focusrot')
+        commands = [line for line in commands if line.split()[0] in cycle_cmds or line.startswith('MB')]
+    commands = commands * options.repeats
+
+    server = TcsServer('localhost', 0, NullQueue(), NullQueue(), NullQueue(), NullQueue())
+    channel = NullChannel()
+
+    print "\nReplaying %i commands from %s"%(len(commands), command_filename)
+    print "%-24s %10s %14s"%("Parser", "Time (s)", "Commands / s")
+
+    t0 = time.time()
+    for line in commands:
+        legacyHandle(server, channel, line + '\n')
+    t_legacy = time.time() - t0
+    print "%-24s %10.3f %14.1f"%("old (regex per packet)", t_legacy, len(commands) / t_legacy)
+
+    t0 = time.time()
+    for line in commands:
+        server.handleLine(channel, line, t0)
+    t_new = time.time() - t0
+    print "%-24s %10.3f %14.1f"%("new (tokenizer + table)", t_new, len(commands) / t_new)
@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+hipsr-tcs-replay.py
+===================
+
+Replays TCS traffic to a hipsr-server, keeping the original timing, and reports
+how quickly the server acknowledged each command. For testing purposes only.
+
+Recordings are made with hipsr-server.py --record-tcs, and hold one received line
+per row as "<monotonic time><tab><line>". Plain TCS command files, such as the
+ones hipsr-dummy-tcs.py sends, can be replayed too: their lines are 50 ms apart,
+and each 'sleep' line is a 1 s pause.
+
+The replay speed is a multiple of real time (-s 1 is real time, -s 10 is ten
+times faster), or -s 0 to send as fast as the acks come back. Like TCS, each
+command waits for the ack of the one before unless --no-wait is given. Reports
+percentiles of the ack latency per command, and of how late commands were sent
+against the schedule.
+
+Usage: python hipsr-tcs-replay.py [-s speed] [-H host] [-p port] recording.log
+
+Copyright (c) 2013 The HIPSR collaboration. All rights reserved.
+"""
+
+import time, sys, os, socket, threading
+from collections import deque
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dev'))
+from lib.latency import LatencyStats, monotonic
+
+# Keyword commands (sent without a value) that TcsServer acknowledges. All commands
+# with a value are acknowledged.
+ACKED_KEYWORDS = ('start', 'stop', 'utc_cycle_end', 'trace_summary')
+
+# The reply to start is not newline terminated, but has a fixed length
+START_REPLY_LEN = len("start_utc 2013-01-01_000000")
+
+PLAIN_GAP = 0.05
+SLEEP_GAP = 1.0
+
+
+def readCommands(filename):
+    """ Read a recording or command file. Returns a list of (seconds after the previous command, line). """
+    commands = []
+    t_last   = None
+    with open(filename) as fh:
+        for row in fh:
+            row = row.rstrip('\n')
+            if row.startswith('#'):
+                # A new recording session: its clock is not comparable with the last one
+                t_last = None
+                continue
+            if '\t' in row:
+                t_str, line = row.split('\t', 1)
+                t_recv = float(t_str)
+                gap    = 0.0 if t_last is None else max(t_recv - t_last, 0.0)
+                t_last = t_recv
+                commands.append((gap, line))
+            elif row.strip() == 'sleep':
+                commands.append((SLEEP_GAP, None))
+            elif row.strip():
+                commands.append((PLAIN_GAP if commands else 0.0, row))
+    return commands
+
+def expectsAck(line):
+    """ Return True if TcsServer sends a reply to a command line """
+    parts = line.split(None, 1)
+    if not parts:
+        return False
+    return len(parts) == 2 or parts[0] in ACKED_KEYWORDS
+
+
+class AckReader(threading.Thread):
+    """ Reads acks from the server, and matches them in order to the commands sent """
+    def __init__(self, sock, ackLatency):
+        threading.Thread.__init__(self)
+        self.sock        = sock
+        self.ackLatency  = ackLatency
+        self.outstanding = deque()          # (cmd, t_send) waiting for an ack
+        self.cond        = threading.Condition()
+        self.buffer      = ""
+        self.closed      = False
+
+    def sent(self, cmd, t_send):
+        """ Record a command that expects an ack """
+        with self.cond:
+            self.outstanding.append((cmd, t_send))
+
+    def waitAcks(self, timeout):
+        """ Wait until every command sent has been acknowledged. Returns False on timeout. """
+        t_stop = monotonic() + timeout
+        with self.cond:
+            while self.outstanding and not self.closed:
+                remaining = t_stop - monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return not self.outstanding
+
+    def nextReply(self):
+        """ Take the next complete reply off the buffer, or return None """
+        cmd = self.outstanding[0][0]
+        if cmd == 'start':
+            if len(self.buffer) < START_REPLY_LEN:
+                return None
+            reply, self.buffer = self.buffer[:START_REPLY_LEN], self.buffer[START_REPLY_LEN:]
+            return reply
+        if '\n' not in self.buffer:
+            return None
+        reply, self.buffer = self.buffer.split('\n', 1)
+        return reply
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error:
+                data = ""
+            t_recv = monotonic()
+            with self.cond:
+                if not data:
+                    self.closed = True
+                    self.cond.notifyAll()
+                    return
+                self.buffer += data
+                while self.outstanding and self.nextReply() is not None:
+                    cmd, t_send = self.outstanding.popleft()
+                    self.ackLatency.add(cmd, t_recv - t_send)
+                    self.ackLatency.add('all', t_recv - t_send)
+                self.cond.notifyAll()
+
+
+def replay(commands, sock, speed, wait, ack_timeout):
+    """ Send the commands on their schedule, until the server closes the connection (e.g. after kill).
+
+    Returns (commands sent, ack latency stats, send lag stats, ack timeouts).
+    """
+    ackLatency = LatencyStats()
+    sendLag    = LatencyStats()
+    reader     = AckReader(sock, ackLatency)
+    reader.daemon = True
+    reader.start()
+
+    timeouts = 0
+    n_sent   = 0
+    t_sched  = monotonic()
+    for gap, line in commands:
+        if speed > 0:
+            t_sched += gap / speed
+            delay = t_sched - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if line is None:
+            continue
+        if wait and not reader.waitAcks(ack_timeout):
+            timeouts += 1
+        t_send = monotonic()
+        if speed > 0:
+            sendLag.add('send_lag', max(t_send - t_sched, 0))
+        cmd = line.split(None, 1)[0] if line.split() else line
+        if cmd.startswith('MB') and cmd[-4:] in ('_raj', '_dcj'):
+            cmd = 'MB'
+        if reader.closed:
+            print "Connection closed by the server"
+            break
+        if expectsAck(line):
+            reader.sent(cmd, t_send)
+        try:
+            sock.sendall(line + "\n")
+        except socket.error as e:
+            print "Connection closed by the server: %s"%e
+            break
+        n_sent += 1
+    if not reader.waitAcks(ack_timeout):
+        timeouts += 1
+    return n_sent, ackLatency, sendLag, timeouts
+
+
+if __name__ == '__main__':
+
+    p = OptionParser()
+    p.set_usage('hipsr-tcs-replay.py [options] recording.log')
+    p.set_description(__doc__)
+    p.add_option("-s", "--speed", dest="speed", type="float", default=1.0,
+                 help="Replay speed as a multiple of real time. Set to 0 to send as fast as possible. Defaults to 1.")
+    p.add_option("-H", "--host", dest="host", type="string", default="localhost",
+                 help="hipsr-server TCS host. Defaults to localhost.")
+    p.add_option("-p", "--port", dest="port", type="int", default=8080,
+                 help="hipsr-server TCS port. Defaults to 8080.")
+    p.add_option("-n", "--no-wait", dest="wait", action="store_false", default=True,
+                 help="Don't wait for each ack before sending the next command.")
+    p.add_option("-t", "--ack-timeout", dest="ack_timeout", type="float", default=5.0,
+                 help="Seconds to wait for outstanding acks. Defaults to 5.")
+    (options, args) = p.parse_args(sys.argv[1:])
+
+    if len(args) != 1:
+        p.print_help()
+        sys.exit(1)
+
+    commands = readCommands(args[0])
+    n_lines  = len([line for gap, line in commands if line is not None])
+    duration = sum([gap for gap, line in commands])
+    print "Replaying %i commands (%2.2f s recorded) to %s:%i at %s"%(n_lines, duration, options.host, options.port,
+          "%gx"%options.speed if options.speed > 0 else "full speed")
+
+    sock = socket.create_connection((options.host, options.port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    t0 = monotonic()
+    n_sent, ackLatency, sendLag, timeouts = replay(commands, sock, options.speed, options.wait, options.ack_timeout)
+    t_elapsed = monotonic() - t0
+    sock.close()
+
+    print "Sent %i commands in %2.2f s (%2.1f commands / s), %i ack timeouts"%(n_sent, t_elapsed,
+          n_sent / t_elapsed, timeouts)
+    print "\nAck latency (ms)"
+    keys = ['all'] + [key for key in ackLatency.keys() if key != 'all']
+    print ackLatency.summary(keys=keys)
+    if sendLag.keys():
+        print "\nSchedule (ms)"
+        print sendLag.summary()